@@ -0,0 +1,130 @@
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from storage import Document, Storage, is_null, one_of
+
+STATS_FIELDS = ('points', 'wins', 'podiums', 'qualifiedWins')
+
+
+def get_month(tournament: Dict[str, Any]) -> str:
+    return datetime.fromtimestamp(tournament['startTimestamp']).strftime('%Y-%m')
+
+
+def get_contributions(tournament: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    players = tournament['standings']['players']
+    contributions: Dict[str, Dict[str, Any]] = {}
+    for standing in players:
+        name = standing.get('name') or standing['username']
+        if name not in contributions:
+            contributions[name] = {field: 0 for field in STATS_FIELDS}
+        contribution = contributions[name]
+        contribution['points'] += standing.get('score', standing.get('points'))
+        if standing['rank'] == 1:
+            contribution['wins'] += 1
+            contribution['won'] = {
+                key: tournament[key] for key in ('id', 'system', 'name', 'fullName') if key in tournament}
+            if len(players) >= 10:
+                contribution['qualifiedWins'] += 1
+        if standing['rank'] <= 3:
+            contribution['podiums'] += 1
+    return contributions
+
+
+def update_totals(row: Dict[str, Any]) -> None:
+    for field in STATS_FIELDS:
+        row[field] = sum(c[field] for c in row['tournaments'].values())
+    row['wonTournaments'] = [c['won'] for c in row['tournaments'].values() if 'won' in c]
+
+
+# Adds the standings of the given tournaments to the per (user, month, player)
+# aggregate rows. Each row keeps the contribution of every tournament, so
+# applying a tournament again replaces its previous contribution. The
+# tournaments get 'stats_month' and 'stats_players' fields which the caller
+# has to save along with the standings.
+def apply_standings(db: Storage, user: str, tournaments: Iterable[Dict[str, Any]]) -> None:
+    tournaments = list(tournaments)
+    if not tournaments:
+        return
+    table = db.table('stats_monthly')
+    # Other threads and processes update the same rows
+    with db.transaction():
+        months = set(get_month(t) for t in tournaments) | set(
+            t['stats_month'] for t in tournaments if 'stats_month' in t)
+        rows: Dict[Tuple[str, str], Dict[str, Any]] = {
+            (row['month'], row['player']): row for row in table.search(user=user, month=one_of(months))}
+        changed = set()
+        for tournament in tournaments:
+            for name in tournament.get('stats_players', []):
+                key = (tournament['stats_month'], name)
+                if key in rows and tournament['id'] in rows[key]['tournaments']:
+                    del rows[key]['tournaments'][tournament['id']]
+                    changed.add(key)
+            month = get_month(tournament)
+            contributions = get_contributions(tournament)
+            for name, contribution in contributions.items():
+                key = (month, name)
+                if key not in rows:
+                    rows[key] = {'user': user, 'month': month, 'player': name, 'tournaments': {}}
+                rows[key]['tournaments'][tournament['id']] = contribution
+                changed.add(key)
+            tournament['stats_month'] = month
+            tournament['stats_players'] = list(contributions)
+        for key in changed:
+            update_totals(rows[key])
+        table.insert_multiple(rows[key] for key in changed if not isinstance(rows[key], Document))
+        table.update_multiple(
+            (rows[key], {'user': user, 'month': key[0], 'player': key[1]})
+            for key in changed if isinstance(rows[key], Document))
+
+
+def read_monthly_stats(db: Storage, user: str, months: List[str]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    statsByMonth: Dict[str, Dict[str, Dict[str, Any]]] = {month: {} for month in months}
+    for row in db.table('stats_monthly').search(user=user, month=one_of(months)):
+        if row['tournaments']:
+            statsByMonth[row['month']][row['player']] = {
+                field: row[field] for field in STATS_FIELDS + ('wonTournaments',)}
+    return statsByMonth
+
+
+def read_leaderboard(db: Storage, user: str, months: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    table = db.table('stats_monthly')
+    rows = table.search(user=user, month=one_of(months)) if months is not None else table.search(user=user)
+    players: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        if not row['tournaments']:
+            continue
+        if row['player'] not in players:
+            players[row['player']] = {'player': row['player'], 'tournaments': 0}
+            players[row['player']].update({field: 0 for field in STATS_FIELDS})
+        player = players[row['player']]
+        player['tournaments'] += len(row['tournaments'])
+        for field in STATS_FIELDS:
+            player[field] += row[field]
+    return sorted(players.values(), key=lambda p: (-p['points'], -p['wins'], p['player']))
+
+
+# Saves fetched standings of stored tournaments together with their
+# contribution to the monthly aggregates
+def store_standings(db: Storage, tournaments: List[Dict[str, Any]], **fields: Any) -> None:
+    by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for tournament in tournaments:
+        by_user.setdefault(tournament['user'], []).append(tournament)
+    with db.transaction():
+        for user, user_tournaments in by_user.items():
+            apply_standings(db, user, user_tournaments)
+        db.table('tournaments').update_multiple(({
+            'standings': tournament['standings'],
+            'stats_month': tournament['stats_month'],
+            'stats_players': tournament['stats_players'],
+            'stats_applied': True,
+            **fields
+        }, {'id': tournament['id']}) for tournament in tournaments)
+
+
+# Standings saved before the aggregates were kept, or by an export of a
+# tournament the harvester no longer looks at, are added once at startup
+def backfill_standings(db: Storage) -> int:
+    tournaments: List[Dict[str, Any]] = [
+        t for t in db.table('tournaments').search(stats_applied=is_null()) if 'standings' in t]
+    store_standings(db, tournaments)
+    return len(tournaments)
@@ -1,8 +1,10 @@
 import logging
 
+from hashlib import sha1
+from secrets import token_hex
 from typing import cast, Any, Dict, Optional
 from datetime import datetime
-from json import dumps, loads
+from json import dumps
 
 import tornado.httpserver
 import tornado.ioloop
@@ -11,58 +13,121 @@ import tornado.auth
 import tornado.escape
 import tornado.options
 
-from tinydb import TinyDB, Query
-
+from dataio import AsyncStorage, run_blocking
 from lichessapi import LichessAPI
+from sessions import SessionStore, store_user
+from storage import Storage
+
+from googleapi import create_public, get, spreadsheet_url
+
+# Part of every ETag, bump when the representation of API responses changes
+ETAG_SCHEMA = 1
+
+
+def get_data_version(db: Storage, user: str) -> str:
+    version = db.table('data_versions').get(user=user)
+    return str(version['version']) if version else ''
+
 
-from googleapi import create_public, get
+# Invalidates ETags of every versioned response of the users. Versions are
+# random rather than counters so concurrent bumps from several server
+# processes can never end up with the same version twice.
+def bump_data_version(db: Storage, *users: str) -> None:
+    table = db.table('data_versions')
+    for user in set(users):
+        table.upsert({'user': user, 'version': token_hex(8)}, user=user)
 
 
 class BaseHandler(tornado.web.RequestHandler):  # type: ignore[misc]
     options = tornado.options.options
     token: str
-    db: TinyDB
+    db: Storage
+    # The same storage with the I/O run in the I/O threads, for handlers
+    async_db: AsyncStorage
 
     @classmethod
-    def set_db(cls, db: TinyDB) -> None:
+    def set_db(cls, db: Storage) -> None:
         cls.db = db
+        cls.async_db = AsyncStorage(db)
 
     @property
     def lichess(self) -> LichessAPI:
         return cast(LichessAPI, self.settings['lichess'])
 
+    @property
+    def sessions(self) -> SessionStore:
+        return cast(SessionStore, self.settings['sessions'])
+
+    async def start_session(self, token: str, lichess_user: Dict[str, Any]) -> None:
+        session = await self.sessions.create(token, await run_blocking(store_user, self.db, lichess_user))
+        self.set_secure_cookie('s', session.id, expires_days=self.sessions.ttl / 86400)
+        self.token = token
+        self._current_user = session.user
+        logging.debug(f'User {self._current_user}')
+
     async def prepare(self) -> None:
-        self.token = (self.get_secure_cookie('t') or b'').decode()
-        user = (self.get_secure_cookie('u') or b'').decode()
-        if self.token:
+        self.token = ''
+        session_id = (self.get_secure_cookie('s', max_age_days=self.sessions.ttl / 86400 + 1) or b'').decode()
+        if session_id:
+            session = await self.sessions.get(session_id)
+            if session is None:
+                self.clear_cookie('s')
+                return
+            self.token = session.token
+            self._current_user = session.user
+            self.sessions.revalidate_if_stale(session, self.lichess)
+            return
+        # Token cookie of logins from before sessions were kept on the server
+        token = (self.get_secure_cookie('t') or b'').decode()
+        if token:
+            self.clear_cookie('t')
+            self.clear_cookie('u')
             try:
-                if user:
-                    self._current_user = loads(user)
-                    return
-                lichess_user = await self.lichess.get_current_user(self.token)
-                users = self.db.table('users')
-                T = Query()
-                current_user = users.get(T.id == lichess_user['id'])
-                if current_user is None:
-                    current_user = lichess_user
-                    users.insert(current_user)
-                else:
-                    users.update(lichess_user, doc_ids=[current_user.doc_id])
-                self._current_user = users.get(T.id == current_user['id'])
-                logging.debug(f'User {self._current_user}')
-                self.set_secure_cookie('u', dumps(self._current_user), 1)
+                await self.start_session(token, await self.lichess.get_current_user(token))
             except Exception as e:
                 logging.warning(f"Cannot get current user: {e}")
-                self.clear_cookie('t')
 
     def get_login_url(self) -> str:
         return "/login"
 
+    # The stats spreadsheet as far as it is known without asking Google
+    def get_stat_spreadsheet_link(self) -> Optional[Dict[str, Any]]:
+        if 'stats_spreadsheet' not in self.current_user:
+            return None
+        spreadsheetId = self.current_user['stats_spreadsheet']
+        return {
+            'spreadsheetId': spreadsheetId,
+            'spreadsheetUrl': spreadsheet_url(spreadsheetId),
+            'lastUpdated': self.current_user.get('stats_last_updated'),
+        }
+
 
 class BaseAPIHandler(BaseHandler):
+    # GET responses of versioned handlers only depend on the URL and on data
+    # owned by the current user, so they are tagged with the user's data
+    # version and answered with 304 before anything is loaded
+    versioned = False
+    _etag: Optional[str] = None
+
     async def prepare(self) -> None:
         await super().prepare()
         self.set_header("Content-Type", "application/json")
+        if self.versioned and self.request.method == 'GET' and self.current_user and not self._finished:
+            version = await run_blocking(get_data_version, self.db, self.current_user['id'])
+            key = f"{ETAG_SCHEMA}:{self.current_user['id']}:{version}:{self.request.uri}"
+            self._etag = f'"{sha1(key.encode()).hexdigest()}"'
+            self.set_header('Etag', self._etag)
+            self.set_header('Cache-Control', 'private, no-cache')
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+
+    def compute_etag(self) -> Optional[str]:
+        return self._etag or super().compute_etag()
+
+    def on_finish(self) -> None:
+        if self.request.method not in ('GET', 'HEAD') and self.get_status() < 400 and self.current_user:
+            bump_data_version(self.db, self.current_user['id'])
 
     def write_error(self, status_code: int, **kwargs: Any) -> None:
         message = "Internal error"
@@ -82,7 +147,6 @@ class BaseAPIHandler(BaseHandler):
     async def get_stat_spreadsheet_for_user(self,
                                             create_if_absent: bool = False
                                             ) -> Optional[Dict[str, Any]]:
-        T = Query()
         spreadsheet = await get(
             self.current_user['stats_spreadsheet']
         ) if 'stats_spreadsheet' in self.current_user else None
@@ -93,11 +157,8 @@ class BaseAPIHandler(BaseHandler):
             )
             spreadsheetId = spreadsheet['spreadsheetId']
 
-            users = self.db.table('users')
-            users.update({'stats_spreadsheet': spreadsheetId},
-                         T.id == self.current_user['id'])
+            await self.sessions.update_user(self.current_user['id'], {'stats_spreadsheet': spreadsheetId})
             self._current_user.update({'stats_spreadsheet': spreadsheetId})
-            self.set_secure_cookie('u', dumps(self._current_user), 1)
             logging.info(
                 f"Spreadsheet {spreadsheetId} for {self.current_user['id']} created"
             )
@@ -106,11 +167,8 @@ class BaseAPIHandler(BaseHandler):
         return spreadsheet
 
     async def on_stats_updated(self) -> str:
-        T = Query()
-        users = self.db.table('users')
         now = datetime.utcnow().isoformat()
-        users.update({'stats_last_updated': now},
-                     T.id == self.current_user['id'])
+        await self.sessions.update_user(self.current_user['id'], {'stats_last_updated': now})
+        await run_blocking(bump_data_version, self.db, self.current_user['id'])
         self._current_user.update({'stats_last_updated': now})
-        self.set_secure_cookie('u', dumps(self._current_user), 1)
         return now
@@ -0,0 +1,51 @@
+import argparse
+import json
+from typing import Any, Dict, Optional
+
+# Arguments which do not change the measurements
+IGNORED_ARGUMENTS = ('json', 'scenario')
+# Lower is better for everything except throughput
+METRICS = (('throughput', 'req/s', 1), ('p50', 'p50 ms', 1000), ('p99', 'p99 ms', 1000),
+           ('peak_rss', 'peak RSS MB', 1 / 2 ** 20))
+
+
+def change(old: Optional[float], new: Optional[float]) -> str:
+    if not old or new is None:
+        return ''
+    return f'{(new - old) / old * 100:+.1f}%'
+
+
+def format_value(value: Optional[float], scale: float) -> str:
+    return '-' if value is None else f'{value * scale:.2f}'
+
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return dict(json.load(f))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare two result files written by bench/run.py --json')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    args = parser.parse_args()
+    old, new = load(args.old), load(args.new)
+    for label, run in (('old', old), ('new', new)):
+        revision = run.get('revision', {})
+        print(f"{label}: {revision.get('commit', '?')[:12]}{' (dirty)' if revision.get('dirty') else ''} {run['date']}")
+    differences = sorted(k for k in set(old['arguments']) | set(new['arguments'])
+                         if k not in IGNORED_ARGUMENTS and old['arguments'].get(k) != new['arguments'].get(k))
+    if differences:
+        print(f"Warning: runs used different arguments: {', '.join(differences)}")
+    print(f'{"scenario":<28} {"metric":<12} {"old":>10} {"new":>10} {"change":>8}')
+    for name in new['results']:
+        if name not in old['results']:
+            continue
+        for key, label, scale in METRICS:
+            before, after = old['results'][name][key], new['results'][name][key]
+            print(f'{name:<28} {label:<12} {format_value(before, scale):>10} {format_value(after, scale):>10} '
+                  f'{change(before, after):>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import random
+from datetime import datetime, timedelta
+from secrets import token_urlsafe
+from typing import Any, Dict, List
+
+from aggregates import store_standings
+from storage import Storage
+
+TIMEZONES = ('Europe/Berlin', 'Europe/Moscow', 'America/New_York', 'Asia/Kolkata', 'Etc/UCT')
+
+
+def make_user(i: int) -> Dict[str, Any]:
+    return {
+        'id': f'bench_user{i}',
+        'username': f'Bench_User{i}',
+        'email': f'bench_user{i}@example.com',
+        'perfs': {'blitz': {'games': 100 + i, 'rating': 1500 + i % 700, 'rd': 60, 'prog': 0}},
+        'stats_spreadsheet': f'bench-spreadsheet-{i}',
+        'stats_last_updated': datetime.utcnow().isoformat(),
+    }
+
+
+# Templates look the way TournamentTemplateHandler stores them
+def make_template(rng: random.Random, user: str, index: int) -> Dict[str, Any]:
+    template: Dict[str, Any] = {
+        'id': token_urlsafe(),
+        'user': user,
+        'tournament_set': 'default',
+        'index': index,
+        'name': f'Club {rng.choice(("Blitz", "Rapid", "Bullet"))} {index}',
+        'startDate': {
+            'weekday': rng.randrange(7),
+            'wall_time': f'{rng.randrange(8, 22):02}:{rng.choice(("00", "30"))}',
+            'timezone': rng.choice(TIMEZONES),
+        },
+        'variant': 'standard',
+        'rated': True,
+        'description': 'Weekly club tournament',
+        'password': rng.choice(('', 'secret')),
+        'conditions.minRating.rating': '0',
+        'conditions.maxRating.rating': '0',
+        'conditions.nbRatedGame.nb': '0',
+    }
+    if rng.random() < 0.5:
+        template.update({
+            'type': 'arena', 'clockTime': 180, 'clockIncrement': 2, 'minutes': 60,
+            'berserkable': True, 'streakable': True, 'hasChat': True})
+    else:
+        template.update({
+            'type': 'swiss', 'clock.limit': 600, 'clock.increment': 5, 'nbRounds': 7,
+            'roundInterval': 60, 'chatFor': 20, 'teamId': 'bench-chess-club'})
+    return template
+
+
+def make_standings(rng: random.Random, system: str, players: List[str]) -> Dict[str, Any]:
+    names = rng.sample(players, min(len(players), rng.randrange(3, 13)))
+    if system == 'arena':
+        return {'page': 1, 'players': [
+            {'name': name, 'rank': rank, 'rating': 2000 - 20 * rank, 'score': 40 - 3 * rank}
+            for rank, name in enumerate(names, 1)]}
+    return {'players': [
+        {'username': name, 'rank': rank, 'rating': 2000 - 20 * rank, 'points': 7 - rank / 2, 'tieBreak': 20 - rank}
+        for rank, name in enumerate(names, 1)]}
+
+
+# Tournaments created from the templates over the past months, with final
+# standings already harvested and applied to the monthly aggregates
+def make_tournaments(rng: random.Random, user: str, templates: List[Dict[str, Any]],
+                     count: int, players: List[str]) -> List[Dict[str, Any]]:
+    now = datetime.utcnow()
+    tournaments = []
+    for i in range(count):
+        template = templates[i % len(templates)]
+        start = now - timedelta(days=rng.uniform(1, 365))
+        system = template['type']
+        tournament = {
+            'id': token_urlsafe(6),
+            'user': user,
+            'tournament_set': 'default',
+            'template': template['id'],
+            'system': system,
+            'password': template['password'] or None,
+            'created': (start - timedelta(days=7)).timestamp(),
+            'startTimestamp': int(start.timestamp()),
+            'startsAt': start.isoformat() + 'Z',
+            'standings': make_standings(rng, system, players),
+            'standings_final': True,
+        }
+        tournament['fullName' if system == 'arena' else 'name'] = template['name']
+        tournaments.append(tournament)
+    return tournaments
+
+
+def make_diploma_template(user: str, index: int) -> Dict[str, Any]:
+    return {
+        'id': token_urlsafe(16),
+        'user': user,
+        'name': f'Diploma {index}',
+        'fields': {
+            'background': {'type': 'BackgroundImage', 'image': None},
+            'title': {'type': 'TextField', 'text': 'Diploma', 'font': 'Serif', 'font_size': 36, 'color': '#000',
+                      'fabric_props': {'left': 150, 'top': 60}},
+            'player': {'type': 'TextField', 'text': '${player.name}', 'font': 'Sans', 'font_size': 24,
+                       'color': '#333', 'fabric_props': {'left': 150, 'top': 160}},
+            'place': {'type': 'TextField', 'text': '${player.rank} place in ${tournament.fullName}', 'font': 'Sans',
+                      'font_size': 14, 'color': '#333', 'fabric_props': {'left': 150, 'top': 200}},
+            'date': {'type': 'TextField', 'text': '${tournament.date}', 'font': 'Sans', 'font_size': 12,
+                     'color': '#333', 'fabric_props': {'left': 150, 'top': 380}},
+        },
+    }
+
+
+def generate(db: Storage, users: int, templates: int, tournaments: int, diplomas: int,
+             players: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    pool = [f'player_{i}' for i in range(players)]
+    user_docs = [make_user(i) for i in range(users)]
+    db.table('users').insert_multiple(user_docs)
+    for user in user_docs:
+        user_templates = [make_template(rng, user['id'], i) for i in range(templates)]
+        db.table('templates').insert_multiple(user_templates)
+        user_tournaments = make_tournaments(rng, user['id'], user_templates, tournaments, pool)
+        db.table('tournaments').insert_multiple(user_tournaments)
+        store_standings(db, user_tournaments, standings_final=True)
+        db.table('diploma_templates').insert_multiple(make_diploma_template(user['id'], i) for i in range(diplomas))
+    return user_docs
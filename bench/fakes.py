@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timezone
+from itertools import count
+from os.path import dirname, join as path_join
+from secrets import token_urlsafe
+from typing import Any, Dict, List
+
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado.httpserver
+
+FIXTURES_DIR = path_join(dirname(__file__), 'fixtures')
+
+
+def load_fixture(name: str) -> str:
+    with open(path_join(FIXTURES_DIR, name)) as f:
+        return f.read()
+
+
+def discovery_document(name: str, root_url: str) -> Dict[str, Any]:
+    return json.loads(load_fixture(f'{name}.json').replace('{root_url}', root_url))
+
+
+class FakeConfig():
+    def __init__(self, latency: float = 0.0, throttle: float = 0.0, retry_after: float = 1.0,
+                 google_latency: float = 0.0, google_throttle: float = 0.0, seed: int = 0) -> None:
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.google_latency = google_latency
+        self.google_throttle = google_throttle
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+
+
+# Serves the recorded replies with fresh ids. Every reply is delayed by the
+# configured latency and a share of them is answered with 429 instead.
+class FakeHandler(tornado.web.RequestHandler):  # type: ignore[misc]
+    google = False
+
+    def initialize(self, config: FakeConfig) -> None:
+        self.config = config
+
+    async def prepare(self) -> None:
+        config = self.config
+        config.requests += 1
+        latency = config.google_latency if self.google else config.latency
+        if latency:
+            await asyncio.sleep(latency)
+        if config.random.random() < (config.google_throttle if self.google else config.throttle):
+            config.throttled += 1
+            self.set_status(429)
+            self.set_header('Retry-After', str(config.retry_after))
+            self.finish({'error': 'Too many requests. Try again later.'})
+
+    def reply(self, fixture: str, **substitutions: str) -> None:
+        body = load_fixture(fixture)
+        for key, value in substitutions.items():
+            body = body.replace(f'{{{key}}}', value)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(body)
+
+    def log_exception(self, *args: Any) -> None:
+        logging.exception("Fake server error")
+
+
+class ArenaHandler(FakeHandler):
+    def get(self, id: str) -> None:
+        self.reply('arena.json', id=id)
+
+    def post(self) -> None:
+        starts_at = datetime.fromtimestamp(int(self.get_body_argument('startDate')) / 1000, timezone.utc)
+        self.reply('created-arena.json', id=token_urlsafe(6), startsAt=starts_at.isoformat())
+
+
+class SwissHandler(FakeHandler):
+    def get(self, id: str) -> None:
+        self.reply('swiss.json', id=id)
+
+
+class SwissCreateHandler(FakeHandler):
+    def post(self, team: str) -> None:
+        starts_at = datetime.fromtimestamp(int(self.get_body_argument('startsAt')) / 1000, timezone.utc)
+        self.reply('created-swiss.json', id=token_urlsafe(6), startsAt=starts_at.isoformat())
+
+
+class SwissResultsHandler(FakeHandler):
+    def get(self, id: str) -> None:
+        lines = load_fixture('swiss-results.ndjson').splitlines(keepends=True)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.finish(''.join(lines[:int(self.get_argument('nb', str(len(lines))))]))
+
+
+class UsersHandler(FakeHandler):
+    def post(self) -> None:
+        user = load_fixture('user.json')
+        users = [
+            json.loads(user.replace('{id}', name.lower()).replace('{username}', name))
+            for name in self.request.body.decode().split(',') if name]
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(users))
+
+
+class AccountHandler(FakeHandler):
+    def get(self) -> None:
+        self.reply('account.json', username='Bench_School')
+
+
+class EmailHandler(FakeHandler):
+    def get(self) -> None:
+        self.reply('email.json')
+
+
+class TeamsHandler(FakeHandler):
+    def get(self, user: str) -> None:
+        self.reply('teams.json')
+
+
+class GoogleHandler(FakeHandler):
+    google = True
+    sheet_ids = count(1)
+
+
+class SpreadsheetsHandler(GoogleHandler):
+    def post(self) -> None:
+        self.reply('spreadsheet.json', id=token_urlsafe(32))
+
+
+class SpreadsheetHandler(GoogleHandler):
+    def get(self, id: str) -> None:
+        self.reply('spreadsheet.json', id=id)
+
+
+class SpreadsheetBatchUpdateHandler(GoogleHandler):
+    def post(self, id: str) -> None:
+        replies: List[Dict[str, Any]] = []
+        for request in json.loads(self.request.body)['requests']:
+            properties = dict(request['addSheet']['properties'], sheetId=next(self.sheet_ids))
+            replies.append({'addSheet': {'properties': properties}})
+        self.finish({'spreadsheetId': id, 'replies': replies})
+
+
+class ValuesHandler(GoogleHandler):
+    def put(self, id: str, range: str) -> None:
+        values = json.loads(self.request.body)['values']
+        self.finish({'spreadsheetId': id, 'updatedRange': range, 'updatedRows': len(values)})
+
+
+class ValuesBatchUpdateHandler(GoogleHandler):
+    def post(self, id: str) -> None:
+        data = json.loads(self.request.body)['data']
+        self.finish({'spreadsheetId': id, 'totalUpdatedRows': sum(len(d['values']) for d in data)})
+
+
+class FilesHandler(GoogleHandler):
+    def get(self) -> None:
+        self.finish({'kind': 'drive#fileList', 'files': []})
+
+
+class FileHandler(GoogleHandler):
+    def delete(self, id: str) -> None:
+        self.set_status(204)
+        self.finish()
+
+
+class PermissionsHandler(GoogleHandler):
+    def post(self, id: str) -> None:
+        self.finish({'kind': 'drive#permission', 'id': token_urlsafe(12), 'type': 'user', 'role': 'writer'})
+
+
+def make_app(config: FakeConfig) -> tornado.web.Application:
+    args = {'config': config}
+    return tornado.web.Application([
+        (r'/api/tournament', ArenaHandler, args),
+        (r'/api/tournament/([^/]+)', ArenaHandler, args),
+        (r'/api/swiss/new/([^/]+)', SwissCreateHandler, args),
+        (r'/api/swiss/([^/]+)/results', SwissResultsHandler, args),
+        (r'/api/swiss/([^/]+)', SwissHandler, args),
+        (r'/api/users', UsersHandler, args),
+        (r'/api/account', AccountHandler, args),
+        (r'/api/account/email', EmailHandler, args),
+        (r'/api/team/of/([^/]+)', TeamsHandler, args),
+        (r'/v4/spreadsheets', SpreadsheetsHandler, args),
+        (r'/v4/spreadsheets/([^/:]+):batchUpdate', SpreadsheetBatchUpdateHandler, args),
+        (r'/v4/spreadsheets/([^/:]+)/values:batchUpdate', ValuesBatchUpdateHandler, args),
+        (r'/v4/spreadsheets/([^/:]+)/values/(.+)', ValuesHandler, args),
+        (r'/v4/spreadsheets/([^/:]+)', SpreadsheetHandler, args),
+        (r'/drive/v3/files', FilesHandler, args),
+        (r'/drive/v3/files/([^/]+)/permissions', PermissionsHandler, args),
+        (r'/drive/v3/files/([^/]+)', FileHandler, args),
+    ], log_function=lambda handler: None)
+
+
+# Runs in a separate process so the fakes do not share the CPU of the load
+# generator
+def serve(port: int, config: FakeConfig) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    sockets = tornado.netutil.bind_sockets(port, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(make_app(config))
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from binascii import hexlify
+from datetime import datetime, timedelta
+from glob import glob
+from os.path import abspath, dirname, join as path_join
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, cast
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.web import create_signed_value
+
+from bench.dataset import generate
+from bench.fakes import FakeConfig, serve
+from sessions import SessionStore
+from storage import open_storage
+
+ROOT = dirname(dirname(abspath(__file__)))
+COOKIE_SECRET = 'bench-cookie-secret'
+XSRF = hexlify(b'bench-xsrf-token').decode()
+
+# (method, path, body) of a request made as the given user
+RequestFactory = Callable[[random.Random, Dict[str, Any], int], Tuple[str, str, Optional[bytes]]]
+
+
+class Scenario(NamedTuple):
+    name: str
+    # Request i goes to user i modulo the number of users instead of a
+    # random one, the factory gets i divided by the number of users
+    sequential_users: bool
+    request: RequestFactory
+
+
+def tournament_api(system: str) -> RequestFactory:
+    def request(rng: random.Random, user: Dict[str, Any], i: int) -> Tuple[str, str, Optional[bytes]]:
+        # A limited set of ids, so most requests are answered from the cache
+        # of Lichess replies like in production
+        url = f'https://lichess.org/{system}/bench{rng.randrange(200)}'
+        return 'GET', f'/api/v1/tournament?{urlencode({"tournament": url, "results": 1})}', None
+    return request
+
+
+def tournament_create(rng: random.Random, user: Dict[str, Any], i: int) -> Tuple[str, str, Optional[bytes]]:
+    # Every request creates the tournaments of all templates of a user for a
+    # week that user has not created yet
+    week = datetime.utcnow() + timedelta(weeks=1 + i)
+    return 'POST', '/api/v1/tournament/create', json.dumps({'week': week.timestamp(), 'templates': []}).encode()
+
+
+def get(path: str) -> RequestFactory:
+    return lambda rng, user, i: ('GET', path, None)
+
+
+SCENARIOS = [
+    Scenario('tournament_api.arena', False, tournament_api('tournament')),
+    Scenario('tournament_api.swiss', False, tournament_api('swiss')),
+    Scenario('tournament_create', True, tournament_create),
+    Scenario('tournament_last', False, get('/api/v1/tournament/last')),
+    Scenario('tournament_templates', False, get('/api/v1/tournament/template/')),
+    Scenario('diploma_templates', False, get('/api/v1/diploma/template/')),
+    Scenario('stats', False, get('/api/v1/tournament/stats')),
+    Scenario('leaderboard', False, get('/api/v1/tournament/leaderboard?period=all')),
+    Scenario('home', False, get('/')),
+]
+MICRO_BENCHMARKS = ('consolidate_stats_by_month',)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return int(s.getsockname()[1])
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if monotonic() > deadline:
+                raise
+            sleep(0.1)
+
+
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    for children in glob(f'/proc/{pid}/task/*/children'):
+        try:
+            with open(children) as f:
+                for child in f.read().split():
+                    pids.extend(process_tree(int(child)))
+        except OSError:
+            continue
+    return pids
+
+
+# Peak resident memory is read from VmHWM and reset through clear_refs,
+# both of which only exist on Linux
+def reset_peak_rss(pid: int) -> None:
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            return None
+    return total or None
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(p * len(values)) - 1))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float, rss: Optional[int]) -> Dict[str, Any]:
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, .5),
+        'p99': percentile(latencies, .99),
+        'peak_rss': rss,
+    }
+
+
+def cookies(user: Dict[str, Any]) -> str:
+    session = create_signed_value(COOKIE_SECRET, 's', user['session']).decode()
+    return f's={session}; _xsrf={XSRF}'
+
+
+async def load(base_url: str, scenario: Scenario, users: List[Dict[str, Any]],
+               requests: int, concurrency: int, seed: int, first: int = 0) -> Tuple[List[float], int, float]:
+    rng = random.Random(seed)
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    headers = {user['id']: cookies(user) for user in users}
+    latencies: List[float] = []
+    errors = 0
+    next_request = 0
+
+    async def worker() -> None:
+        nonlocal errors, next_request
+        while next_request < requests:
+            i = next_request
+            next_request += 1
+            if scenario.sequential_users:
+                user, n = users[i % len(users)], first + i // len(users)
+            else:
+                user, n = rng.choice(users), i
+            method, path, body = scenario.request(rng, user, n)
+            request = HTTPRequest(
+                f'{base_url}{path}', method=method, body=body, follow_redirects=False, request_timeout=300,
+                headers={'Cookie': headers[user['id']], 'X-XSRFToken': XSRF, 'Accept-Encoding': 'gzip, br'},
+                decompress_response=False)
+            start = monotonic()
+            res = await client.fetch(request, raise_error=False)
+            latencies.append(monotonic() - start)
+            if res.code != 200:
+                errors += 1
+                if errors <= 3:
+                    logging.warning(f"{scenario.name}: {res.code} for {method} {path}")
+
+    start = monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = monotonic() - start
+    client.close()
+    return latencies, errors, elapsed
+
+
+def run_scenario(base_url: str, pid: int, scenario: Scenario, users: List[Dict[str, Any]],
+                 args: argparse.Namespace) -> Dict[str, Any]:
+    if args.warmup:
+        # Sequential scenarios continue after the requests measured later
+        asyncio.run(load(base_url, scenario, users, args.warmup, args.concurrency, args.seed + 1,
+                         args.requests // len(users) + 1))
+    reset_peak_rss(pid)
+    latencies, errors, elapsed = asyncio.run(
+        load(base_url, scenario, users, args.requests, args.concurrency, args.seed))
+    return summarize(latencies, errors, elapsed, peak_rss(pid))
+
+
+def run_consolidate_stats(db_dir: str, work_dir: str, users: List[Dict[str, Any]],
+                          args: argparse.Namespace) -> Dict[str, Any]:
+    # Importing stats loads the Google service account key from the working
+    # directory
+    os.chdir(work_dir)
+    from stats import TournamentStatsHandlerBase
+    os.chdir(ROOT)
+    db = open_storage(args.storage, db_dir)
+    tournaments = [db.table('tournaments').search(user=user['id']) for user in users[:args.requests]]
+    db.close()
+    year = datetime.utcnow().year
+    latencies = []
+    reset_peak_rss(os.getpid())
+    start = monotonic()
+    for i in range(args.requests):
+        call_start = monotonic()
+        # The method does not use the handler
+        TournamentStatsHandlerBase.consolidate_stats_by_month(
+            cast(Any, None), year, cast(List[Dict[str, Any]], tournaments[i % len(tournaments)]))
+        latencies.append(monotonic() - call_start)
+    return summarize(latencies, 0, monotonic() - start, peak_rss(os.getpid()))
+
+
+def write_config(path: str, db_dir: str, port: int, args: argparse.Namespace) -> None:
+    values = {
+        'port': port,
+        'bind': '127.0.0.1',
+        'base_url': f'http://127.0.0.1:{port}',
+        'db_dir': db_dir,
+        'storage': args.storage,
+        'processes': args.processes,
+        'cookie_secret': COOKIE_SECRET,
+        'logging': 'warning',
+        # Keep the harvester, the rate limits and the creation quota out of the measurements
+        'harvest_interval': 86400.0,
+        'lichess_rate': 10000.0,
+        'lichess_token_rate': 10000.0,
+        'lichess_concurrency': 10000,
+        'daily_public_tournaments': 1000000,
+        'daily_private_tournaments': 1000000,
+    }
+    for option in args.option:
+        name, value = option.split('=', 1)
+        values[name] = json.loads(value)
+    with open(path, 'w') as f:
+        for name, value in values.items():
+            f.write(f'{name} = {value!r}\n')
+
+
+def revision() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                cwd=ROOT, capture_output=True, text=True).stdout
+    except OSError:
+        return {}
+    return {'commit': commit.strip(), 'dirty': bool(status.strip())}
+
+
+def print_results(results: Dict[str, Dict[str, Any]]) -> None:
+    print(f'{"scenario":<28} {"requests":>8} {"errors":>6} {"req/s":>9} '
+          f'{"p50 ms":>9} {"p99 ms":>9} {"peak RSS MB":>11}')
+    for name, r in results.items():
+        rss = f'{r["peak_rss"] / 2 ** 20:.1f}' if r['peak_rss'] else '-'
+        print(f'{name:<28} {r["requests"]:>8} {r["errors"]:>6} {r["throughput"]:>9.1f} '
+              f'{r["p50"] * 1000:>9.2f} {r["p99"] * 1000:>9.2f} {rss:>11}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Run the server against fake Lichess and Google servers and measure the main endpoints')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--templates', type=int, default=8, help='Tournament templates per user')
+    parser.add_argument('--tournaments', type=int, default=40, help='Past tournaments per user')
+    parser.add_argument('--diplomas', type=int, default=3, help='Diploma templates per user')
+    parser.add_argument('--players', type=int, default=2000, help='Distinct players in standings')
+    parser.add_argument('--storage', default='sqlite')
+    parser.add_argument('--processes', type=int, default=1, help='Server processes')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight')
+    parser.add_argument('--warmup', type=int, default=20, help='Requests per scenario before measuring')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the fake Lichess takes to reply')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Share of Lichess requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After of injected 429 replies')
+    parser.add_argument('--google-latency', type=float, default=0.1, help='Seconds the fake Google takes to reply')
+    parser.add_argument('--google-throttle', type=float, default=0.0,
+                        help='Share of Google requests answered with 429')
+    parser.add_argument('--scenario', action='append', default=[],
+                        help=f'Run only these, any of {", ".join(MICRO_BENCHMARKS + tuple(s.name for s in SCENARIOS))}')
+    parser.add_argument('--option', action='append', default=[], help='Extra server option as name=JSON value')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write results to this file for bench/compare.py')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    selected = set(args.scenario)
+
+    work_dir = tempfile.mkdtemp(prefix='tournaments-bench-')
+    db_dir = path_join(work_dir, 'db')
+    os.makedirs(db_dir)
+    with open(path_join(work_dir, 'google_key.json'), 'w') as f:
+        json.dump({'type': 'service_account', 'client_email': 'bench@example.com', 'private_key': '',
+                   'token_uri': 'https://oauth2.googleapis.com/token'}, f)
+    logging.info(f"Generating {args.users} users in {db_dir}")
+    start = time()
+    db = open_storage(args.storage, db_dir)
+    users = generate(db, args.users, args.templates, args.tournaments, args.diplomas, args.players, args.seed)
+    sessions = SessionStore(db)
+
+    async def create_sessions() -> None:
+        for user in users:
+            user['session'] = (await sessions.create(f'bench-token-{user["id"]}', user)).id
+    asyncio.run(create_sessions())
+    db.close()
+    generation_time = time() - start
+
+    results: Dict[str, Dict[str, Any]] = {}
+    if not selected or 'consolidate_stats_by_month' in selected:
+        logging.info("Running consolidate_stats_by_month")
+        results['consolidate_stats_by_month'] = run_consolidate_stats(db_dir, work_dir, users, args)
+
+    fake_port = free_port()
+    fake_config = FakeConfig(args.latency, args.throttle, args.retry_after,
+                             args.google_latency, args.google_throttle, args.seed)
+    fakes = multiprocessing.Process(target=serve, args=(fake_port, fake_config), daemon=True)
+    fakes.start()
+    port = free_port()
+    config = path_join(work_dir, 'bench.conf')
+    write_config(config, db_dir, port, args)
+    wait_for_port(fake_port)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'bench.server', work_dir, config, f'http://127.0.0.1:{fake_port}'],
+        cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT))
+    try:
+        wait_for_port(port)
+        for scenario in SCENARIOS:
+            if selected and scenario.name not in selected:
+                continue
+            logging.info(f"Running {scenario.name}")
+            results[scenario.name] = run_scenario(f'http://127.0.0.1:{port}', server.pid, scenario, users, args)
+    finally:
+        server.terminate()
+        server.wait(60)
+        fakes.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'revision': revision(),
+                'date': datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'arguments': vars(args),
+                'generation_time': generation_time,
+                'results': results,
+            }, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
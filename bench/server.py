@@ -0,0 +1,38 @@
+import json
+import os
+import sys
+from os.path import join as path_join
+
+from bench.fakes import discovery_document
+
+# The real server with Lichess and Google pointed at the fake server.
+# Usage: python3 -m bench.server <work dir> <config> <fake server url>
+
+
+def main() -> None:
+    work_dir, config, fake_url = sys.argv[1:4]
+    # googleapi reads the service account key from the working directory
+    # when imported, webapp parses the command line when imported
+    os.chdir(work_dir)
+    sys.argv = ['webapp', f'--config={config}']
+    import webapp
+    from aiogoogle.auth.utils import _get_expires_at
+    from lichessapi import LichessAPI
+
+    for name, value in vars(LichessAPI).items():
+        if isinstance(value, str) and value.startswith('https://lichess.org/'):
+            setattr(LichessAPI, name, value.replace('https://lichess.org', fake_url, 1))
+    # A token that never expires, the fake key cannot sign token requests
+    manager = webapp.googleapi.client.aiogoogle.service_account_manager
+    manager._access_token = 'bench'
+    manager._expires_at = _get_expires_at(365 * 86400)
+    discovery_dir = path_join(webapp.options.db_dir, 'google')
+    os.makedirs(discovery_dir, exist_ok=True)
+    for name in ('sheets-v4', 'drive-v3'):
+        with open(path_join(discovery_dir, f'{name}.json'), 'w') as f:
+            json.dump(discovery_document(name, f'{fake_url}/'), f)
+    webapp.run()
+
+
+if __name__ == '__main__':
+    main()
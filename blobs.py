@@ -0,0 +1,69 @@
+import re
+from base64 import b64decode
+from binascii import Error as Base64Error
+from hashlib import sha256
+from mimetypes import guess_extension
+from os import makedirs, replace
+from os.path import exists, join as path_join
+from secrets import token_hex
+from typing import Any, Dict, Optional
+
+from tornado.options import options
+import tornado.web
+
+BLOB_URL = '/diplomas/blob/'
+BLOB_NAME = r'[0-9a-f]{64}\.[a-z0-9]+'
+
+_DATA_URL = re.compile(r'data:(?P<type>[-\w.+]+/[-\w.+]+)?(?:;[^,;]*)*;base64,(?P<data>.*)', re.S)
+_BLOB_NAME = re.compile(BLOB_NAME)
+
+
+def blob_dir() -> str:
+    return path_join(options.db_dir, 'blobs')
+
+
+# Stores data under its SHA-256 hash, so identical images uploaded to any
+# number of templates by any number of users are kept once
+def put_blob(data: bytes, content_type: Optional[str]) -> str:
+    extension = (guess_extension(content_type or '') or '.bin').lstrip('.')
+    name = f'{sha256(data).hexdigest()}.{extension}'
+    path = path_join(blob_dir(), name)
+    if not exists(path):
+        makedirs(blob_dir(), mode=0o700, exist_ok=True)
+        tmp = f'{path}.{token_hex(8)}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        replace(tmp, path)
+    return f'{BLOB_URL}{name}'
+
+
+def blob_path(url: str) -> Optional[str]:
+    if not url.startswith(BLOB_URL) or not _BLOB_NAME.fullmatch(url[len(BLOB_URL):]):
+        return None
+    return path_join(blob_dir(), url[len(BLOB_URL):])
+
+
+# Replaces inline base64 images in diploma fields with blob URLs.
+# Returns True if anything was replaced.
+def externalize_images(fields: Dict[str, Any]) -> bool:
+    changed = False
+    for field in fields.values():
+        image = field.get('image') if isinstance(field, dict) else None
+        if not isinstance(image, str) or not image.startswith('data:'):
+            continue
+        match = _DATA_URL.fullmatch(image)
+        if not match:
+            continue
+        try:
+            data = b64decode(match['data'])
+        except Base64Error:
+            continue
+        field['image'] = put_blob(data, match['type'])
+        changed = True
+    return changed
+
+
+class BlobHandler(tornado.web.StaticFileHandler):  # type: ignore[misc]
+    # Blob names change whenever the content does
+    def set_extra_headers(self, path: str) -> None:
+        self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
@@ -0,0 +1,96 @@
+import asyncio
+from collections import OrderedDict
+from json import dumps, loads
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple
+
+
+class CacheEntry(NamedTuple):
+    data: str
+    expires: float
+
+
+class ResponseCache():
+    # Values are kept serialized: every caller gets its own copy it is free to
+    # mutate, and the entry size is known exactly for the byte limit
+    def __init__(self, max_entries: int = 2048, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._entries: 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+        self._pending: Dict[Hashable, 'asyncio.Future[str]'] = {}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+        }
+
+    def lookup(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return loads(entry.data)
+
+    def put(self, key: Hashable, value: Any, ttl: float) -> None:
+        self._store(key, dumps(value), ttl)
+
+    def invalidate(self, key: Hashable) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+    async def get(self,
+                  key: Hashable,
+                  fetch: Callable[[], Awaitable[Any]],
+                  ttl: Callable[[Any], float]) -> Any:
+        value = self.lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        # Concurrent identical requests share a single upstream fetch
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch, ttl))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        else:
+            self.shared += 1
+        return loads(await asyncio.shield(task))
+
+    async def _fetch(self,
+                     key: Hashable,
+                     fetch: Callable[[], Awaitable[Any]],
+                     ttl: Callable[[Any], float]) -> str:
+        value = await fetch()
+        data = dumps(value)
+        self._store(key, data, ttl(value))
+        return data
+
+    def _store(self, key: Hashable, data: str, ttl: float) -> None:
+        if ttl <= 0 or len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = CacheEntry(data, monotonic() + ttl)
+        self.bytes += len(data)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self.bytes -= len(entry.data)
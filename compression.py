@@ -0,0 +1,110 @@
+import gzip
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Type
+
+from tornado import httputil
+from tornado.web import GZipContentEncoding, OutputTransform, RequestHandler
+
+from dataio import run_blocking
+
+try:
+    import brotli  # type: ignore[import]
+except ModuleNotFoundError:
+    brotli = None
+
+
+def accepts(handler: RequestHandler, encoding: str) -> bool:
+    return encoding in handler.request.headers.get('Accept-Encoding', '')
+
+
+class BrotliContentEncoding(GZipContentEncoding):  # type: ignore[misc]
+    # Brotli is preferred over gzip when the client supports both. Only
+    # complete responses are compressed; GZipContentEncoding runs after this
+    # transform and leaves responses that already have a Content-Encoding.
+    BROTLI_QUALITY = 5
+
+    def __init__(self, request: httputil.HTTPServerRequest) -> None:
+        self._compressing = 'br' in request.headers.get('Accept-Encoding', '')
+
+    def transform_first_chunk(
+            self,
+            status_code: int,
+            headers: httputil.HTTPHeaders,
+            chunk: bytes,
+            finishing: bool) -> Tuple[int, httputil.HTTPHeaders, bytes]:
+        ctype = str(headers.get('Content-Type', '')).split(';')[0]
+        if (self._compressing and finishing and len(chunk) >= self.MIN_LENGTH
+                and self._compressible_type(ctype) and 'Content-Encoding' not in headers):
+            headers['Content-Encoding'] = 'br'
+            chunk = brotli.compress(chunk, quality=self.BROTLI_QUALITY)
+            if 'Content-Length' in headers:
+                headers['Content-Length'] = str(len(chunk))
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk: bytes, finishing: bool) -> bytes:
+        return chunk
+
+
+def get_transforms() -> List[Type[OutputTransform]]:
+    if brotli is None:
+        return [GZipContentEncoding]
+    return [BrotliContentEncoding, GZipContentEncoding]
+
+
+class PrecompressedCache():
+    # Keeps serialized responses together with their compressed variants so a
+    # repeated request for the same large document is served without
+    # serializing or compressing it again. Variants are compressed in the I/O
+    # threads; quality 11 takes seconds for a template of a few megabytes.
+    MIN_LENGTH = 16 * 1024
+    BROTLI_QUALITY = 9
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Dict[str, bytes]]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, bytes]]:
+        variants = self._entries.get(key)
+        if variants is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return variants
+
+    @classmethod
+    def compress(cls, body: bytes) -> Dict[str, bytes]:
+        variants = {'identity': body, 'gzip': gzip.compress(body, GZipContentEncoding.GZIP_LEVEL)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(body, quality=cls.BROTLI_QUALITY)
+        return variants
+
+    async def put(self, key: str, body: bytes) -> Optional[Dict[str, bytes]]:
+        if self.max_bytes <= 0 or len(body) < self.MIN_LENGTH:
+            return None
+        variants = await run_blocking(self.compress, body)
+        size = sum(len(v) for v in variants.values())
+        if size > self.max_bytes:
+            return None
+        if key in self._entries:
+            self.bytes -= sum(len(v) for v in self._entries.pop(key).values())
+        self._entries[key] = variants
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= sum(len(v) for v in evicted.values())
+        return variants
+
+
+# GZipContentEncoding adds the Vary header and leaves the body alone as the
+# Content-Encoding is already set
+def write_precompressed(handler: RequestHandler, variants: Dict[str, bytes]) -> None:
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepts(handler, encoding):
+            handler.set_header('Content-Encoding', encoding)
+            handler.write(variants[encoding])
+            return
+    handler.write(variants['identity'])
@@ -0,0 +1,307 @@
+import logging
+from asyncio import gather
+from datetime import datetime, timedelta
+from json import dumps
+from secrets import token_urlsafe
+from time import monotonic, time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, cast
+
+import tornado.ioloop
+import tornado.locks
+import tornado.web
+from tornado.web import HTTPError
+
+from basehandler import BaseAPIHandler, bump_data_version
+from dataio import run_blocking
+from lichessapi import LichessAPI, LichessError
+from operations import Progress, no_progress
+from sessions import get_token
+from storage import Document, Storage, at_least, at_most, one_of
+
+# Job statuses, queued jobs are the only ones the queue looks at
+QUEUED = 'queued'
+CREATED = 'created'
+FAILED = 'failed'
+
+
+def get_day(timestamp: float) -> str:
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def next_day(timestamp: float) -> float:
+    day = datetime.utcfromtimestamp(timestamp).date() + timedelta(days=1)
+    return (datetime(day.year, day.month, day.day) - datetime(1970, 1, 1)).total_seconds()
+
+
+# Lichess counts public and private (password protected) tournaments
+# separately
+def get_kind(parameters: Dict[str, Any]) -> str:
+    return 'private' if parameters.get('password') else 'public'
+
+
+# Adds creation jobs for tournaments of a user, each with the Lichess
+# parameters of one tournament. Any server process can enqueue, the queue
+# itself only runs in one of them and creates them with the token saved at
+# the last login of the user.
+def enqueue(db: Storage, user: str,
+            tournaments: Iterable[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    now = time()
+    jobs = [{
+        'id': token_urlsafe(12),
+        'user': user,
+        'template': template,
+        'parameters': parameters,
+        'startTimestamp': parameters['startTimestamp'],
+        'status': QUEUED,
+        'queued': now,
+        'not_before': now,
+        'attempts': 0,
+    } for template, parameters in tournaments]
+    db.table('creation_jobs').insert_multiple(jobs)
+    return jobs
+
+
+# Jobs as shown to their user
+def job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    status = {key: job[key] for key in ('id', 'template', 'startTimestamp', 'status', 'queued', 'attempts')}
+    status['name'] = job['parameters'].get('name')
+    if job['status'] == QUEUED:
+        status['notBefore'] = job['not_before']
+    for key in ('finished', 'error', 'tournament'):
+        if key in job:
+            status[key] = job[key]
+    return status
+
+
+# What wait_for has seen of a job that was removed while it waited
+CANCELLED_STATE = ('cancelled', 0.0)
+
+
+# Jobs put off to a later time by the quota or a failed attempt
+def is_deferred(job: Dict[str, Any]) -> bool:
+    return bool(job['status'] == QUEUED and job['not_before'] > job['queued'])
+
+
+class CreationQueue():
+    # Failed requests are retried after RETRY_DELAY * attempts seconds
+    RETRY_DELAY = 60
+    MAX_ATTEMPTS = 5
+    FINISHED_TTL = 30 * 86400
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, db: Storage, lichess: LichessAPI, public_limit: int = 12, private_limit: int = 24,
+                 interval: float = 2, batch: int = 50) -> None:
+        self.db = db
+        self.lichess = lichess
+        self.limits = {'public': public_limit, 'private': private_limit}
+        self.interval = interval
+        self.batch = batch
+        self.running = False
+        self.started = False
+        self._again = False
+        self.created = 0
+        self.failed = 0
+        self.postponed = 0
+        self._callback: Optional[tornado.ioloop.PeriodicCallback] = None
+        self._changed = tornado.locks.Condition()
+
+    def start(self) -> None:
+        self._callback = tornado.ioloop.PeriodicCallback(self.run_once, self.interval * 1000)
+        self._callback.start()
+        self.started = True
+        tornado.ioloop.IOLoop.current().add_callback(self.run_once)
+
+    def stop(self) -> None:
+        if self._callback is not None:
+            self._callback.stop()
+        self.started = False
+
+    # Runs the queue right away when it runs in this process, otherwise the
+    # jobs are picked up by the next periodic run
+    def wake(self) -> None:
+        if self.started:
+            tornado.ioloop.IOLoop.current().add_callback(self.run_once)
+
+    # Waits until the jobs are finished or deferred, or the timeout passes,
+    # and returns them. Jobs are read from the database as they may be run by
+    # another server process, which is polled for every POLL_INTERVAL seconds.
+    # Progress gets every job as soon as it is finished or deferred. Jobs
+    # cancelled meanwhile are missing from the result.
+    async def wait_for(self, ids: List[str], timeout: float,
+                       progress: Progress = no_progress) -> List[Dict[str, Any]]:
+        deadline = monotonic() + timeout
+        seen: Dict[str, Tuple[str, float]] = {}
+        while True:
+            jobs = await run_blocking(self.db.table('creation_jobs').search, id=one_of(ids)) if ids else []
+            for job in jobs:
+                state = (job['status'], job['not_before'])
+                if (job['status'] != QUEUED or is_deferred(job)) and seen.get(job['id']) != state:
+                    seen[job['id']] = state
+                    progress('deferred' if job['status'] == QUEUED else job['status'], **job_status(job))
+            found = set(job['id'] for job in jobs)
+            for id in ids:
+                if id not in found and seen.get(id) != CANCELLED_STATE:
+                    seen[id] = CANCELLED_STATE
+                    progress('cancelled', id=id)
+            if monotonic() >= deadline or all(job['status'] != QUEUED or is_deferred(job) for job in jobs):
+                return sorted(jobs, key=lambda job: ids.index(job['id']))
+            await self._changed.wait(timedelta(seconds=min(self.POLL_INTERVAL, max(0, deadline - monotonic()))))
+
+    def get_quota(self, user: str, now: float) -> Dict[str, Any]:
+        quota = self.db.table('creation_quota').get(user=user, day=get_day(now))
+        return {kind: int(quota.get(kind, 0)) if quota else 0 for kind in self.limits}
+
+    def _save_quota(self, user: str, now: float, used: Dict[str, int]) -> None:
+        day = get_day(now)
+        self.db.table('creation_quota').upsert({'user': user, 'day': day, **used}, user=user, day=day)
+
+    # Jobs queued while a run is going on are picked up by another round
+    # right after it instead of waiting for the next periodic run
+    async def run_once(self) -> None:
+        if self.running:
+            self._again = True
+            return
+        self.running = True
+        try:
+            self._again = True
+            while self._again:
+                self._again = False
+                jobs = await run_blocking(
+                    self.db.table('creation_jobs').search, status=QUEUED, not_before=at_most(time()))
+                jobs.sort(key=lambda job: (job['startTimestamp'], job['queued']))
+                by_user: Dict[str, List[Dict[str, Any]]] = {}
+                for job in jobs[:self.batch]:
+                    by_user.setdefault(job['user'], []).append(job)
+                await gather(*[self.run_user(user, user_jobs) for user, user_jobs in by_user.items()])
+                self._changed.notify_all()
+        finally:
+            self.running = False
+            self._changed.notify_all()
+
+    # The quota of a user is reserved for their jobs before the Lichess
+    # requests are sent together, reservations of failed requests are given
+    # back afterwards
+    async def run_user(self, user: str, jobs: List[Dict[str, Any]]) -> None:
+        now = time()
+        used = await run_blocking(self.get_quota, user, now)
+        # Jobs queued before tokens had a table of their own carry one
+        token = await run_blocking(get_token, self.db, user)
+        updates: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        running = []
+        for job in jobs:
+            kind = get_kind(job['parameters'])
+            if not (token or job.get('token')):
+                updates.append(self._finish(job, FAILED, error="Log in again to create tournaments"))
+            elif job['startTimestamp'] <= now:
+                updates.append(self._finish(job, FAILED, error=f"Cannot create tournament "
+                                            f"{job['parameters'].get('name')} as it would start in the past"))
+            elif used[kind] >= self.limits[kind]:
+                updates.append(self._postpone(job, now))
+            else:
+                used[kind] += 1
+                running.append(job)
+        if running:
+            await run_blocking(self._save_quota, user, now, used)
+        results = await gather(*[
+            self.lichess.create_tournament(token or job['token'], job['parameters']['type'], dict(job['parameters']))
+            for job in running], return_exceptions=True)
+        created = []
+        for job, result in zip(running, results):
+            kind = get_kind(job['parameters'])
+            if isinstance(result, dict):
+                created.append(dict(
+                    result,
+                    user=user,
+                    tournament_set='default',
+                    template=job['template'],
+                    password=job['parameters'].get('password'),
+                    created=datetime.utcnow().timestamp(),
+                    startTimestamp=job['startTimestamp']))
+                updates.append(self._finish(job, CREATED, tournament=result))
+                continue
+            if isinstance(result, LichessError) and result.code == 429:
+                # Lichess counts tournaments made elsewhere as well
+                used[kind] = self.limits[kind]
+                updates.append(self._postpone(job, now))
+                continue
+            used[kind] -= 1
+            if isinstance(result, LichessError) and result.code < 500 and result.code != 599:
+                updates.append(self._finish(job, FAILED, error=result.message))
+            elif isinstance(result, LichessError):
+                updates.append(self._retry(job, result.message))
+            else:
+                logging.error(f"Cannot create tournament for {user}", exc_info=result)
+                updates.append(self._retry(job, str(result) or type(result).__name__))
+        await run_blocking(self._save, user, now, used if running else None, created, updates)
+
+    def _save(self, user: str, now: float, used: Optional[Dict[str, int]], created: List[Dict[str, Any]],
+              updates: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> None:
+        if used is not None:
+            self._save_quota(user, now, used)
+        self.db.table('tournaments').insert_multiple(created)
+        self.db.table('creation_jobs').update_multiple(updates)
+        if any(fields.get('status') in (CREATED, FAILED) for fields, _ in updates):
+            bump_data_version(self.db, user)
+
+    def _postpone(self, job: Dict[str, Any], now: float) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        self.postponed += 1
+        return {'not_before': next_day(now)}, {'id': job['id']}
+
+    def _retry(self, job: Dict[str, Any], error: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        attempts = job['attempts'] + 1
+        if attempts >= self.MAX_ATTEMPTS:
+            return self._finish(job, FAILED, error=error)
+        return {'attempts': attempts, 'not_before': time() + self.RETRY_DELAY * attempts, 'error': error}, \
+            {'id': job['id']}
+
+    # The job update of a finished job
+    def _finish(self, job: Dict[str, Any], status: str, **fields: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        if status == CREATED:
+            self.created += 1
+        else:
+            self.failed += 1
+        return {'status': status, 'finished': time(), **fields}, {'id': job['id']}
+
+    def prune(self) -> int:
+        table = self.db.table('creation_jobs')
+        cutoff = time() - self.FINISHED_TTL
+        return table.remove(status=CREATED, finished=at_most(cutoff)) + \
+            table.remove(status=FAILED, finished=at_most(cutoff))
+
+
+class CreationJobsHandler(BaseAPIHandler):
+    # Queued jobs and the ones finished in the last week
+    RECENT = 7 * 86400
+
+    @property
+    def queue(self) -> CreationQueue:
+        return cast(CreationQueue, self.settings['creation_queue'])
+
+    def get_jobs(self, user: str, now: float) -> List[Document]:
+        table = self.db.table('creation_jobs')
+        jobs = table.search(user=user, status=QUEUED) + table.search(user=user, finished=at_least(now - self.RECENT))
+        jobs.sort(key=lambda job: (job['startTimestamp'], job['queued']))
+        return jobs
+
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self, id: str) -> None:
+        now = time()
+        jobs, used = await gather(
+            run_blocking(self.get_jobs, self.current_user['id'], now),
+            run_blocking(self.queue.get_quota, self.current_user['id'], now))
+        self.write(dumps({
+            'success': True,
+            'jobs': [job_status(job) for job in jobs],
+            'quota': {
+                'used': used,
+                'limits': self.queue.limits,
+                'resets': next_day(now),
+            },
+        }))
+
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def delete(self, id: str) -> None:
+        if not id:
+            raise HTTPError(400, "Missing job id")
+        removed = await self.async_db.table('creation_jobs').remove(user=self.current_user['id'], id=id, status=QUEUED)
+        self.write(dumps({'success': bool(removed)}))
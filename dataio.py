@@ -0,0 +1,138 @@
+import logging
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+import tornado.ioloop
+import tornado.locks
+
+from storage import Document, Storage, Table
+
+T = TypeVar('T')
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor(threads: Optional[int] = None) -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(threads or 4, thread_name_prefix='io')
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+# Runs blocking file or database work in the I/O threads so the event loop
+# keeps serving other requests meanwhile
+async def run_blocking(function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    return await tornado.ioloop.IOLoop.current().run_in_executor(
+        get_executor(), partial(function, *args, **kwargs))
+
+
+# The Table interface as coroutines. Reads run in parallel, writes to a table
+# wait for the earlier ones of this process so they are applied in the order
+# they were made.
+class AsyncTable():
+    def __init__(self, table: Table) -> None:
+        self.table = table
+        self._writes = tornado.locks.Lock()
+
+    async def search(self, **where: Any) -> List[Document]:
+        return await run_blocking(self.table.search, **where)
+
+    async def get(self, **where: Any) -> Optional[Document]:
+        return await run_blocking(self.table.get, **where)
+
+    async def contains(self, **where: Any) -> bool:
+        return await run_blocking(self.table.contains, **where)
+
+    async def search_page(self, order_by: str, limit: int, after: Optional[Tuple[Any, int]] = None,
+                          descending: bool = False, **where: Any) -> List[Document]:
+        return await run_blocking(self.table.search_page, order_by, limit, after, descending, **where)
+
+    async def _write(self, function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        async with self._writes:
+            return await run_blocking(function, *args, **kwargs)
+
+    async def insert(self, document: Dict[str, Any]) -> int:
+        return await self._write(self.table.insert, document)
+
+    async def insert_multiple(self, documents: Iterable[Dict[str, Any]]) -> List[int]:
+        return await self._write(self.table.insert_multiple, list(documents))
+
+    async def update(self, fields: Dict[str, Any], **where: Any) -> int:
+        return await self._write(self.table.update, fields, **where)
+
+    async def update_multiple(self, updates: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]) -> int:
+        return await self._write(self.table.update_multiple, list(updates))
+
+    async def upsert(self, document: Dict[str, Any], **where: Any) -> None:
+        await self._write(self.table.upsert, document, **where)
+
+    async def remove(self, **where: Any) -> int:
+        return await self._write(self.table.remove, **where)
+
+
+class AsyncStorage():
+    def __init__(self, storage: Storage) -> None:
+        self.storage = storage
+        self._tables: Dict[str, AsyncTable] = {}
+
+    def table(self, name: str) -> AsyncTable:
+        if name not in self._tables:
+            self._tables[name] = AsyncTable(self.storage.table(name))
+        return self._tables[name]
+
+
+class StallDetector():
+    # The event loop marks itself alive every threshold / 4 seconds and a
+    # watchdog thread logs where the loop is stuck once the mark is older
+    # than threshold, once per stall
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self.started = False
+        self.stalls = 0
+        self._beat = monotonic()
+        self._loop_thread = threading.get_ident()
+        self._callback: Optional[tornado.ioloop.PeriodicCallback] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._beat = monotonic()
+        self._callback = tornado.ioloop.PeriodicCallback(self._heartbeat, self.threshold * 1000 / 4)
+        self._callback.start()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name='stall-detector', daemon=True).start()
+        self.started = True
+
+    def stop(self) -> None:
+        if self._callback is not None:
+            self._callback.stop()
+        self._stop.set()
+        self.started = False
+
+    def _heartbeat(self) -> None:
+        self._beat = monotonic()
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            blocked = monotonic() - beat
+            if blocked <= self.threshold or beat == reported:
+                continue
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            logging.warning(f"Event loop blocked for {blocked * 1000:.0f} ms in:\n{stack}")
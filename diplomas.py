@@ -1,42 +1,153 @@
+import asyncio
 from json import loads, dumps, load, dump
-from os.path import join as path_join
+from os.path import dirname, join as path_join, realpath
 from os import makedirs
 from copy import deepcopy
 from secrets import token_urlsafe
 from shutil import copyfile
+from typing import Any, Dict, List, Optional, cast
+from urllib.parse import quote, urlsplit
+from zipfile import ZipFile, ZIP_STORED
 
-from tinydb import Query
-
+from tornado.ioloop import IOLoop
 from tornado.options import options
 from tornado.web import HTTPError
 import tornado.web
 
 from basehandler import BaseAPIHandler
+from blobs import externalize_images
+from compression import PrecompressedCache, write_precompressed
+from dataio import run_blocking
+from lichessapi import LichessAPI
+from metrics import RENDER_CACHE
+from rendering import (cached_render, get_layers, get_pool, render_diploma, render_dir, render_key, render_pdf,
+                       template_hash)
+from storage import Storage
+
+
+RELEVANT_VARIANTS = ('blitz', 'rapid', 'classical')
+
+
+# Fields files are named by the server, a name resolving to anything but a
+# file in the diplomas directory is refused before it is read or written
+def get_fields_path(fields_file: str) -> str:
+    directory = realpath(path_join(options.db_dir, 'diplomas'))
+    fields_path = realpath(path_join(directory, fields_file))
+    if dirname(fields_path) != directory:
+        raise HTTPError(400, "Invalid fields file")
+    return fields_path
+
+
+# Fields files are large, the functions reading and writing them are run in
+# the I/O threads
+def load_fields(template: Dict[str, Any]) -> Dict[str, Any]:
+    if not (fields_file := template.get('fields_file')):
+        return {}
+    fields_path = get_fields_path(fields_file)
+    with open(fields_path) as f:
+        fields = cast(Dict[str, Any], load(f))
+    # Templates saved before images were moved to the blob store
+    if externalize_images(fields):
+        with open(fields_path, 'w') as f:
+            dump(fields, f)
+    return fields
+
+
+def save_fields(fields_file: str, fields: Dict[str, Any]) -> None:
+    makedirs(path_join(options.db_dir, 'diplomas'), mode=0o700, exist_ok=True)
+    externalize_images(fields)
+    with open(get_fields_path(fields_file), 'w') as f:
+        dump(fields, f)
+
+
+def copy_fields(source: str, target: str) -> None:
+    makedirs(path_join(options.db_dir, 'diplomas'), mode=0o700, exist_ok=True)
+    copyfile(get_fields_path(source), get_fields_path(target))
+
+
+# Tournament by its lichess URL with standings of the top players and their
+# profiles as used for substitutions in diploma texts
+async def get_tournament_results(
+        lichess: LichessAPI, token: str, tournament_url: str, need_standings: bool) -> Dict[str, Any]:
+    scheme, netloc, path, query, fragment = urlsplit(tournament_url)
+    paths = path.split('/')
+    if netloc != 'lichess.org' or len(paths) < 2:
+        raise HTTPError(400, "Invalid tournament URL")
+    else:
+        id = paths[-1]
+        if paths[-2] == 'tournament':
+            type = 'arena'
+        elif paths[-2] == 'swiss':
+            type = 'swiss'
+        else:
+            raise HTTPError(400, "Invalid tournament type")
+    tournament = await lichess.get_tournament(token, type, id)
+    if need_standings:
+        if type == 'swiss':
+            standings = await lichess.get_swiss_standings(token, id, 10)
+            for p in standings:
+                p['name'] = p['username']
+                del p['username']
+            tournament['standing'] = {'players': standings}
+            tournament['fullName'] = tournament['name']
+        players = tournament['standing']['players']
+        profiles = await lichess.get_users(token, [player['name'] for player in players])
+        for player in players:
+            profile = profiles.get(player['name'].lower(), {})
+            player['profile'] = profile.get('profile', {})
+            if 'perfs' not in profile:
+                player['ratings'] = dict()
+            else:
+                player['ratings'] = dict((variant, perf['rating']) for (variant, perf) in profile['perfs'].items()
+                                         if 'rating' in perf)
+            player['ratings']['max'] = max(player['ratings'].get(variant, 0) for variant in RELEVANT_VARIANTS)
+    tournament['type'] = type
+    return tournament
 
 
 class DiplomaTemplateHandler(BaseAPIHandler):
+    versioned = True
+    # Fields a patch may change, the rest is saved by post
+    PATCH_FIELDS = ('index', 'name')
+    _fields_cache: Optional[PrecompressedCache] = None
+
+    @property
+    def fields_cache(self) -> PrecompressedCache:
+        if DiplomaTemplateHandler._fields_cache is None:
+            DiplomaTemplateHandler._fields_cache = PrecompressedCache(self.options.precompressed_cache_bytes)
+        return DiplomaTemplateHandler._fields_cache
 
     @tornado.web.authenticated  # type: ignore[misc]
-    def get(self, id: str) -> None:
-        T = Query()
-        table = self.db.table('diploma_templates')
+    async def get(self, id: str) -> None:
+        if id and self._etag and (variants := self.fields_cache.get(self._etag)):
+            write_precompressed(self, variants)
+            return
         if id:
-            template = table.get((T.user == self.current_user['id']) & (T.id == id))
+            template = await self.async_db.table('diploma_templates').get(user=self.current_user['id'], id=id)
             if not template:
                 raise HTTPError(404, f"No template with id \"{id}\" for user: \"{self.current_user['id']}\"")
             del template['user']
             del template['id']
-            if fields_file := template.get('fields_file'):
-                template['fields'] = load(open(path_join(options.db_dir, 'diplomas', fields_file)))
+            if 'fields_file' in template:
+                template['fields'] = await run_blocking(load_fields, template)
             template.update({'success': True})
-            self.write(dumps(template))
+            body = dumps(template).encode()
+            if self._etag and (variants := await self.fields_cache.put(self._etag, body)):
+                write_precompressed(self, variants)
+            else:
+                self.write(body)
         else:
-            templates = table.search((T.user == self.current_user['id']))
-            templates.sort(key=lambda template: template.get('index', 0))
+            templates = await run_blocking(self.list_templates, self.db, self.current_user['id'])
             self.write(dumps({'success': True, 'templates': templates}))
 
+    @staticmethod
+    def list_templates(db: Storage, user: str) -> List[Dict[str, Any]]:
+        templates = db.table('diploma_templates').search(user=user)
+        templates.sort(key=lambda template: template.get('index', 0))
+        return list(templates)
+
     @tornado.web.authenticated  # type: ignore[misc]
-    def post(self, id: str) -> None:
+    async def post(self, id: str) -> None:
         value = {}
         try:
             value = loads(self.request.body.decode())
@@ -44,58 +155,144 @@ class DiplomaTemplateHandler(BaseAPIHandler):
             raise HTTPError(400, "Invalid JSON")
         value['id'] = id
         value['user'] = self.current_user['id']
+        # The stored fields file is kept unless new fields are sent
+        value.pop('fields_file', None)
         if 'fields' in value:
             fields_file = f'{value["user"]}-{value["id"]}'
-            makedirs(path_join(options.db_dir, 'diplomas'), mode=0o700, exist_ok=True)
-            dump(value['fields'], open(path_join(options.db_dir, 'diplomas', fields_file), 'w'))
+            await run_blocking(save_fields, fields_file, value['fields'])
             del value['fields']
             value['fields_file'] = fields_file
-        table = self.db.table('diploma_templates')
-        T = Query()
-        table.upsert(value, (T.user == self.current_user['id']) & (T.id == id))
+        await self.async_db.table('diploma_templates').upsert(value, user=self.current_user['id'], id=id)
         self.write(dumps({'success': True}))
 
     @tornado.web.authenticated  # type: ignore[misc]
-    def delete(self, id: str) -> None:
-        T = Query()
-        table = self.db.table('diploma_templates')
-        u = table.remove((T.user == self.current_user['id']) & (T.id == id))
+    async def delete(self, id: str) -> None:
+        u = await self.async_db.table('diploma_templates').remove(user=self.current_user['id'], id=id)
         self.write(dumps({'success': bool(u)}))
 
+    # Without an id the body is {"templates": [{"id": ..., "index": ...}]}
+    # and changes several templates at once
     @tornado.web.authenticated  # type: ignore[misc]
-    def patch(self, id: str) -> None:
+    async def patch(self, id: str) -> None:
         value = {}
         try:
             value = loads(self.request.body.decode())
         except ValueError:
             raise HTTPError(400, "Invalid JSON")
-        table = self.db.table('diploma_templates')
-        T = Query()
-        template = table.get((T.user == self.current_user['id']) & (T.id == id))
+        if not id:
+            await self.patch_multiple(value)
+            return
+        table = self.async_db.table('diploma_templates')
+        template = await table.get(user=self.current_user['id'], id=id)
         if not template:
             raise HTTPError(404, f"No template with id \"{id}\" for user: \"{self.current_user['id']}\"")
         template['index'] = value.get('index', template.get('index', 0))
         template['name'] = value.get('name', template.get('name', 0))
-        table.upsert(template, (T.user == self.current_user['id']) & (T.id == id))
+        await table.upsert(template, user=self.current_user['id'], id=id)
         self.write(dumps({'success': True}))
 
+    @classmethod
+    def filter_allowed_fields(cls, template: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in template.items() if k in cls.PATCH_FIELDS}
+
+    # Every change is checked before any is applied and all of them are
+    # saved in one write
+    async def patch_multiple(self, request: Dict[str, Any]) -> None:
+        changes = request.get('templates') if isinstance(request, dict) else None
+        if not isinstance(changes, list) or not all(isinstance(c, dict) and c.get('id') for c in changes):
+            raise HTTPError(400, "Expected a list of templates with ids")
+        table = self.async_db.table('diploma_templates')
+        stored = set(t['id'] for t in await table.search(user=self.current_user['id']))
+        updates = []
+        for change in changes:
+            if change['id'] not in stored:
+                raise HTTPError(404, f"No template with id \"{change['id']}\" for user: \"{self.current_user['id']}\"")
+            updates.append((self.filter_allowed_fields(change), {'user': self.current_user['id'], 'id': change['id']}))
+        self.write(dumps({'success': True, 'updated': await table.update_multiple(u for u in updates if u[0])}))
+
 
 class DiplomaDuplicateHandler(BaseAPIHandler):
     @tornado.web.authenticated  # type: ignore[misc]
-    def post(self, id: str) -> None:
-        T = Query()
-        table = self.db.table('diploma_templates')
-        template = table.get((T.user == self.current_user['id']) & (T.id == id))
+    async def post(self, id: str) -> None:
+        table = self.async_db.table('diploma_templates')
+        template = await table.get(user=self.current_user['id'], id=id)
         if not template:
             raise HTTPError(404, f"No template with id \"{id}\" for user: \"{self.current_user['id']}\"")
         value = deepcopy(dict(template))
         value['id'] = token_urlsafe(16)
         value['user'] = self.current_user['id']
         fields_file = f'{value["user"]}-{value["id"]}'
-        makedirs(path_join(options.db_dir, 'diplomas'), mode=0o700, exist_ok=True)
-        copyfile(
-            path_join(options.db_dir, 'diplomas', value['fields_file']),
-            path_join(options.db_dir, 'diplomas', fields_file))
+        await run_blocking(copy_fields, value['fields_file'], fields_file)
         value['fields_file'] = fields_file
-        table.upsert(value, (T.user == self.current_user['id']) & (T.id == value['id']))
+        await table.upsert(value, user=self.current_user['id'], id=value['id'])
         self.write(dumps({'success': True, 'value': value}))
+
+
+class _ResponseStream():
+    # Minimal file object for ZipFile writing straight into the response
+    def __init__(self, handler: tornado.web.RequestHandler) -> None:
+        self.handler = handler
+
+    def write(self, data: bytes) -> int:
+        self.handler.write(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class DiplomaRenderHandler(BaseAPIHandler):
+    FORMATS = {'zip': 'application/zip', 'pdf': 'application/pdf'}
+    MAX_PLAYERS = 10
+
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self, id: str) -> None:
+        format = self.get_argument('format', 'zip')
+        if format not in self.FORMATS:
+            raise HTTPError(400, f"Unknown format {format}")
+        try:
+            num_players = min(max(int(self.get_argument('players', '3')), 1), self.MAX_PLAYERS)
+        except ValueError:
+            raise HTTPError(400, "Invalid number of players")
+        template = await self.async_db.table('diploma_templates').get(user=self.current_user['id'], id=id)
+        if not template:
+            raise HTTPError(404, f"No template with id \"{id}\" for user: \"{self.current_user['id']}\"")
+        fields = await run_blocking(load_fields, template)
+        tournament = await get_tournament_results(self.lichess, self.token, self.get_argument('tournament'), True)
+        players = tournament['standing']['players'][:num_players]
+        if not players:
+            raise HTTPError(404, "Tournament has no players")
+
+        # Diplomas are rendered in parallel by the process pool and cached
+        # on disk, so downloading the same diplomas again is only a file read
+        template_key = template_hash(fields)
+        loop = IOLoop.current()
+        pool = get_pool(options.render_processes)
+
+        async def render(player: Dict[str, Any]) -> str:
+            layers = get_layers(fields, {'tournament': tournament, 'player': player})
+            key = render_key(template_key, tournament['id'], player['name'], layers)
+            path = cached_render(options.db_dir, key)
+            if path is not None:
+                RENDER_CACHE.inc('hit')
+                return path
+            RENDER_CACHE.inc('miss')
+            path = path_join(render_dir(options.db_dir), f'{key}.png')
+            await loop.run_in_executor(pool, render_diploma, layers, path)
+            return path
+
+        renders = [asyncio.ensure_future(render(player)) for player in players]
+        date = str(tournament.get('startsAt', ''))[:10]
+        name = f"{date}-{tournament.get('fullName', tournament['id'])}".replace('/', '-')
+        self.set_header('Content-Type', self.FORMATS[format])
+        self.set_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(name)}.{format}")
+
+        if format == 'pdf':
+            paths = [await rendered for rendered in renders]
+            self.write(await loop.run_in_executor(pool, render_pdf, paths))
+            return
+        with ZipFile(cast(Any, _ResponseStream(self)), 'w', ZIP_STORED) as archive:
+            for player, rendered in zip(players, renders):
+                path = await rendered
+                archive.write(path, f"{name}-{player['rank']}.png")
+                await self.flush()
@@ -1,9 +1,19 @@
 import json
 import asyncio
+import logging
+from os import makedirs, replace
+from os.path import exists, join as path_join
+from secrets import token_hex
 from aiogoogle import Aiogoogle
 from aiogoogle.auth.creds import ServiceAccountCreds
+from aiogoogle.models import Request
+from aiogoogle.resource import GoogleAPI
+from aiogoogle.sessions.aiohttp_session import AiohttpSession
+from time import monotonic
 
-from typing import Any, Dict, List, Optional, cast
+from metrics import GOOGLE_REQUESTS
+
+from typing import Any, Dict, List, Optional, Tuple, cast
 
 service_account_key = json.load(open('google_key.json'))
 
@@ -11,86 +21,204 @@ creds = ServiceAccountCreds(scopes=['https://www.googleapis.com/auth/drive'],
                             **service_account_key)
 
 
-async def create_public(title: str, email: str) -> Dict[str, Any]:
-    async with Aiogoogle(service_account_creds=creds) as aiogoogle:
+class GoogleClient():
+    # One HTTP session, one service account token and one copy of each
+    # discovery document for the whole process. Discovery documents are also
+    # kept on disk so a restart does not download them again.
+    def __init__(self, creds: ServiceAccountCreds, discovery_cache_dir: Optional[str] = None) -> None:
+        self.aiogoogle = Aiogoogle(service_account_creds=creds)
+        self.discovery_cache_dir = discovery_cache_dir
+        self.round_trips = 0
+        self._session: Optional[AiohttpSession] = None
+        self._apis: Dict[Tuple[str, str], GoogleAPI] = {}
+        self._discovery_lock = asyncio.Lock()
+
+    @property
+    def session(self) -> AiohttpSession:
+        if self._session is None:
+            self._session = AiohttpSession()
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _discovery_cache_path(self, name: str, version: str) -> Optional[str]:
+        if not self.discovery_cache_dir:
+            return None
+        return path_join(self.discovery_cache_dir, f'{name}-{version}.json')
+
+    async def discover(self, name: str, version: str) -> GoogleAPI:
+        async with self._discovery_lock:
+            if (name, version) not in self._apis:
+                path = self._discovery_cache_path(name, version)
+                if path and exists(path):
+                    with open(path) as f:
+                        document = json.load(f)
+                else:
+                    self.round_trips += 1
+                    start = monotonic()
+                    document = await self.session.send(
+                        self.aiogoogle.discovery_service.apis.getRest(api=name, version=version, validate=False))
+                    GOOGLE_REQUESTS.observe(monotonic() - start, 'discovery', '200')
+                    if path:
+                        makedirs(cast(str, self.discovery_cache_dir), mode=0o700, exist_ok=True)
+                        # Other server processes may read it meanwhile
+                        tmp = f'{path}.{token_hex(8)}.tmp'
+                        with open(tmp, 'w') as f:
+                            json.dump(document, f)
+                        replace(tmp, path)
+                    logging.info(f"Discovered Google API {name} {version}")
+                self._apis[(name, version)] = GoogleAPI(document)
+            return self._apis[(name, version)]
+
+    async def send(self, operation: str, request: Request, raise_for_status: bool = True) -> Any:
+        manager = self.aiogoogle.service_account_manager
+        start = monotonic()
+        if await manager.refresh():
+            self.round_trips += 1
+            GOOGLE_REQUESTS.observe(monotonic() - start, 'token', '200')
+            start = monotonic()
+        self.round_trips += 1
+        try:
+            res = await self.session.send(
+                manager.authorize(request),
+                full_res=True,
+                raise_for_status=False,
+                auth_manager=manager)
+        except Exception:
+            GOOGLE_REQUESTS.observe(monotonic() - start, operation, 'error')
+            raise
+        GOOGLE_REQUESTS.observe(monotonic() - start, operation, str(res.status_code))
+        if raise_for_status:
+            res.raise_for_status()
+        return res.content
+
+
+client = GoogleClient(creds)
 
-        sheets = await aiogoogle.discover('sheets', 'v4')
-        spreadsheet = {'properties': {'title': title}}
-        spreadsheet = await aiogoogle.as_service_account(
-            sheets.spreadsheets.create(json=spreadsheet))
 
-        drive = await aiogoogle.discover('drive', 'v3')
+async def create_public(title: str, email: str) -> Dict[str, Any]:
+    sheets = await client.discover('sheets', 'v4')
+    spreadsheet = {'properties': {'title': title}}
+    spreadsheet = await client.send(
+        'spreadsheets.create',
+        sheets.spreadsheets.create(json=spreadsheet))
 
-        await aiogoogle.as_service_account(
-            drive.permissions.create(fileId=spreadsheet['spreadsheetId'],
-                                     json={
-                                         'type': 'user',
-                                         'role': 'writer',
-                                         'emailAddress': email
-                                     }))
-        return spreadsheet
+    drive = await client.discover('drive', 'v3')
+
+    await client.send(
+        'permissions.create',
+        drive.permissions.create(fileId=spreadsheet['spreadsheetId'],
+                                 json={
+                                     'type': 'user',
+                                     'role': 'writer',
+                                     'emailAddress': email
+                                 }))
+    return spreadsheet
 
 
 async def get(spreadsheetId: str) -> Optional[Dict[str, Any]]:
-    async with Aiogoogle(service_account_creds=creds) as aiogoogle:
-        sheets = await aiogoogle.discover('sheets', 'v4')
-        res = await aiogoogle.as_service_account(
-            sheets.spreadsheets.get(spreadsheetId=spreadsheetId),
-            raise_for_status=False)
-        return cast(Optional[Dict[str, Any]], res)
+    sheets = await client.discover('sheets', 'v4')
+    res = await client.send(
+        'spreadsheets.get',
+        sheets.spreadsheets.get(spreadsheetId=spreadsheetId),
+        raise_for_status=False)
+    return cast(Optional[Dict[str, Any]], res)
+
+
+# The address Google gives spreadsheets, known without a request
+def spreadsheet_url(spreadsheetId: str) -> str:
+    return f'https://docs.google.com/spreadsheets/d/{spreadsheetId}/edit'
 
 
 async def list_spreadsheets() -> List[Any]:
-    async with Aiogoogle(service_account_creds=creds) as aiogoogle:
-        drive = await aiogoogle.discover('drive', 'v3')
+    drive = await client.discover('drive', 'v3')
 
-        res = await aiogoogle.as_service_account(drive.files.list())
-        files = cast(List[Dict[str, Any]], res['files'])
-        sheets = tuple(
-            filter(
-                lambda file: file['mimeType'] ==
-                'application/vnd.google-apps.spreadsheet', files))
-        return cast(List[Any], sheets)
+    res = await client.send('files.list', drive.files.list())
+    files = cast(List[Dict[str, Any]], res['files'])
+    sheets = tuple(
+        filter(
+            lambda file: file['mimeType'] ==
+            'application/vnd.google-apps.spreadsheet', files))
+    return cast(List[Any], sheets)
 
 
 async def create_sheet(spreadsheetId: str, title: str) -> int:
-    async with Aiogoogle(service_account_creds=creds) as aiogoogle:
-        sheets = await aiogoogle.discover('sheets', 'v4')
-        res = await aiogoogle.as_service_account(
-            sheets.spreadsheets.batchUpdate(spreadsheetId=spreadsheetId,
-                                            json={
-                                                'requests': [{
-                                                    'addSheet': {
-                                                        'properties': {
-                                                            'title': title
-                                                        }
+    sheets = await client.discover('sheets', 'v4')
+    res = await client.send(
+        'spreadsheets.batchUpdate',
+        sheets.spreadsheets.batchUpdate(spreadsheetId=spreadsheetId,
+                                        json={
+                                            'requests': [{
+                                                'addSheet': {
+                                                    'properties': {
+                                                        'title': title
                                                     }
-                                                }]
-                                            }))
-        return cast(int, res['replies'][0]['addSheet']['properties']['sheetId'])
+                                                }
+                                            }]
+                                        }))
+    return cast(int, res['replies'][0]['addSheet']['properties']['sheetId'])
 
 
 async def write_values(spreadsheetId: str, range: str,
                        data: List[List[str]]) -> None:
-    async with Aiogoogle(service_account_creds=creds) as aiogoogle:
-        sheets = await aiogoogle.discover('sheets', 'v4')
-        await aiogoogle.as_service_account(
-            sheets.spreadsheets.values.update(spreadsheetId=spreadsheetId,
-                                              range=range,
-                                              valueInputOption='USER_ENTERED',
-                                              json={
-                                                  'range': range,
-                                                  'majorDimension': 'ROWS',
-                                                  'values': data
-                                              }))
+    sheets = await client.discover('sheets', 'v4')
+    await client.send(
+        'values.update',
+        sheets.spreadsheets.values.update(spreadsheetId=spreadsheetId,
+                                          range=range,
+                                          valueInputOption='USER_ENTERED',
+                                          json={
+                                              'range': range,
+                                              'majorDimension': 'ROWS',
+                                              'values': data
+                                          }))
+    return
+
+
+async def add_sheets(spreadsheetId: str, titles: List[str]) -> List[int]:
+    if not titles:
+        return []
+    sheets = await client.discover('sheets', 'v4')
+    res = await client.send(
+        'spreadsheets.batchUpdate',
+        sheets.spreadsheets.batchUpdate(spreadsheetId=spreadsheetId,
+                                        json={
+                                            'requests': [{
+                                                'addSheet': {
+                                                    'properties': {
+                                                        'title': title
+                                                    }
+                                                }
+                                            } for title in titles]
+                                        }))
+    return [cast(int, reply['addSheet']['properties']['sheetId']) for reply in res['replies']]
+
+
+async def write_ranges(spreadsheetId: str, ranges: Dict[str, List[List[Any]]]) -> None:
+    if not ranges:
         return
+    sheets = await client.discover('sheets', 'v4')
+    await client.send(
+        'values.batchUpdate',
+        sheets.spreadsheets.values.batchUpdate(spreadsheetId=spreadsheetId,
+                                               json={
+                                                   'valueInputOption': 'USER_ENTERED',
+                                                   'data': [{
+                                                       'range': range,
+                                                       'majorDimension': 'ROWS',
+                                                       'values': data
+                                                   } for range, data in ranges.items()]
+                                               }))
 
 
 async def delete(spreadsheetId: str) -> None:
-    async with Aiogoogle(service_account_creds=creds) as aiogoogle:
-        service = await aiogoogle.discover('drive', 'v3')
-        await aiogoogle.as_service_account(
-            service.files.delete(fileId=spreadsheetId))
+    service = await client.discover('drive', 'v3')
+    await client.send(
+        'files.delete',
+        service.files.delete(fileId=spreadsheetId))
 
 
 async def main() -> None:
@@ -99,6 +227,7 @@ async def main() -> None:
     files = await list_spreadsheets()
     for file in files:
         await delete(file['id'])
+    await client.close()
 
 
 if __name__ == '__main__':
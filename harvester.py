@@ -0,0 +1,171 @@
+import logging
+from datetime import datetime
+from json import dumps
+from time import time
+from typing import Any, Dict, List, Optional, Tuple, cast
+
+import tornado.ioloop
+import tornado.web
+
+from aggregates import store_standings
+from basehandler import BaseAPIHandler, bump_data_version
+from dataio import run_blocking
+from lichessapi import LichessAPI, LichessError
+from storage import Storage, between, is_null
+
+
+def estimate_end(tournament: Dict[str, Any]) -> float:
+    start = float(tournament['startTimestamp'])
+    if tournament.get('system') == 'arena':
+        return start + int(tournament.get('minutes', 0)) * 60
+    clock = tournament.get('clock', {})
+    # Rough length of a swiss round: both clocks used up plus the pause
+    round_length = 2 * (clock.get('limit', 0) + 40 * clock.get('increment', 0)) + tournament.get('roundInterval', 60)
+    return start + int(tournament.get('nbRounds', 0)) * round_length
+
+
+class StandingsHarvester():
+    # Tournaments are re-checked later when Lichess has not finished them
+    # yet or returns incomplete standings
+    RETRY_DELAY = 600
+    MAX_ATTEMPTS = 12
+    # Stats exports read the aggregates of last month and this one, the
+    # tournaments of both have to be harvested
+    MIN_WINDOW = 62 * 86400
+
+    def __init__(self, db: Storage, lichess: LichessAPI, interval: float = 60, batch: int = 20,
+                 window: float = MIN_WINDOW) -> None:
+        self.db = db
+        self.lichess = lichess
+        self.interval = interval
+        self.batch = batch
+        self.window = max(window, self.MIN_WINDOW)
+        self.running = False
+        self.started = False
+        self.last_run: Optional[float] = None
+        self.queue_length = 0
+        self.lag = 0.0
+        self.harvested = 0
+        self.errors = 0
+        self._callback: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    def start(self) -> None:
+        self._callback = tornado.ioloop.PeriodicCallback(self.run_once, self.interval * 1000)
+        self._callback.start()
+        self.started = True
+        tornado.ioloop.IOLoop.current().add_callback(self.run_once)
+
+    def stop(self) -> None:
+        if self._callback is not None:
+            self._callback.stop()
+        self.started = False
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'lastRun': datetime.utcfromtimestamp(self.last_run).isoformat() if self.last_run else None,
+            'queueLength': self.queue_length,
+            'lag': self.lag,
+            'harvested': self.harvested,
+            'errors': self.errors,
+        }
+
+    # Tournaments that started in the last window seconds, looked up by the
+    # (standings_final, startTimestamp) index, and have ended by now
+    def pending(self, user: Optional[str] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        now = time()
+        where: Dict[str, Any] = {'user': user} if user else {}
+        candidates = self.db.table('tournaments').search(
+            standings_final=is_null(), startTimestamp=between(int(now - self.window), int(now)), **where)
+        pending = [(estimate_end(t), t) for t in candidates]
+        return sorted(
+            ((end, t) for end, t in pending if end <= now and t.get('harvest_after', 0) <= now),
+            key=lambda p: p[0])
+
+    async def fetch(self, tournament: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Standings of a finished tournament or None if it has to be retried
+        system = tournament.get('system', 'swiss')
+        try:
+            info = await self.lichess.get_tournament('', system, tournament['id'])
+            if system == 'arena':
+                if not info.get('isFinished'):
+                    return None
+                standings = cast(Dict[str, Any], info['standing'])
+            else:
+                if info.get('status') != 'finished':
+                    return None
+                standings = {'players': await self.lichess.get_swiss_standings('', tournament['id'], 10)}
+        except LichessError as e:
+            if e.code != 404:
+                raise
+            logging.warning(f"Tournament was deleted {tournament['id']}")
+            return {'players': []}
+        # Sometimes lichess returns a single player instead of full standings
+        if len(standings.get('players', [])) < min(3, int(info.get('nbPlayers', 0))):
+            return None
+        return standings
+
+    async def run_once(self) -> None:
+        if self.running:
+            return
+        self.running = True
+        try:
+            pending = await run_blocking(self.pending)
+            now = time()
+            self.last_run = now
+            self.queue_length = len(pending)
+            self.lag = now - pending[0][0] if pending else 0.0
+            harvested = []
+            retries = []
+            for _, tournament in pending[:self.batch]:
+                try:
+                    standings = await self.fetch(tournament)
+                except Exception:
+                    logging.exception(f"Cannot harvest standings for {tournament['id']}")
+                    self.errors += 1
+                    standings = None
+                attempts = tournament.get('harvest_attempts', 0) + 1
+                if standings is None and attempts < self.MAX_ATTEMPTS:
+                    retries.append(({
+                        'harvest_attempts': attempts,
+                        'harvest_after': time() + self.RETRY_DELAY * attempts
+                    }, {'id': tournament['id']}))
+                    continue
+                tournament['standings'] = standings or tournament.get('standings') or {'players': []}
+                harvested.append(tournament)
+            await run_blocking(self._save, harvested, retries)
+            self.harvested += len(harvested)
+            self.queue_length -= len(harvested)
+            if harvested:
+                logging.info(f"Harvested standings of {len(harvested)} tournaments, {self.queue_length} pending")
+        finally:
+            self.running = False
+            await run_blocking(self.save_status)
+
+    def _save(self, harvested: List[Dict[str, Any]], retries: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> None:
+        store_standings(self.db, harvested, standings_final=True)
+        bump_data_version(self.db, *(tournament['user'] for tournament in harvested))
+        self.db.table('tournaments').update_multiple(retries)
+
+    # Only one server process runs the harvester, the others report the
+    # status it saved last
+    def save_status(self) -> None:
+        self.db.table('harvester').upsert({'id': 'status', **self.status()}, id='status')
+
+    def load_status(self) -> Dict[str, Any]:
+        if self.started:
+            return self.status()
+        status = self.db.table('harvester').get(id='status')
+        if status is None:
+            return self.status()
+        del status['id']
+        return status
+
+
+class HarvesterStatusHandler(BaseAPIHandler):
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self) -> None:
+        harvester = cast(StandingsHarvester, self.settings['harvester'])
+        status = await run_blocking(harvester.load_status)
+        status['userQueueLength'] = len(await run_blocking(harvester.pending, self.current_user['id']))
+        self.write(dumps({'success': True, 'harvester': status}))
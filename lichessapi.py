@@ -1,15 +1,20 @@
 import logging
 
-from asyncio import gather
-from urllib.parse import urlencode
+from asyncio import Queue, Future, ensure_future, gather
+from time import monotonic
+from urllib.parse import urlencode, urlsplit
 from secrets import token_urlsafe
 from hashlib import sha256
 from base64 import urlsafe_b64encode
 from json import loads
 
-from typing import cast, Any, Dict, List, Optional, Tuple, Union
+from typing import cast, Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 
-from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPResponse
+
+from cache import ResponseCache
+from metrics import LICHESS_REQUESTS
+from ratelimit import RequestScheduler
 
 
 class LichessError(RuntimeError):
@@ -17,15 +22,54 @@ class LichessError(RuntimeError):
         super().__init__(*args)
         self.code = code
         self.message = message
+        self.url = url
 
     def __str__(self) -> str:
         return f'Lichess API error {self.code}: {self.message} at {self.url}'
 
 
+class NDJSONStream():
+    # Collects records from a line-delimited response as chunks arrive.
+    # Bodies of non-200 responses are kept whole for the error message.
+    def __init__(self) -> None:
+        self.records: 'Queue[Optional[Dict[str, Any]]]' = Queue()
+        self.received = 0
+        self.closed = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.code = 0
+        self.buffer = b''
+
+    def on_header(self, line: str) -> None:
+        if line.startswith('HTTP/'):
+            self.reset()
+            self.code = int(line.split(' ', 2)[1])
+
+    def on_data(self, chunk: bytes) -> None:
+        if self.closed:
+            return
+        self.buffer += chunk
+        if self.code != 200:
+            return
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                self.records.put_nowait(loads(line))
+                self.received += 1
+
+    def finish(self) -> None:
+        if self.code == 200 and self.buffer.strip():
+            self.records.put_nowait(loads(self.buffer))
+            self.buffer = b''
+        self.records.put_nowait(None)
+
+
 class LichessAPI():
     _OAUTH_AUTHORIZE_URL = 'https://lichess.org/oauth'
     _OAUTH_ACCESS_TOKEN_URL = 'https://lichess.org/api/token'
     _USER_URL = 'https://lichess.org/api/user'
+    _USERS_URL = 'https://lichess.org/api/users'
     _ACCOUNT_URL = 'https://lichess.org/api/account'
     _EMAIL_URL = 'https://lichess.org/api/account/email'
     _USER_TEAMS_URL = 'https://lichess.org/api/team/of'
@@ -34,10 +78,29 @@ class LichessAPI():
     SWISS_URL = 'https://lichess.org/api/swiss'
     TEAM_URL = 'https://lichess.org/api/team'
 
-    def __init__(self, client_id: str, redirect_uri: str):
+    # Path segments kept in the endpoint label of metrics, anything else is
+    # an id or a user name
+    _ENDPOINT_SEGMENTS = frozenset((
+        '', 'api', 'token', 'user', 'users', 'account', 'email', 'team', 'of', 'tournament', 'swiss', 'new',
+        'results'))
+
+    # Maximum number of ids accepted by a single POST /api/users
+    USERS_CHUNK = 300
+
+    # Cache lifetimes in seconds
+    FINISHED_TOURNAMENT_TTL = 24 * 3600
+    LIVE_TOURNAMENT_TTL = 30
+    USER_TTL = 3600
+    TEAMS_TTL = 300
+
+    def __init__(self, client_id: str, redirect_uri: str,
+                 cache: Optional[ResponseCache] = None,
+                 scheduler: Optional[RequestScheduler] = None):
         self.client_id = client_id
         self.redirect_uri = redirect_uri
         self.http = AsyncHTTPClient(force_instance=True)
+        self.cache = cache or ResponseCache()
+        self.scheduler = scheduler or RequestScheduler()
 
     def __del__(self) -> None:
         self.http.close()
@@ -49,14 +112,93 @@ class LichessAPI():
                 params_dict[k] = "true" if v else "false"
         return params_dict
 
+    @staticmethod
+    def _raise_error(code: int, body: bytes, url: str) -> None:
+        message = f"Bad Lichess Request: {body.decode() if body else ''}"
+        try:
+            json = loads(body.decode()) if len(body) > 0 else []
+            message = str(json.get('error_description') or json.get('error'))
+        except ValueError:
+            logging.exception("Error decoding lichess response")
+        logging.error(f"Lichess API error: {code}, {body.decode()}")
+        raise LichessError(code, message, url)
+
+    @classmethod
+    def endpoint(cls, url: str) -> str:
+        return '/'.join(s if s in cls._ENDPOINT_SEGMENTS else '{id}' for s in urlsplit(url).path.split('/'))
+
+    async def _fetch(self, url: str, method: str, **kwargs: Any) -> HTTPResponse:
+        start = monotonic()
+        try:
+            res = await self.http.fetch(url, method=method, raise_error=False, **kwargs)
+        except HTTPClientError as e:
+            LICHESS_REQUESTS.observe(monotonic() - start, self.endpoint(url), method, str(e.code))
+            raise
+        except OSError:
+            LICHESS_REQUESTS.observe(monotonic() - start, self.endpoint(url), method, 'error')
+            raise
+        LICHESS_REQUESTS.observe(monotonic() - start, self.endpoint(url), method, str(res.code))
+        return res
+
+    async def _stream_request(
+            self,
+            url: str,
+            token: str,
+            limit: Optional[int] = None,
+            **kwargs: Any) -> AsyncIterator[Dict[str, Any]]:
+        headers: Dict[str, str] = {'Accept': 'application/x-ndjson'}
+        if kwargs:
+            url = f'{url}?{urlencode(self.transform_boolean_parameters(kwargs))}'
+        if token:
+            headers.update({'Authorization': f' Bearer {token}'})
+        stream = NDJSONStream()
+
+        async def fetch() -> HTTPResponse:
+            received = stream.received
+            try:
+                return await self._fetch(
+                    url,
+                    method='GET',
+                    headers=headers,
+                    header_callback=stream.on_header,
+                    streaming_callback=stream.on_data)
+            except (HTTPClientError, OSError) as e:
+                if stream.received > received:
+                    # Retrying would yield the same records again
+                    raise LichessError(599, str(e), url) from e
+                raise
+        request: 'Future[HTTPResponse]' = ensure_future(self.scheduler.run(token, fetch))
+        request.add_done_callback(lambda _: stream.finish())
+        count = 0
+        try:
+            while limit is None or count < limit:
+                record = await stream.records.get()
+                if record is None:
+                    break
+                yield record
+                count += 1
+        finally:
+            if not request.done():
+                # Remaining chunks are dropped without being parsed
+                stream.closed = True
+                request.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if request.done():
+            res = request.result()
+            if res.code != 200:
+                self._raise_error(res.code, stream.buffer, url)
+
     async def _make_request(
             self,
             url: str,
             token: str,
             method: str,
+            raw_body: Optional[str] = None,
             **kwargs: Any) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
         headers: Dict[str, str] = {'Accept': 'application/json'}
         body = None
+        if raw_body is not None:
+            body = raw_body.encode()
+            headers.update({'Content-Type': 'text/plain'})
         if kwargs:
             if method == 'GET':
                 url = f'{url}?{urlencode(self.transform_boolean_parameters(kwargs))}'
@@ -65,24 +207,20 @@ class LichessAPI():
                 headers.update({'Content-Type': 'application/x-www-form-urlencoded'})
         if token:
             headers.update({'Authorization': f' Bearer {token}'})
-        res = await self.http.fetch(
-            url,
-            method=method,
-            headers=headers,
-            body=body,
-            raise_error=False)
+        res = await self.scheduler.run(
+            token,
+            lambda: self._fetch(
+                url,
+                method=method,
+                headers=headers,
+                body=body),
+            idempotent=method == 'GET')
         if res.code == 200:
             if b'\n' in res.body:
                 return cast(List[Dict[str, Any]], [loads(line) for line in res.body.decode().splitlines()])
             return cast(Dict[str, Any], loads(res.body.decode())) if len(res.body) > 0 else []
-        message = f"Bad Lichess Request: {res.body.decode() if res.body else ''}"
-        try:
-            json = loads(res.body.decode()) if len(res.body) > 0 else []
-            message = str(json.get('error_description') or json.get('error'))
-        except ValueError:
-            logging.exception("Error decoding lichess response")
-        logging.error(f"Lichess API error: {res.code}, {res.body.decode()}")
-        raise LichessError(res.code, message, url)
+        self._raise_error(res.code, res.body, url)
+        return []
 
     def get_authorize_url(self,  scope: List[str], state: Optional[str] = None) -> Tuple[str, str]:
         code_verifier = token_urlsafe(64)
@@ -112,58 +250,106 @@ class LichessAPI():
             client_id=self.client_id
         )))['access_token'])
 
+    @classmethod
+    def tournament_ttl(cls, tournament: Dict[str, Any]) -> float:
+        if tournament.get('isFinished') or tournament.get('status') == 'finished':
+            return cls.FINISHED_TOURNAMENT_TTL
+        return cls.LIVE_TOURNAMENT_TTL
+
     async def get_user(self, token: str, username: str) -> Dict[str, Any]:
-        return cast(Dict[str, Any], await self._make_request(
-                    f'{self._USER_URL}/{username}',
-                    method='GET',
-                    token=token))
+        return cast(Dict[str, Any], await self.cache.get(
+            ('user', username.lower()),
+            lambda: self._make_request(
+                f'{self._USER_URL}/{username}',
+                method='GET',
+                token=token),
+            lambda _: self.USER_TTL))
+
+    async def get_users(self, token: str, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        unique_ids = list(dict.fromkeys(id.lower() for id in ids))
+        users: Dict[str, Dict[str, Any]] = {}
+        missing = []
+        for id in unique_ids:
+            user = self.cache.lookup(('user', id))
+            if user is None:
+                missing.append(id)
+            else:
+                users[id] = user
+        self.cache.hits += len(users)
+        self.cache.misses += len(missing)
+        chunks = [missing[i:i + self.USERS_CHUNK] for i in range(0, len(missing), self.USERS_CHUNK)]
+        results = await gather(*[
+            self._make_request(
+                self._USERS_URL,
+                method='POST',
+                token=token,
+                raw_body=','.join(chunk))
+            for chunk in chunks])
+        # Closed and unknown accounts are silently omitted from the reply
+        for user in (user for chunk in results for user in cast(List[Dict[str, Any]], chunk)):
+            self.cache.put(('user', user['id']), user, self.USER_TTL)
+            users[user['id']] = user
+        return users
 
     async def get_current_user(self, token: str) -> Dict[str, Any]:
-        account_request = self.http.fetch(
-            self._ACCOUNT_URL,
-            method='GET',
-            headers={
-                'Authorization': f' Bearer {token}'
-            })
-        email_request = self.http.fetch(
-            self._EMAIL_URL,
-            method='GET',
-            headers={
-                'Authorization': f' Bearer {token}'
-            })
-        user, email = [loads(res.body.decode()) for res in await gather(account_request, email_request)]
-        user.update(email)
+        user, email = await gather(
+            self._make_request(self._ACCOUNT_URL, method='GET', token=token),
+            self._make_request(self._EMAIL_URL, method='GET', token=token))
+        cast(Dict[str, Any], user).update(cast(Dict[str, Any], email))
         return cast(Dict[str, Any], user)
 
     async def get_user_teams(self, token: str, username: str) -> List[Dict[str, Any]]:
         assert '/' not in username
-        return cast(List[Dict[str, Any]], await self._make_request(
-            f'{self._USER_TEAMS_URL}/{username}',
-            method='GET',
-            token=token))
+        return cast(List[Dict[str, Any]], await self.cache.get(
+            ('teams', username.lower()),
+            lambda: self._make_request(
+                f'{self._USER_TEAMS_URL}/{username}',
+                method='GET',
+                token=token),
+            lambda _: self.TEAMS_TTL))
+
+    # Teams of a user if they are cached, without asking Lichess
+    def get_cached_user_teams(self, username: str) -> Optional[List[Dict[str, Any]]]:
+        return cast(Optional[List[Dict[str, Any]]], self.cache.lookup(('teams', username.lower())))
 
     async def get_tournament(self, token: str, type: str, id: str) -> Dict[str, Any]:
         assert '/' not in id
         if type == 'arena':
-            return cast(Dict[str, Any], await self._make_request(
-                f'{self.ARENA_URL}/{id}',
-                method='GET',
-                token=token))
+            url = f'{self.ARENA_URL}/{id}'
         elif type == 'swiss':
-            return cast(Dict[str, Any], await self._make_request(
-                f'{self.SWISS_URL}/{id}',
-                method='GET',
-                token=token))
+            url = f'{self.SWISS_URL}/{id}'
         else:
             raise ValueError(f"Unknown tournament type {type}")
+        # Arena replies include a "me" section for the requesting user
+        return cast(Dict[str, Any], await self.cache.get(
+            ('tournament', type, id, token),
+            lambda: self._make_request(url, method='GET', token=token),
+            self.tournament_ttl))
 
-    async def get_swiss_standings(self, token: str, id: str, max: int = 10) -> List[Dict[str, Any]]:
+    def stream_swiss_standings(self, token: str, id: str, max: int = 10) -> AsyncIterator[Dict[str, Any]]:
         assert '/' not in id
-        return cast(List[Dict[str, Any]], await self._make_request(
-                f'{self.SWISS_URL}/{id}/results',
-                method='GET',
-                token=token,
-                nb=max))
+        return self._stream_request(f'{self.SWISS_URL}/{id}/results', token=token, limit=max, nb=max)
+
+    def stream_arena_standings(self, token: str, id: str, max: int = 10) -> AsyncIterator[Dict[str, Any]]:
+        assert '/' not in id
+        return self._stream_request(f'{self.ARENA_URL}/{id}/results', token=token, limit=max, nb=max)
+
+    def stream_team_members(self, token: str, team_id: str) -> AsyncIterator[Dict[str, Any]]:
+        assert '/' not in team_id
+        return self._stream_request(f'{self.TEAM_URL}/{team_id}/users', token=token)
+
+    # Standings are kept as long as the tournament they belong to, which
+    # callers usually have fetched already
+    async def get_swiss_standings(self, token: str, id: str, max: int = 10) -> List[Dict[str, Any]]:
+        tournament = await self.get_tournament(token, 'swiss', id)
+        return cast(List[Dict[str, Any]], await self.cache.get(
+            ('swiss_standings', id, max),
+            lambda: self._collect(self.stream_swiss_standings(token, id, max)),
+            lambda _: self.tournament_ttl(tournament)))
+
+    @staticmethod
+    async def _collect(records: AsyncIterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [record async for record in records]
 
     async def create_tournament(self, token: str, type: str, template_dict: Dict[str, Any]) -> Dict[str, Any]:
         if type == 'arena':
@@ -0,0 +1,312 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from os import listdir, makedirs, replace
+from os.path import exists, join as path_join
+from time import monotonic
+from typing import Any, Callable, ContextManager, Dict, Iterable, List, Optional, Tuple
+
+import tornado.web
+from tornado.log import access_log
+
+from storage import Document, Storage, Table
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+Labels = Tuple[str, ...]
+
+
+# Recording is a dict lookup and an addition, so metrics stay on in
+# production. Metric values are kept per process; with several server
+# processes each one saves a snapshot which /metrics adds up.
+class Metric(ABC):
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    @abstractmethod
+    def samples(self) -> Dict[Labels, Any]:
+        ...
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, value: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self) -> Dict[Labels, Any]:
+        return dict(self._values)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label values: count of every bucket plus +Inf, then the sum
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Dict[Labels, Any]:
+        return {labels: list(counts) for labels, counts in self._values.items()}
+
+
+# Values read from existing counters, e.g. cache statistics, when metrics
+# are collected
+class Collected(Metric):
+    def __init__(self, name: str, help: str, type: str, labels: Iterable[str],
+                 collect: Callable[[], Dict[Labels, float]]) -> None:
+        super().__init__(name, help, labels)
+        self.type = type
+        self.collect = collect
+
+    def samples(self) -> Dict[Labels, Any]:
+        try:
+            return self.collect()
+        except Exception:
+            logging.exception(f"Cannot collect metric {self.name}")
+            return {}
+
+
+REGISTRY: Dict[str, Metric] = {}
+
+HTTP_REQUESTS = Histogram(
+    'http_request_duration_seconds', "Requests served by handler", ('handler', 'method', 'status'))
+LICHESS_REQUESTS = Histogram(
+    'lichess_request_duration_seconds', "Requests to Lichess by endpoint", ('endpoint', 'method', 'status'))
+GOOGLE_REQUESTS = Histogram(
+    'google_request_duration_seconds', "Requests to Google APIs by operation", ('operation', 'status'))
+DB_OPERATIONS = Histogram(
+    'db_operation_duration_seconds', "Storage operations by table", ('table', 'operation'), DB_BUCKETS)
+RENDER_CACHE = Counter('diploma_render_cache_total', "Diplomas served from cache or rendered", ('result',))
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        name: {
+            'type': metric.type,
+            'help': metric.help,
+            'labels': metric.labels,
+            'buckets': getattr(metric, 'buckets', None),
+            'samples': [[list(labels), value] for labels, value in metric.samples().items()],
+        } for name, metric in REGISTRY.items()}
+
+
+def save_snapshot(directory: str, worker: int) -> None:
+    makedirs(directory, mode=0o700, exist_ok=True)
+    path = path_join(directory, f'worker-{worker}.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    replace(f'{path}.tmp', path)
+
+
+def load_snapshots(directory: str, worker: int) -> Dict[int, Dict[str, Any]]:
+    snapshots = {worker: snapshot()}
+    if not exists(directory):
+        return snapshots
+    for name in listdir(directory):
+        if not name.startswith('worker-') or not name.endswith('.json'):
+            continue
+        other = int(name[len('worker-'):-len('.json')])
+        if other != worker:
+            try:
+                with open(path_join(directory, name)) as f:
+                    snapshots[other] = json.load(f)
+            except ValueError:
+                continue
+    return snapshots
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[Any]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# Counters and histograms of all processes are added up, gauges get a
+# "worker" label
+def render(snapshots: Dict[int, Dict[str, Any]]) -> str:
+    lines = []
+    for name in sorted(set(name for snapshot in snapshots.values() for name in snapshot)):
+        merged: Dict[Tuple[Any, ...], Any] = {}
+        metric: Optional[Dict[str, Any]] = None
+        for worker, snap in sorted(snapshots.items()):
+            if name not in snap:
+                continue
+            metric = snap[name]
+            for labels, value in metric['samples']:
+                if metric['type'] == 'gauge':
+                    if len(snapshots) > 1:
+                        labels = labels + [str(worker)]
+                    merged[tuple(labels)] = value
+                elif metric['type'] == 'histogram':
+                    counts = merged.setdefault(tuple(labels), [0] * len(value))
+                    for i, count in enumerate(value):
+                        counts[i] += count
+                else:
+                    merged[tuple(labels)] = merged.get(tuple(labels), 0) + value
+        assert metric is not None
+        label_names = list(metric['labels'])
+        if metric['type'] == 'gauge' and len(snapshots) > 1:
+            label_names.append('worker')
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for labels, value in sorted(merged.items()):
+            if metric['type'] != 'histogram':
+                lines.append(f'{name}{_format_labels(label_names, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], value):
+                cumulative += count
+                le = _format_labels(label_names + ['le'], list(labels) + [bound])
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(label_names, labels)} {value[-1]}')
+            lines.append(f'{name}_count{_format_labels(label_names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+# Replaces the access log of tornado.web.Application
+def log_request(handler: tornado.web.RequestHandler) -> None:
+    status = handler.get_status()
+    HTTP_REQUESTS.observe(
+        handler.request.request_time(), type(handler).__name__, handler.request.method or '', str(status))
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", status, handler._request_summary(), 1000.0 * handler.request.request_time())
+
+
+class TimedTable(Table):
+    def __init__(self, table: Table, name: str) -> None:
+        self._table = table
+        self.name = name
+
+    def _observe(self, operation: str, start: float) -> None:
+        DB_OPERATIONS.observe(monotonic() - start, self.name, operation)
+
+    def search(self, **where: Any) -> List[Document]:
+        start = monotonic()
+        try:
+            return self._table.search(**where)
+        finally:
+            self._observe('search', start)
+
+    def get(self, **where: Any) -> Optional[Document]:
+        start = monotonic()
+        try:
+            return self._table.get(**where)
+        finally:
+            self._observe('get', start)
+
+    def contains(self, **where: Any) -> bool:
+        start = monotonic()
+        try:
+            return self._table.contains(**where)
+        finally:
+            self._observe('contains', start)
+
+    def search_page(self, order_by: str, limit: int, after: Optional[Tuple[Any, int]] = None,
+                    descending: bool = False, **where: Any) -> List[Document]:
+        start = monotonic()
+        try:
+            return self._table.search_page(order_by, limit, after, descending, **where)
+        finally:
+            self._observe('search_page', start)
+
+    def insert(self, document: Dict[str, Any]) -> int:
+        start = monotonic()
+        try:
+            return self._table.insert(document)
+        finally:
+            self._observe('insert', start)
+
+    def insert_multiple(self, documents: Iterable[Dict[str, Any]]) -> List[int]:
+        start = monotonic()
+        try:
+            return self._table.insert_multiple(documents)
+        finally:
+            self._observe('insert_multiple', start)
+
+    def update(self, fields: Dict[str, Any], **where: Any) -> int:
+        start = monotonic()
+        try:
+            return self._table.update(fields, **where)
+        finally:
+            self._observe('update', start)
+
+    def update_multiple(self, updates: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]) -> int:
+        start = monotonic()
+        try:
+            return self._table.update_multiple(updates)
+        finally:
+            self._observe('update_multiple', start)
+
+    def upsert(self, document: Dict[str, Any], **where: Any) -> None:
+        start = monotonic()
+        try:
+            self._table.upsert(document, **where)
+        finally:
+            self._observe('upsert', start)
+
+    def remove(self, **where: Any) -> int:
+        start = monotonic()
+        try:
+            return self._table.remove(**where)
+        finally:
+            self._observe('remove', start)
+
+
+class TimedStorage(Storage):
+    def __init__(self, storage: Storage) -> None:
+        self.storage = storage
+        self._tables: Dict[str, TimedTable] = {}
+
+    def table(self, name: str) -> Table:
+        if name not in self._tables:
+            self._tables[name] = TimedTable(self.storage.table(name), name)
+        return self._tables[name]
+
+    def transaction(self) -> ContextManager[Any]:
+        return self.storage.transaction()
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+class MetricsHandler(tornado.web.RequestHandler):  # type: ignore[misc]
+    def get(self) -> None:
+        token = self.settings['options'].metrics_token
+        if token and self.request.headers.get('Authorization') != f'Bearer {token}':
+            raise tornado.web.HTTPError(403)
+        worker = self.settings.get('worker', 0)
+        if directory := self.settings.get('metrics_dir'):
+            snapshots = load_snapshots(directory, worker)
+        else:
+            snapshots = {worker: snapshot()}
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(render(snapshots))
@@ -0,0 +1,47 @@
+import argparse
+import logging
+import sys
+
+from tinydb import TinyDB
+
+from storage import open_storage, STORAGE_ENGINES
+
+
+def migrate(source: str, db_dir: str, engine: str = 'sqlite') -> int:
+    db = TinyDB(source, access_mode='r')
+    storage = open_storage(engine, db_dir, check_migration=False)
+    try:
+        for name in sorted(db.tables()):
+            table = storage.table(name)
+            if table.get():
+                raise RuntimeError(f"Table {name} in {db_dir} is not empty, refusing to import")
+        total = 0
+        for name in sorted(db.tables()):
+            documents = db.table(name).all()
+            storage.table(name).insert_multiple(documents)
+            logging.info(f"Imported {len(documents)} documents into {name}")
+            total += len(documents)
+        return total
+    finally:
+        storage.close()
+        db.close()
+
+
+def main() -> None:
+    engines = [engine for engine in STORAGE_ENGINES if engine != 'tinydb']
+    parser = argparse.ArgumentParser(description='Import a TinyDB db.json into another storage engine')
+    parser.add_argument('--engine', choices=engines, default='sqlite', help='Storage engine to import into')
+    parser.add_argument('source', help='Path to db.json')
+    parser.add_argument('target', help='Directory of the target storage, the db_dir of the server')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        total = migrate(args.source, args.target, args.engine)
+    except RuntimeError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    logging.info(f"Imported {total} documents from {args.source} into {args.engine} storage in {args.target}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import logging
+from asyncio import Future, ensure_future
+from datetime import timedelta
+from json import dumps
+from secrets import token_urlsafe
+from time import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, cast
+
+import tornado.iostream
+import tornado.locks
+import tornado.web
+from tornado.web import HTTPError
+
+from basehandler import BaseAPIHandler
+from dataio import run_blocking
+from storage import Storage, at_least, at_most, one_of
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+# Receives the progress events of an operation, a no-op when the request
+# is answered synchronously
+Progress = Callable[..., None]
+
+
+def no_progress(event: str, **data: Any) -> None:
+    pass
+
+
+class Operation():
+    def __init__(self, operations: 'Operations', id: str) -> None:
+        self.operations = operations
+        self.id = id
+        self.emitted = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._writing: Optional['Future[None]'] = None
+
+    # Events are written behind, one row each in the order they were
+    # emitted, together with those emitted while the previous ones were
+    # being written
+    def emit(self, event: str, **data: Any) -> None:
+        self._pending.append({'operation': self.id, 'seq': self.emitted, 'event': event, 'data': data})
+        self.emitted += 1
+        if self._writing is None or self._writing.done():
+            self._writing = ensure_future(self._write())
+
+    async def _write(self) -> None:
+        while self._pending:
+            events, self._pending = self._pending, []
+            try:
+                await run_blocking(self.operations._append, self.id, events)
+            except Exception:
+                logging.exception(f"Saving events of operation {self.id} failed")
+            self.operations._changed.notify_all()
+
+    async def finish(self, status: str, **fields: Any) -> None:
+        if self._writing is not None:
+            await self._writing
+        await self.operations._save(self.id, {'status': status, 'finished': time(), **fields})
+
+
+class Operations():
+    # Long requests can run in the background instead, their results are kept
+    # in the 'operations' table and their progress events in
+    # 'operation_events' so a reloaded page can follow them again from any
+    # server process. Streams in other processes notice new events every
+    # POLL_INTERVAL seconds.
+    POLL_INTERVAL = 1.0
+    KEEP = 7 * 86400
+    # Operations of a server process that stopped never finish
+    STALE_AFTER = 600
+
+    def __init__(self, db: Storage) -> None:
+        self.db = db
+        self.running = 0
+        self._changed = tornado.locks.Condition()
+        self._tasks: Set['Future[None]'] = set()
+
+    async def start(self, user: str, kind: str,
+                    run: Callable[[Operation], Awaitable[Dict[str, Any]]]) -> Operation:
+        now = time()
+        operation = Operation(self, token_urlsafe(12))
+        await run_blocking(self.db.table('operations').insert, {
+            'id': operation.id,
+            'user': user,
+            'kind': kind,
+            'status': RUNNING,
+            'started': now,
+            'updated': now,
+        })
+
+        async def background() -> None:
+            self.running += 1
+            try:
+                result = await run(operation)
+            except Exception as e:
+                logging.exception(f"Operation {kind} of {user} failed")
+                message = e.log_message if isinstance(e, HTTPError) else "Internal error"
+                await operation.finish(FAILED, error=message or "Internal error")
+            else:
+                await operation.finish(DONE, result=result)
+            finally:
+                self.running -= 1
+
+        # The event loop only keeps weak references to tasks
+        task = ensure_future(background())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return operation
+
+    async def _save(self, id: str, fields: Dict[str, Any]) -> None:
+        await run_blocking(self.db.table('operations').update, {**fields, 'updated': time()}, id=id)
+        self._changed.notify_all()
+
+    def _append(self, id: str, events: List[Dict[str, Any]]) -> None:
+        self.db.table('operation_events').insert_multiple(events)
+        self.db.table('operations').update({'updated': time()}, id=id)
+
+    async def get(self, id: str, user: str) -> Optional[Dict[str, Any]]:
+        operation = await run_blocking(self.db.table('operations').get, id=id, user=user)
+        return self._check(dict(operation)) if operation is not None else None
+
+    # The events of an operation after the one numbered after
+    async def events(self, id: str, after: int = -1) -> List[Dict[str, Any]]:
+        events = await run_blocking(self.db.table('operation_events').search, operation=id, seq=at_least(after + 1))
+        events.sort(key=lambda e: e['seq'])
+        return [{'id': e['seq'], 'event': e['event'], 'data': e['data']} for e in events]
+
+    async def recent(self, user: str, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        where = {'kind': kind} if kind else {}
+        operations = await run_blocking(self.db.table('operations').search, user=user, **where)
+        return sorted((self._check(dict(o)) for o in operations), key=lambda o: o['started'], reverse=True)
+
+    def _check(self, operation: Dict[str, Any]) -> Dict[str, Any]:
+        if operation['status'] == RUNNING and operation['updated'] < time() - self.STALE_AFTER:
+            operation.update(status=FAILED, error="Interrupted")
+        return operation
+
+    async def wait(self, timeout: float) -> None:
+        await self._changed.wait(timedelta(seconds=timeout))
+
+    def prune(self) -> int:
+        ids = [o['id'] for o in self.db.table('operations').search(updated=at_most(time() - self.KEEP))]
+        if not ids:
+            return 0
+        self.db.table('operation_events').remove(operation=one_of(ids))
+        return self.db.table('operations').remove(id=one_of(ids))
+
+
+# Clients ask for a background operation with "Prefer: respond-async"
+# (RFC 7240) and get 202 with the operation id right away
+def wants_async(handler: tornado.web.RequestHandler) -> bool:
+    return 'respond-async' in handler.request.headers.get('Prefer', '')
+
+
+async def start_operation(handler: BaseAPIHandler, kind: str,
+                          run: Callable[[Operation], Awaitable[Dict[str, Any]]]) -> None:
+    operations = cast(Operations, handler.settings['operations'])
+    operation = await operations.start(handler.current_user['id'], kind, run)
+    handler.set_status(202)
+    handler.set_header('Preference-Applied', 'respond-async')
+    handler.set_header('Location', f'/api/v1/operations/{operation.id}')
+    handler.write(dumps({'success': True, 'operation': operation.id}))
+
+
+def operation_status(operation: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: operation[key] for key in ('id', 'kind', 'status', 'started', 'updated', 'finished', 'result',
+                                            'error', 'events') if key in operation}
+
+
+class OperationsHandler(BaseAPIHandler):
+    @property
+    def operations(self) -> Operations:
+        return cast(Operations, self.settings['operations'])
+
+    # One operation with every event, or the user's recent operations of a
+    # kind without them
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self, id: str) -> None:
+        if id:
+            operation = await self.operations.get(id, self.current_user['id'])
+            if operation is None:
+                raise HTTPError(404, "Operation not found")
+            operation['events'] = await self.operations.events(id)
+            self.write(dumps({'success': True, 'operation': operation_status(operation)}))
+            return
+        operations = await self.operations.recent(self.current_user['id'], self.get_argument('kind', None))
+        self.write(dumps({'success': True, 'operations': [
+            {key: value for key, value in operation_status(o).items() if key != 'events'} for o in operations]}))
+
+
+class OperationEventsHandler(OperationsHandler):
+    # Server-sent events of an operation, starting after Last-Event-ID when
+    # the browser reconnects. A comment is sent every KEEPALIVE seconds so
+    # proxies keep the connection open.
+    KEEPALIVE = 15
+
+    _closed = False
+
+    def on_connection_close(self) -> None:
+        self._closed = True
+
+    def send(self, event: str, data: Any, id: Optional[int] = None) -> None:
+        if id is not None:
+            self.write(f'id: {id}\n')
+        self.write(f'event: {event}\ndata: {dumps(data)}\n\n')
+
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self, id: str) -> None:
+        operation = await self.operations.get(id, self.current_user['id'])
+        if operation is None:
+            raise HTTPError(404, "Operation not found")
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')
+        try:
+            sent = int(self.request.headers.get('Last-Event-ID', self.get_argument('after', '-1')))
+        except ValueError:
+            raise HTTPError(400, "Invalid event id")
+        idle = 0.0
+        try:
+            while not self._closed:
+                # Events are all saved before the status changes
+                events = await self.operations.events(id, sent)
+                for event in events:
+                    self.send(event['event'], event['data'], event['id'])
+                    sent = event['id']
+                if operation['status'] != RUNNING:
+                    self.send('finished', operation_status(operation))
+                    await self.flush()
+                    break
+                if events or idle >= self.KEEPALIVE:
+                    if not events:
+                        self.write(': keepalive\n\n')
+                    idle = 0
+                    await self.flush()
+                started = time()
+                await self.operations.wait(self.operations.POLL_INTERVAL)
+                idle += time() - started
+                operation = await self.operations.get(id, self.current_user['id']) or operation
+        except tornado.iostream.StreamClosedError:
+            pass
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from random import uniform
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from tornado.httpclient import HTTPClientError, HTTPResponse
+
+
+class TokenBucket():
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Takes a token even if the bucket is empty and returns how long the
+        # caller has to wait for it, so waiters are served in arrival order
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class RequestScheduler():
+    # Lichess asks clients to pause for a full minute after a 429
+    COOLDOWN = 60.0
+    MAX_TOKEN_BUCKETS = 1024
+
+    def __init__(self,
+                 rate: float = 20,
+                 burst: float = 20,
+                 token_rate: float = 4,
+                 token_burst: float = 8,
+                 concurrency: int = 8,
+                 max_retries: int = 3,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 30) -> None:
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._global = TokenBucket(rate, burst)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._cooldown_until = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'max_queue_depth': self.max_queue_depth,
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'wait_time_total': self.wait_time,
+            'wait_time_avg': self.wait_time / self.requests if self.requests else 0.0,
+            'wait_time_max': self.max_wait_time,
+            'cooldown': max(0.0, self._cooldown_until - monotonic()),
+        }
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_TOKEN_BUCKETS:
+                # Full buckets carry no state, dropping them is free
+                for k in [k for k, b in self._buckets.items() if b.is_full()]:
+                    del self._buckets[k]
+            bucket = self._buckets[key] = TokenBucket(self.token_rate, self.token_burst)
+        return bucket
+
+    def backoff(self, attempt: int) -> float:
+        return uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _acquire(self, key: str) -> None:
+        start = monotonic()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            while (cooldown := self._cooldown_until - monotonic()) > 0:
+                await asyncio.sleep(cooldown)
+            delay = max(self._global.reserve(), self._bucket(key).reserve())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+        waited = monotonic() - start
+        self.requests += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+    async def run(self,
+                  key: str,
+                  fetch: Callable[[], Awaitable[HTTPResponse]],
+                  idempotent: bool = True) -> HTTPResponse:
+        attempt = 0
+        self.in_flight += 1
+        try:
+            while True:
+                await self._acquire(key)
+                try:
+                    res = await fetch()
+                except (HTTPClientError, OSError) as e:
+                    # Timeouts and connection errors are raised even with
+                    # raise_error=False
+                    if not idempotent or attempt >= self.max_retries:
+                        raise
+                    failure = f"Lichess request failed: {e}"
+                else:
+                    if res.code == 429:
+                        self.throttled += 1
+                        self._cooldown_until = max(self._cooldown_until, monotonic() + self.retry_after(res))
+                    elif not (idempotent and res.code >= 500):
+                        return res
+                    if attempt >= self.max_retries:
+                        return res
+                    failure = f"Lichess replied {res.code} for {res.effective_url}"
+                finally:
+                    self._semaphore.release()
+                attempt += 1
+                self.retries += 1
+                delay = self.backoff(attempt)
+                logging.warning(f"{failure}, retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        finally:
+            self.in_flight -= 1
+
+    # Waits for queued and running requests to finish, returns False if some
+    # are still running after the timeout
+    async def drain(self, timeout: float) -> bool:
+        deadline = monotonic() + timeout
+        while self.in_flight and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return not self.in_flight
+
+    @classmethod
+    def retry_after(cls, res: HTTPResponse) -> float:
+        value: Optional[str] = res.headers.get('Retry-After') if res.headers else None
+        try:
+            return float(value) if value else cls.COOLDOWN
+        except ValueError:
+            return cls.COOLDOWN
@@ -0,0 +1,271 @@
+import json
+import math
+import multiprocessing
+import re
+import signal
+from base64 import b64decode
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from hashlib import sha256
+from io import BytesIO
+from multiprocessing.context import BaseContext
+from os import listdir, makedirs, remove, replace, utime
+from os.path import dirname, exists, getmtime, join as path_join
+from secrets import token_hex
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from blobs import blob_path
+
+# Size of the fabric canvas in diplomas.html, diplomas are rendered SCALE
+# times larger like the "Download" button in the browser does
+CANVAS_SIZE = (300, 422)
+SCALE = 4
+# Bump when rendering changes so previously cached diplomas are not reused
+RENDER_VERSION = 1
+
+# fabric.Text line height
+LINE_HEIGHT = 1.16
+
+FONT_ALIASES = {
+    'sans': 'DejaVuSans',
+    'sans-serif': 'DejaVuSans',
+    'serif': 'DejaVuSerif',
+    'monospace': 'DejaVuSansMono',
+}
+
+_SUBSTITUTION = re.compile(r'\$\{([a-zA-Z.]+)\}')
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _init_worker() -> None:
+    # Stopping the server stops the workers through shutdown_pool()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+# The pool is created on the first render, when the I/O threads are already
+# running, so workers are not forked from the server process. They come from
+# a fork server which only preloads this module, importing the server's main
+# module there would parse a command line it does not have.
+def get_pool(processes: Optional[int] = None) -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context: BaseContext = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+        else:
+            context = multiprocessing.get_context('spawn')
+        _pool = ProcessPoolExecutor(processes or None, mp_context=context, initializer=_init_worker)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def _get_deep(obj: Any, path: str) -> Any:
+    # Same semantics as TextField.getDeep in diplomas.js
+    for key in path.split('.'):
+        obj = obj.get(key) if isinstance(obj, dict) else None
+        if not obj:
+            return None
+    return obj
+
+
+def format_date(starts_at: Any) -> str:
+    if isinstance(starts_at, (int, float)):
+        date = datetime.utcfromtimestamp(starts_at / 1000)
+    else:
+        date = datetime.fromisoformat(str(starts_at).replace('Z', '+00:00'))
+    return date.strftime('%d.%m.%Y')
+
+
+def make_substitutions(text: str, substitutions: Dict[str, Any]) -> str:
+    def replace_match(match: 're.Match[str]') -> str:
+        if match[1] == 'tournament.date':
+            replacement = format_date(substitutions['tournament'].get('startsAt'))
+        else:
+            replacement = _get_deep(substitutions, match[1])
+        return str(replacement) if replacement else ''
+    return _SUBSTITUTION.sub(replace_match, text)
+
+
+def template_hash(fields: Dict[str, Any]) -> str:
+    return sha256(f'{RENDER_VERSION}:{SCALE}:{json.dumps(fields, sort_keys=True)}'.encode()).hexdigest()
+
+
+def _image_source(image: Optional[str]) -> Optional[str]:
+    if not image:
+        return None
+    if image.startswith('data:'):
+        return image
+    return blob_path(image)
+
+
+# Turns the stored diploma fields into a list of layers for render_diploma()
+# with all texts substituted for the player. Layers only contain values
+# which end up on the diploma so they also serve as the cache key.
+def get_layers(fields: Dict[str, Any], substitutions: Dict[str, Any]) -> List[Dict[str, Any]]:
+    backgrounds = []
+    layers = []
+    for field in fields.values():
+        if not isinstance(field, dict):
+            continue
+        props = field.get('fabric_props') or {}
+        if field.get('type') == 'BackgroundImage':
+            if source := _image_source(field.get('image')):
+                backgrounds.append({'type': 'background', 'source': source})
+        elif field.get('type') == 'ImageField':
+            if source := _image_source(field.get('image')):
+                layers.append({'type': 'image', 'source': source, 'props': props})
+        elif field.get('type') == 'TextField':
+            layers.append({
+                'type': 'text',
+                'text': make_substitutions(field.get('text', 'Example Text'), substitutions),
+                'font': field.get('font', 'Sans'),
+                'font_size': float(field.get('font_size') or 24),
+                'color': field.get('color', '#000'),
+                'props': props,
+            })
+    return backgrounds + layers
+
+
+def render_key(template: str, tournament_id: str, player: str, layers: List[Dict[str, Any]]) -> str:
+    texts = [layer['text'] for layer in layers if layer['type'] == 'text']
+    return sha256(json.dumps([template, tournament_id, player, texts]).encode()).hexdigest()
+
+
+def render_dir(db_dir: str) -> str:
+    return path_join(db_dir, 'renders')
+
+
+def cached_render(db_dir: str, key: str) -> Optional[str]:
+    path = path_join(render_dir(db_dir), f'{key}.png')
+    if not exists(path):
+        return None
+    utime(path)
+    return path
+
+
+def prune_renders(db_dir: str, max_age: float) -> int:
+    directory = render_dir(db_dir)
+    if not exists(directory):
+        return 0
+    removed = 0
+    for name in listdir(directory):
+        path = path_join(directory, name)
+        if getmtime(path) < time() - max_age:
+            remove(path)
+            removed += 1
+    return removed
+
+
+# Everything below runs in the worker processes
+
+@lru_cache(maxsize=16)
+def _load_image(source: str) -> Image.Image:
+    if source.startswith('data:'):
+        image = Image.open(BytesIO(b64decode(source.split(',', 1)[1])))
+    else:
+        image = Image.open(source)
+    return image.convert('RGBA')
+
+
+@lru_cache(maxsize=64)
+def _load_font(family: str, size: int) -> ImageFont.FreeTypeFont:
+    name = FONT_ALIASES.get(family.lower(), family)
+    for candidate in (name, name.replace(' ', ''), f'{name}.ttf', FONT_ALIASES['sans']):
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+def _color(value: str) -> Tuple[int, ...]:
+    try:
+        return ImageColor.getcolor(value, 'RGBA')
+    except ValueError:
+        return (0, 0, 0, 255)
+
+
+# Pastes a layer the way fabric positions objects: (left, top) is where the
+# origin point of the scaled and rotated object ends up
+def _place(canvas: Image.Image, layer: Image.Image, props: Dict[str, Any],
+           default_left: float, default_top: float, origin_x: str = 'left') -> None:
+    scale_x = float(props.get('scaleX', 1)) * (-1 if props.get('flipX') else 1)
+    scale_y = float(props.get('scaleY', 1)) * (-1 if props.get('flipY') else 1)
+    width = max(1, round(layer.width * abs(scale_x)))
+    height = max(1, round(layer.height * abs(scale_y)))
+    layer = layer.resize((width, height), Image.LANCZOS)
+    if scale_x < 0:
+        layer = layer.transpose(Image.FLIP_LEFT_RIGHT)
+    if scale_y < 0:
+        layer = layer.transpose(Image.FLIP_TOP_BOTTOM)
+    if (opacity := float(props.get('opacity', 1))) < 1:
+        layer.putalpha(layer.getchannel('A').point(lambda a: round(a * opacity)))
+    offsets = {'left': 0.0, 'center': 0.5, 'right': 1.0, 'top': 0.0, 'bottom': 1.0}
+    ox = offsets.get(props.get('originX', origin_x), 0) * width
+    oy = offsets.get(props.get('originY', 'top'), 0) * height
+    angle = math.radians(float(props.get('angle', 0)))
+    dx, dy = width / 2 - ox, height / 2 - oy
+    center_x = float(props.get('left', default_left)) * SCALE + dx * math.cos(angle) - dy * math.sin(angle)
+    center_y = float(props.get('top', default_top)) * SCALE + dx * math.sin(angle) + dy * math.cos(angle)
+    if angle:
+        layer = layer.rotate(-math.degrees(angle), Image.BICUBIC, expand=True)
+    # The canvas is opaque, so pasting through the alpha channel composites
+    # correctly and unlike alpha_composite() allows negative offsets
+    canvas.paste(layer, (round(center_x - layer.width / 2), round(center_y - layer.height / 2)), layer)
+
+
+def _render_text(layer: Dict[str, Any]) -> Image.Image:
+    font = _load_font(layer['font'], max(1, round(layer['font_size'] * SCALE)))
+    lines = layer['text'].split('\n')
+    line_height = layer['font_size'] * SCALE * LINE_HEIGHT
+    width = max(1, max(round(font.getlength(line)) for line in lines))
+    image = Image.new('RGBA', (width, max(1, round(line_height * len(lines)))))
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((0, i * line_height + (line_height - layer['font_size'] * SCALE) / 2), line,
+                  font=font, fill=_color(layer['color']))
+    return image
+
+
+def render_diploma(layers: List[Dict[str, Any]], path: str) -> None:
+    width, height = CANVAS_SIZE
+    canvas = Image.new('RGBA', (width * SCALE, height * SCALE), (255, 255, 255, 255))
+    for layer in layers:
+        if layer['type'] == 'background':
+            image = _load_image(layer['source'])
+            scaled_height = round(image.height * canvas.width / image.width)
+            canvas.alpha_composite(image.resize((canvas.width, scaled_height), Image.LANCZOS))
+        elif layer['type'] == 'image':
+            image = _load_image(layer['source'])
+            # fabric_props store the size the image had when it was added
+            props = dict(layer['props'])
+            if 'width' in props and 'height' in props:
+                image = image.resize((max(1, round(float(props['width']))), max(1, round(float(props['height'])))))
+            props['scaleX'] = float(props.get('scaleX', 1)) * SCALE
+            props['scaleY'] = float(props.get('scaleY', 1)) * SCALE
+            _place(canvas, image, props, 10, 10)
+        elif layer['type'] == 'text':
+            _place(canvas, _render_text(layer), layer['props'], width / 2, height * .39, 'center')
+    makedirs(dirname(path), mode=0o700, exist_ok=True)
+    tmp = f'{path}.{token_hex(8)}.tmp'
+    canvas.convert('RGB').save(tmp, 'PNG', optimize=False)
+    replace(tmp, path)
+
+
+def render_pdf(paths: List[str]) -> bytes:
+    pages = [Image.open(path).convert('RGB') for path in paths]
+    output = BytesIO()
+    pages[0].save(output, 'PDF', save_all=True, append_images=pages[1:], resolution=72 * SCALE)
+    return output.getvalue()
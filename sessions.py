@@ -0,0 +1,174 @@
+import logging
+from collections import OrderedDict
+from secrets import token_urlsafe
+from time import monotonic, time
+from typing import Any, Dict, Optional, Set
+
+import tornado.ioloop
+
+from dataio import run_blocking
+from lichessapi import LichessAPI, LichessError
+from storage import Storage, at_most, one_of
+
+
+# Adds a user fetched from Lichess or refreshes the stored copy, keeping the
+# fields only this server knows about
+def store_user(db: Storage, lichess_user: Dict[str, Any]) -> Dict[str, Any]:
+    users = db.table('users')
+    if users.contains(id=lichess_user['id']):
+        users.update(lichess_user, id=lichess_user['id'])
+    else:
+        users.insert(lichess_user)
+    return dict(users.get(id=lichess_user['id']) or lichess_user)
+
+
+# The Lichess token of a user is only kept in the 'tokens' table, rows that
+# act for the user look it up by the user id. A new login replaces it.
+def save_token(db: Storage, user: str, token: str) -> None:
+    db.table('tokens').upsert({'user': user, 'token': token}, user=user)
+
+
+def get_token(db: Storage, user: str) -> Optional[str]:
+    document = db.table('tokens').get(user=user)
+    return str(document['token']) if document else None
+
+
+class Session():
+    def __init__(self, id: str, token: str, user: Dict[str, Any], expires: float, validated: float) -> None:
+        self.id = id
+        self.token = token
+        self.user = user
+        self.expires = expires
+        self.validated = validated
+        self.loaded = monotonic()
+
+
+class SessionStore():
+    # The cookie only holds the session id. Sessions live in the 'sessions'
+    # table, recently used ones are also kept in memory with their user and
+    # Lichess token. Other server processes may change a user, so
+    # cached entries are reloaded from the database after MEMORY_TTL seconds.
+    MEMORY_TTL = 30
+    # Users are fetched from Lichess again in the background after this many
+    # seconds, which also notices revoked tokens
+    REVALIDATE_AFTER = 24 * 3600
+
+    def __init__(self, db: Storage, max_entries: int = 4096, ttl: float = 30 * 86400) -> None:
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Session]' = OrderedDict()
+        self._revalidating: Set[str] = set()
+
+    async def create(self, token: str, user: Dict[str, Any]) -> Session:
+        now = time()
+        session = Session(token_urlsafe(32), token, user, now + self.ttl, now)
+        await run_blocking(self._save, session)
+        self._store(session)
+        return session
+
+    def _save(self, session: Session) -> None:
+        save_token(self.db, session.user['id'], session.token)
+        self.db.table('sessions').insert({
+            'id': session.id,
+            'user': session.user['id'],
+            'expires': session.expires,
+            'validated': session.validated,
+        })
+
+    async def get(self, id: str) -> Optional[Session]:
+        session = self._entries.get(id)
+        if session is not None and monotonic() - session.loaded < self.MEMORY_TTL:
+            self.hits += 1
+            self._entries.move_to_end(id)
+        else:
+            self.misses += 1
+            self._entries.pop(id, None)
+            session = await run_blocking(self._load, id)
+            if session is not None:
+                self._store(session)
+        if session is not None and session.expires <= time():
+            await self.delete(id)
+            return None
+        return session
+
+    def _load(self, id: str) -> Optional[Session]:
+        document = self.db.table('sessions').get(id=id)
+        if document is None:
+            return None
+        fields = self._move_token(document) if 'token' in document else document
+        user = self.db.table('users').get(id=fields['user'])
+        token = get_token(self.db, fields['user'])
+        if user is None or token is None:
+            return None
+        return Session(id, token, dict(user), fields['expires'], fields['validated'])
+
+    # Sessions saved before tokens had a table of their own
+    def _move_token(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        if get_token(self.db, document['user']) is None:
+            save_token(self.db, document['user'], document['token'])
+        document = {key: value for key, value in document.items() if key != 'token'}
+        sessions = self.db.table('sessions')
+        sessions.remove(id=document['id'])
+        sessions.insert(document)
+        return document
+
+    def _store(self, session: Session) -> None:
+        self._entries[session.id] = session
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, id: str) -> None:
+        self._entries.pop(id, None)
+        await run_blocking(self.db.table('sessions').remove, id=id)
+
+    # Saves changed user fields and applies them to every cached session of
+    # the user
+    async def update_user(self, user_id: str, fields: Dict[str, Any]) -> None:
+        await run_blocking(self.db.table('users').update, fields, id=user_id)
+        for session in self._entries.values():
+            if session.user['id'] == user_id:
+                session.user.update(fields)
+
+    def revalidate_if_stale(self, session: Session, lichess: LichessAPI) -> None:
+        if time() - session.validated < self.REVALIDATE_AFTER or session.id in self._revalidating:
+            return
+        self._revalidating.add(session.id)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.revalidate, session, lichess)
+
+    async def revalidate(self, session: Session, lichess: LichessAPI) -> None:
+        try:
+            lichess_user = await lichess.get_current_user(session.token)
+        except LichessError as e:
+            if e.code == 401:
+                logging.info(f"Token of {session.user['id']} was revoked, ending session")
+                await self.delete(session.id)
+                await run_blocking(self.db.table('tokens').remove, user=session.user['id'], token=session.token)
+            else:
+                logging.warning(f"Cannot revalidate session of {session.user['id']}: {e}")
+            return
+        except Exception:
+            logging.exception(f"Cannot revalidate session of {session.user['id']}")
+            return
+        finally:
+            self._revalidating.discard(session.id)
+        user = await run_blocking(store_user, self.db, lichess_user)
+        now = time()
+        await run_blocking(self.db.table('sessions').update, {'validated': now}, id=session.id)
+        for cached in self._entries.values():
+            if cached.user['id'] == user['id']:
+                cached.user.update(user)
+        session.validated = now
+
+    # Tokens are removed with the last session of their user once no
+    # creation job of the user is queued
+    def prune(self) -> int:
+        removed = self.db.table('sessions').remove(expires=at_most(time()))
+        users = set(session['user'] for session in self.db.table('sessions').search())
+        users.update(job['user'] for job in self.db.table('creation_jobs').search(status='queued'))
+        unused = [token['user'] for token in self.db.table('tokens').search() if token['user'] not in users]
+        if unused:
+            self.db.table('tokens').remove(user=one_of(unused))
+        return removed
@@ -633,6 +633,7 @@ function TournamentLine(props) {
       canvas: props.canvas,
       fieldsRef: props.fieldsRef,
       tournament: tournament,
+      url: props.url,
       numDiplomas: props.numDiplomas
     }))
 }
@@ -690,13 +691,21 @@ function DiplomasLine(props) {
   return e('div', {},
     e('a', {
       className: 'diploma_download_all',
-      onClick: (evt) => {
-        evt.preventDefault();
-        props.tournament.standing.players.slice(0, props.numDiplomas).forEach(player => {
-          DownloadDiploma(player);
-        });
-      }
+      // Rendered on the server from the saved template as one ZIP file
+      href: `/api/v1/diploma/render/${diploma_template_id}?${new URLSearchParams({
+        tournament: props.url,
+        players: props.numDiplomas,
+        format: 'zip'
+      })}`
     }, 'Download all'),
+    e('a', {
+      className: 'diploma_download_all',
+      href: `/api/v1/diploma/render/${diploma_template_id}?${new URLSearchParams({
+        tournament: props.url,
+        players: props.numDiplomas,
+        format: 'pdf'
+      })}`
+    }, 'Download all as PDF'),
     props.tournament.standing.players.slice(0, props.numDiplomas).map(player => {
       return e('a', {
         className: "diploma_preview_canvas",
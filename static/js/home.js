@@ -6,6 +6,20 @@ const weekdays = [3, 4, 5, 6, 7, 8, 9].map(day => (new Date(`2022-01-0${day}`)).
 
 const userTeams = null;
 
+// What the API would answer to the first requests of the page, embedded in it
+let bootstrap = {};
+
+// A part of the bootstrap data for the component that shows it first, the
+// part is dropped once the component is mounted so it is loaded from the API
+// when the component is shown again
+function useBootstrap(key) {
+  const [value] = React.useState(() => bootstrap[key]);
+  React.useEffect(() => {
+    delete bootstrap[key];
+  }, []);
+  return value;
+}
+
 function dragDrop(n_elements) {
   const dragItem = React.useRef()
   const dragOverItem = React.useRef()
@@ -23,10 +37,70 @@ function dragDrop(n_elements) {
   }
 }
 
+// Starts a background operation and resolves with its id
+function startOperation(url, options) {
+  return fetch(url, {
+    ...options,
+    credentials: 'include',
+    headers: { ...options.headers, Prefer: 'respond-async' }
+  })
+    .then(res => res.json())
+    .then(res => {
+      if (!res.success)
+        throw new Error(res.message);
+      return res.operation;
+    });
+}
+
+// Follows the progress events of an operation and resolves with the
+// operation once it has finished. The browser reconnects by itself and
+// continues after the last event it got.
+function followOperation(id, events, onEvent) {
+  return new Promise(resolve => {
+    const source = new EventSource(`/api/v1/operations/${id}/events`);
+    events.forEach(name => source.addEventListener(name, event => onEvent(name, JSON.parse(event.data))));
+    source.addEventListener('finished', event => {
+      source.close();
+      resolve(JSON.parse(event.data));
+    });
+  });
+}
+
+// The running operation of a kind started before the page was loaded
+function findRunningOperation(kind) {
+  return fetch(`/api/v1/operations?kind=${kind}`, {
+    credentials: 'include',
+  })
+    .then(res => res.json())
+    .then(res => res.success ? res.operations.find(operation => operation.status == 'running') : undefined)
+    .catch(() => undefined);
+}
+
+// Saves changes of several templates, each with its id, in one request
+function patchTemplates(url, changes) {
+  return fetch(`${url}?_xsrf=${xsrf}`, {
+    credentials: 'include',
+    method: 'PATCH',
+    headers: {
+      'Content-Type': 'appication/json'
+    },
+    body: JSON.stringify({ templates: changes })
+  })
+    .then(res => res.json())
+    .then(res => {
+      if (!res.success)
+        throw new Error(res.message);
+      return res;
+    });
+}
+
 function TournamentTemplates(props) {
-  const [templates, setTemplates] = React.useState([]);
-  const [loading, setLoading] = React.useState({ request: false, loading: true });
-  const [teams, setTeams] = React.useState(null);
+  const initialTemplates = useBootstrap('templates');
+  const initialTeams = useBootstrap('teams');
+  const [templates, setTemplates] = React.useState(initialTemplates || []);
+  const [loading, setLoading] = React.useState(initialTemplates ?
+    { request: true, loading: false } : { request: false, loading: true });
+  const [teams, setTeams] = React.useState(initialTeams || null);
   const [expandedIndex, setExpanded] = React.useState(null);
 
   React.useLayoutEffect(() => {
@@ -111,7 +185,8 @@ function TournamentTemplates(props) {
   }
 
   const onSave = (template) => {
-    template.index = templates.length
+    if (template.index === undefined)
+      template.index = templates.length
     return fetch(`/api/v1/tournament/template/?_xsrf=${xsrf}`, {
       credentials: 'include',
       method: 'POST',
@@ -137,10 +212,11 @@ function TournamentTemplates(props) {
     const newTemplate = { ...templates[index], name: `Copy of ${templates[index].name}`, index: index + 1 }
     const newTemplates = [...templates]
     newTemplates.splice(index + 1, 0, newTemplate)
-    Promise.all(
-      [...templates.slice(index + 1).map((template, idx) => editTemplate(idx + index + 1, { ...template, index: idx + index + 2})),
-        onSave(newTemplate)
-      ])
+    Promise.all([
+      patchTemplates('/api/v1/tournament/template/',
+        templates.slice(index + 1).map((template, idx) => ({ id: template.id, index: idx + index + 2 }))),
+      onSave(newTemplate)
+    ])
     .then(() => {
       setTemplates(newTemplates)
       setExpanded(index + 1)
@@ -156,12 +232,15 @@ function TournamentTemplates(props) {
 
   const [created, setCreated] = React.useState([])
   const [errors, setErrors] = React.useState([])
+  const [jobsVersion, setJobsVersion] = React.useState(0)
   const onCreated = (createdTournaments) => {
     const newCreated = Array.from(created);
     const newErrors = [];
-    Object.entries(createdTournaments.created).forEach(([templateId, result]) => {
-      const template = templates.find(t => t.id == templateId);
-      if (result.success) {
+    createdTournaments.plan.forEach(result => {
+      const template = templates.find(t => t.id == result.template);
+      if (result.queued || result.cancelled) {
+        return;
+      } else if (result.success) {
         newCreated.push({
           template: template,
           tournament: result
@@ -175,15 +254,15 @@ function TournamentTemplates(props) {
     });
     setCreated(newCreated);
     setErrors(newErrors);
+    setJobsVersion(jobsVersion + 1);
   }
 
   const [selected, setSelected] = React.useState(new Set());
   const onSelectedTournament = (tournament) => {
-    const s = new Set(selected);
-    if (!s.has(tournament))
+    // Pages are loaded again when paging, so tournaments are told apart by id
+    const s = new Set(Array.from(selected).filter(t => t.id != tournament.id));
+    if (s.size == selected.size)
       s.add(tournament);
-    else
-      s.delete(tournament);
     setSelected(s);
   }
 
@@ -192,9 +271,9 @@ function TournamentTemplates(props) {
   const onDragDrop = () => {
     const permutation = templatesDragDrop.onDragDrop()
     const newTemplates = permutation.map(({ index }, newIndex) => ({...templates[index], oldIndex: index, index: newIndex }))
-    Promise.all(newTemplates
+    patchTemplates('/api/v1/tournament/template/', newTemplates
       .filter(template => template.index !== template.oldIndex)
-      .map(template => editTemplate(template.oldIndex, template)))
+      .map(template => ({ id: template.id, index: template.index })))
     .then(() => setTemplates(newTemplates))
     .catch(() => setTemplates(templates))
   }
@@ -237,6 +316,9 @@ function TournamentTemplates(props) {
           templates: templates,
           onCreated: onCreated
         }),
+        e(CreationJobs, {
+          version: jobsVersion
+        }),
       ),
       e(CreatedTournaments, {
         newTournaments: created,
@@ -828,9 +910,11 @@ function TournamentCreation(props) {
   }, []);
 
   const [creating, setCreating] = React.useState(false);
+  const [progress, setProgress] = React.useState(null);
 
   let m = moment().utc().subtract(1, 'day').startOf('isoWeek');
   const [week, setWeek] = React.useState(m.valueOf());
+  const [numWeeks, setNumWeeks] = React.useState(1);
   const weeks = [];
   for (let i = 0; i < 6; i++) {
     weeks.push({
@@ -840,27 +924,50 @@ function TournamentCreation(props) {
     m.add(1, 'week');
   }
 
+  const followCreation = (operation) => {
+    setCreating(true);
+    let total = 0, done = 0;
+    return followOperation(operation, ['queued', 'created', 'failed', 'deferred', 'cancelled'], (event, data) => {
+      if (event == 'queued')
+        total = data.jobs.length;
+      else
+        done++;
+      setProgress(`${done} of ${total} tournaments processed`);
+    })
+      .then(operation => {
+        if (operation.status == 'done')
+          props.onCreated(operation.result);
+        else
+          alert(`Torunaments not created: ${operation.error}`);
+      })
+      .finally(() => {
+        setCreating(false);
+        setProgress(null);
+      });
+  }
+
+  React.useEffect(() => {
+    findRunningOperation('create').then(operation => operation && followCreation(operation.id));
+  }, []);
+
   const createTournaments = (selectedOnly) => {
     setCreating(true);
-    fetch(`/api/v1/tournament/create?_xsrf=${xsrf}`, {
-      credentials: 'include',
+    startOperation(`/api/v1/tournament/create?_xsrf=${xsrf}`, {
       method: 'POST',
       headers: {
         'Content-Type': 'appication/json'
       },
       body: JSON.stringify({
         week: week / 1000,
+        weeks: numWeeks,
         templates: selectedIds.length && selectedOnly ? selectedIds : undefined
       })
     })
-      .then(res => res.json())
-      .then(res => {
-        if (res.success)
-          props.onCreated(res);
-        else
-          alert(`Torunaments not created: ${res.error}`);
-      })
-      .finally(() => setCreating(false));
+      .then(followCreation)
+      .catch(error => {
+        alert(`Torunaments not created: ${error.message}`);
+        setCreating(false);
+      });
   }
 
   const pastTemplates = props.templates.reduce((a, t, index) => {
@@ -884,7 +991,18 @@ function TournamentCreation(props) {
       }, weeks.map(w => e('option', {
         value: w.week,
         key: w.week,
-      }, w.name)))),
+      }, w.name))),
+      e('label', {
+        htmlFor: 'creation_weeks'
+      }, " for "),
+      e('select', {
+        id: 'creation_weeks',
+        value: numWeeks,
+        onChange: (event) => setNumWeeks(parseInt(event.target.value))
+      }, weeks.map((w, index) => e('option', {
+        value: index + 1,
+        key: index,
+      }, `${index + 1} week${index > 0 ? 's' : ''}`)))),
     e('button', {
       disabled: props.templates.length == 0 || pastTemplates.size > 0 || creating,
       onClick: () => createTournaments(false)
@@ -894,44 +1012,130 @@ function TournamentCreation(props) {
       onClick: () => createTournaments(true)
     }, `Create ${selectedIds.length} tournament${selectedIds.length != 1 ? 's' : ''}  for selected templates`),
     pastTemplates.size > 0 ? e('p', { className: 'error' }, "Some tournaments for this week are already in the past") : null,
+    progress ? e('p', {}, progress) : null,
   )
 }
 
+// Tournaments waiting in the creation queue, usually for the Lichess daily
+// limit. Reloaded every minute while something is queued.
+function CreationJobs(props) {
+  const [jobs, setJobs] = React.useState([]);
+  const [quota, setQuota] = React.useState(null);
+  const [reload, setReload] = React.useState(0);
+
+  React.useEffect(() => {
+    fetch(`/api/v1/tournament/jobs`, {
+      credentials: 'include',
+    })
+      .then(res => res.json())
+      .then(res => {
+        if (res.success) {
+          setJobs(res.jobs.filter(job => job.status == 'queued'));
+          setQuota(res.quota);
+        }
+      })
+      .catch(() => null);
+  }, [props.version, reload]);
+
+  React.useEffect(() => {
+    if (jobs.length == 0)
+      return;
+    const timer = setTimeout(() => setReload(reload + 1), 60 * 1000);
+    return () => clearTimeout(timer);
+  }, [jobs, reload]);
+
+  const onCancel = (job) => {
+    fetch(`/api/v1/tournament/jobs/${job.id}?_xsrf=${xsrf}`, {
+      credentials: 'include',
+      method: 'DELETE'
+    }).then(() => setReload(reload + 1));
+  }
+
+  if (jobs.length == 0)
+    return null;
+  return e('div', { className: 'creation_jobs' },
+    e('h3', {}, "Waiting for creation:"),
+    quota ? e('p', {},
+      `Created today: ${quota.used.public}/${quota.limits.public} public, ` +
+      `${quota.used.private}/${quota.limits.private} private. ` +
+      `The limit resets ${moment.unix(quota.resets).fromNow()}.`) : null,
+    e('ol', { className: 'tournament_list' },
+      jobs.map(job => e('li', { key: job.id },
+        `${job.name} (${moment.unix(job.startTimestamp).format('lll')}), ` +
+        `next attempt ${moment.unix(job.notBefore).fromNow()} `,
+        job.error ? e('span', { className: 'error' }, `${job.error} `) : null,
+        e('a', { href: '#', onClick: (event) => { event.preventDefault(); onCancel(job); } }, "cancel")))))
+}
+
 function CreatedTournaments(props) {
   const pageSize = 16;
 
-  const [tournaments, setTournaments] = React.useState([]);
+  const initial = useBootstrap('tournaments');
+  const [tournaments, setTournaments] = React.useState(initial ? initial.tournaments : []);
   const [page, setPage] = React.useState(0);
-  const [loading, setLoading] = React.useState({ request: false, loading: true });
-  const [statsSheet, setStatsSheet] = React.useState(undefined)
+  // Cursors of the pages seen so far, the first page has none
+  const [cursors, setCursors] = React.useState(initial && initial.next ? ['', initial.next] : ['']);
+  const [loading, setLoading] = React.useState(!initial);
+  const [statsSheet, setStatsSheet] = React.useState(initial ? initial.stats.spreadsheet : undefined)
+  const [statsProgress, setStatsProgress] = React.useState(null)
+  // The first page came with the page itself
+  const bootstrapped = React.useRef(Boolean(initial));
 
-  React.useLayoutEffect(() => {
-    if (loading.request)
-      return
-    setLoading({ request: true, loading: true });
-    fetch(`/api/v1/tournament/last`, {
+  React.useEffect(() => {
+    if (bootstrapped.current) {
+      bootstrapped.current = false;
+      return;
+    }
+    setLoading(true);
+    const params = new URLSearchParams({ limit: pageSize });
+    if (cursors[page])
+      params.set('cursor', cursors[page]);
+    fetch(`/api/v1/tournament/last?${params}`, {
       credentials: 'include',
     })
       .then(res => res.json())
       .catch(() => null)
       .then(res => {
-        if (res.tournaments && res.success) {
+        if (res && res.success) {
           setTournaments(res.tournaments);
+          setCursors(cursors => cursors.slice(0, page + 1).concat(res.next ? [res.next] : []));
+          if (res.stats)
+            setStatsSheet(res.stats.spreadsheet);
         }
-        setStatsSheet(res.stats.spreadsheet)
-        setLoading({ request: true, loading: false });
+        setLoading(false);
       });
-  });
+  }, [page]);
+
+  const followStats = (operation) => {
+    setStatsProgress("Updating statistics");
+    return followOperation(operation, ['standings', 'sheets', 'written'], (event, data) => {
+      if (event == 'standings')
+        setStatsProgress(`Fetched standings of ${data.done} of ${data.total} tournaments`);
+      else
+        setStatsProgress("Writing the spreadsheet");
+    })
+      .then(operation => {
+        if (operation.status == 'done')
+          setStatsSheet(operation.result.spreadsheet);
+        else
+          alert(`Statistics not updated: ${operation.error}`);
+      })
+      .finally(() => setStatsProgress(null));
+  }
+
+  React.useEffect(() => {
+    findRunningOperation('stats').then(operation => operation && followStats(operation.id));
+  }, []);
 
   const generateTournamentStatistics = (event) => {
     event.preventDefault()
-    setLoading({ request: true, loading: true });
-    fetch(`/api/v1/tournament/stats`, {
-      credentials: 'include',
-    }).then(res => res.json()).then(res => {
-      setLoading({ request: true, loading: false })
-      setStatsSheet(res.spreadsheet)
-    })
+    setStatsProgress("Updating statistics");
+    startOperation(`/api/v1/tournament/stats`, {})
+      .then(followStats)
+      .catch(error => {
+        alert(`Statistics not updated: ${error.message}`);
+        setStatsProgress(null);
+      });
   }
 
   return e('div', {
@@ -940,7 +1144,8 @@ function CreatedTournaments(props) {
     e('h1', {}, "Created tournaments"),
     e('span', { key: 'stats', className: 'tournament_stats' },
       statsSheet != null ? [e('a', { key: 'stats', href: statsSheet.spreadsheetUrl, target: 'blank' }, "Statistics spreadsheet"), e('span', { key: 'lastUpdated' }, `Last updated: ${new Date(statsSheet.lastUpdated).toLocaleString()}`)] : "No statistics spreadsheet",
-      loading.loading ? null : e('a', { key: 'statsReload', href: '#', className: 'update_icon', onClick: generateTournamentStatistics })),
+      loading || statsProgress ? null : e('a', { key: 'statsReload', href: '#', className: 'update_icon', onClick: generateTournamentStatistics }),
+      statsProgress ? e('span', { key: 'statsProgress' }, statsProgress) : null),
     props.errors.length || props.newTournaments.length ? [
       e('h3', { key: 'header' }, "Recently created:"),
       e('ol', {
@@ -959,13 +1164,13 @@ function CreatedTournaments(props) {
       className: 'tournament_list',
       start: page * pageSize + 1
     },
-      loading.loading ? e(Loader, {}) : (tournaments.length == 0 ? "Nothing here" :
-        tournaments.slice(page * pageSize, (page + 1) * pageSize).map((t, index) => e(TorunamentLine, {
+      loading ? e(Loader, {}) : (tournaments.length == 0 ? "Nothing here" :
+        tournaments.map((t, index) => e(TorunamentLine, {
           key: t.id,
           tournament: t,
           highlight: t.success,
           selectable: true,
-          selected: props.selected.has(t),
+          selected: Array.from(props.selected).some(s => s.id == t.id),
           onSelected: () => props.onSelected(t)
         })))
     ),
@@ -976,7 +1181,7 @@ function CreatedTournaments(props) {
     }, "<"),
     e('button', {
       className: 'button_paging button_right',
-      disabled: (page + 1) * pageSize >= tournaments.length,
+      disabled: page + 1 >= cursors.length,
       onClick: () => setPage(page + 1)
     }, ">"),
   )
@@ -1013,8 +1218,10 @@ function TorunamentLine(props) {
 }
 
 function DiplomaTemplates(props) {
-  const [diplomas, setDiplomas] = React.useState([]);
-  const [loading, setLoading] = React.useState({ request: false, loading: true });
+  const initial = useBootstrap('diplomaTemplates');
+  const [diplomas, setDiplomas] = React.useState(initial || []);
+  const [loading, setLoading] = React.useState(initial ?
+    { request: true, loading: false } : { request: false, loading: true });
 
   React.useLayoutEffect(() => {
     if (loading.request)
@@ -1057,25 +1264,6 @@ function DiplomaTemplates(props) {
     window.location.href = `/diplomas/edit/${template.id}?${(new URLSearchParams(Array.from(props.selectedTournaments).map(tournament => ['u', getTournamentURL(tournament)]))).toString()}`;
   }
 
-  const editDiploma = (diploma) => {
-    return fetch(`/api/v1/diploma/template/${diploma.id}?_xsrf=${xsrf}`, {
-      credentials: 'include',
-      method: 'PATCH',
-      headers: {
-        'Content-Type': 'appication/json'
-      },
-      body: JSON.stringify(diploma)
-    })
-    .then(res => res.json())
-    .then(res => {
-      if (!res.success) {
-        console.error(res);
-        return;
-      }
-      return res;
-    })
-  }
-
   const onDuplicate = (index) => {
     fetch(`/api/v1/diploma/template/duplicate/${diplomas[index].id}?_xsrf=${xsrf}`, {
       credentials: 'include',
@@ -1090,13 +1278,12 @@ function DiplomaTemplates(props) {
         console.error(res);
         return;
       }
-      const newDiploma = { ...res.value, name: `Copy of ${res.value.name || 'Unnamed'}`}
+      const newDiploma = { ...res.value, name: `Copy of ${res.value.name || 'Unnamed'}`, index: index + 1 }
       const newDiplomas = [...diplomas]
       newDiplomas.splice(index + 1, 0, newDiploma)
-      Promise.all([
-        ...diplomas.slice(index + 1).map(
-          (diploma, idx) => editDiploma({...diploma, index: idx + index + 2})),
-          editDiploma(newDiploma)])
+      patchTemplates('/api/v1/diploma/template/', [
+        ...diplomas.slice(index + 1).map((diploma, idx) => ({ id: diploma.id, index: idx + index + 2 })),
+        { id: newDiploma.id, name: newDiploma.name, index: newDiploma.index }])
       .then( () => {
         setDiplomas(newDiplomas)
       })
@@ -1110,12 +1297,11 @@ function DiplomaTemplates(props) {
   const onDragDrop = () => {
     const permutation = diplomaDragDrop.onDragDrop()
     const newDiplomas = permutation.map(({ index }, newIndex) => ({...diplomas[index], oldIndex: index, index: newIndex }))
-    Promise.all(
-      newDiplomas
-        .filter(template => template.index !== template.oldIndex)
-        .map(template => editDiploma(template)))
+    patchTemplates('/api/v1/diploma/template/', newDiplomas
+      .filter(template => template.index !== template.oldIndex)
+      .map(template => ({ id: template.id, index: template.index })))
     .then(() => setDiplomas(newDiplomas))
-    .catch(() => setDiplomas(templates))
+    .catch(() => setDiplomas(diplomas))
   }
 
   return e('div', {
@@ -1166,6 +1352,9 @@ function Loader(props) {
 }
 
 document.addEventListener('DOMContentLoaded', () => {
+  const data = document.querySelector('#bootstrap');
+  if (data)
+    bootstrap = JSON.parse(data.textContent);
   const domContainer = document.querySelector('#tournament_templates');
   ReactDOM.render(
     e(React.StrictMode, {}, e(TournamentTemplates, {})), domContainer)
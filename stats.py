@@ -1,60 +1,113 @@
 from datetime import datetime
 import calendar
 import logging
+from asyncio import Semaphore, gather
 from json import dumps
-from typing import Any, Dict, List, cast
+from typing import Any, Dict, List, Optional, Tuple, cast
 from lichessapi import LichessError
 
-from tinydb import Query
 import tornado
+from tornado.web import HTTPError
 
 from basehandler import BaseAPIHandler
-from googleapi import create_sheet, write_values
+from dataio import run_blocking
+from operations import Progress, no_progress, start_operation, wants_async
+from googleapi import client as google_client, add_sheets, write_ranges
+from storage import Document, at_least
+from aggregates import read_leaderboard, read_monthly_stats, store_standings
 
 
 def get_tournament_url(tournament: Dict[str, Any]) -> str:
     return f'https://lichess.org/{"tournament" if tournament.get("system", "swiss") == "arena" else "swiss"}/{tournament["id"]}'
 
 
+def column_name(index: int) -> str:
+    name = ''
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        name = chr(ord('A') + rem) + name
+    return name
+
+
+# Ranges covering the rows that differ from the previous export. Changed
+# rows are padded to their previous width so stale cells get cleared.
+def get_changed_ranges(sheetName: str, rows: List[List[Any]],
+                       previous: List[List[Any]]) -> Dict[str, List[List[Any]]]:
+    ranges: Dict[str, List[List[Any]]] = {}
+    height = max(len(rows), len(previous))
+    block: List[List[Any]] = []
+    for i in range(height + 1):
+        row = rows[i] if i < len(rows) else []
+        old = previous[i] if i < len(previous) else []
+        if i < height and row != old:
+            block.append(row + [''] * (len(old) - len(row)))
+            continue
+        if block:
+            width = max(len(r) for r in block)
+            ranges[f"'{sheetName}'!A{i - len(block) + 1}:{column_name(width)}{i}"] = block
+            block = []
+    return ranges
+
+
 class TournamentStatsHandlerBase(BaseAPIHandler):
-    async def enrich_tournaments_with_standings(self, tournaments: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        T = Query()
+    async def fetch_standings(self, tournament: Dict[str, Any]) -> Dict[str, Any]:
+        tournament_type = tournament.get('system', 'swiss')
+        try:
+            if tournament_type == 'arena':
+                lichess_tournament = await self.lichess.get_tournament(
+                    self.token, tournament_type, tournament['id'])
+                if lichess_tournament is not None:
+                    return cast(Dict[str, Any], lichess_tournament['standing'])
+            else:
+                return {
+                    'players':
+                    (await self.lichess.get_swiss_standings(
+                        self.token, tournament['id'], 10)) or []
+                }
+        except LichessError as e:
+            # Other errors are reported by enrich_tournaments_with_standings
+            # without storing anything, so the next export asks again
+            if e.code != 404:
+                raise
+        logging.warning(f"Tournament was deleted {tournament['id']}")
+        return {'players': []}
+
+    async def enrich_tournaments_with_standings(
+            self, tournaments: List[Dict[str, Any]],
+            progress: Progress = no_progress) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
         force_refresh = self.get_argument('refresh', '')
-        table = self.db.table('tournaments')
-        for tournament in tournaments:
-            tournament_type = tournament.get('system', 'swiss')
-            # Sometimes lichess returns a single player instead of full standings
-            # refreshing always if we have <3 players in the saved standings
-            if force_refresh or 'standings' not in tournament or len(tournament['standings'].get('players', [])) < 3:
-                if tournament_type == 'arena':
-                    try:
-                        lichess_tournament = await self.lichess.get_tournament(
-                            self.token, tournament_type, tournament['id'])
-                        if lichess_tournament is None:
-                            logging.warning(
-                                f"Tournament was deleted {tournament['id']}")
-                            standings = {'players': []}
-                        else:
-                            standings = lichess_tournament['standing']
-                    except LichessError:
-                        logging.warning(
-                            f"Tournament was deleted {tournament['id']}")
-                        standings = {'players': []}
-                elif tournament_type == 'swiss':
-                    try:
-                        standings = {
-                            'players':
-                            (await self.lichess.get_swiss_standings(
-                                self.token, tournament['id'], 10)) or []
-                        }
-                    except LichessError:
-                        logging.warning(
-                            f"Tournament was deleted {tournament['id']}")
-                        standings = {'players': []}
-                if 'doc_id' in tournament:
-                    table.update({'standings': standings}, T.id == tournament['id'])
-                tournament['standings'] = standings
-        return tournaments
+        # Sometimes lichess returns a single player instead of full standings
+        # refreshing always if we have <3 players in the saved standings
+        stale = [
+            tournament for tournament in tournaments
+            if force_refresh or 'standings' not in tournament or len(tournament['standings'].get('players', [])) < 3]
+        semaphore = Semaphore(self.options.standings_concurrency)
+
+        async def fetch(tournament: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                standings = await self.fetch_standings(tournament)
+            progress('standings', tournament=tournament['id'], players=len(standings.get('players', [])),
+                     done=len(done) + 1, total=len(stale))
+            done.append(tournament['id'])
+            return standings
+
+        done: List[str] = []
+
+        results = await gather(*[fetch(tournament) for tournament in stale], return_exceptions=True)
+        errors: Dict[str, str] = {}
+        for tournament, standings in zip(stale, results):
+            if isinstance(standings, BaseException):
+                logging.error(f"Cannot fetch standings for {tournament['id']}: {standings!r}")
+                errors[tournament['id']] = str(standings) or type(standings).__name__
+                continue
+            tournament['standings'] = standings
+            tournament.pop('stats_applied', None)
+        # Stored tournaments contribute to the monthly aggregates once their
+        # standings are saved, and again only when the standings are replaced
+        await run_blocking(store_standings, self.db, [
+            tournament for tournament in tournaments
+            if isinstance(tournament, Document) and 'standings' in tournament and 'stats_applied' not in tournament])
+        return [tournament for tournament in tournaments if 'standings' in tournament], errors
 
     def consolidate_stats_by_month(self, year: int, tournaments: List[Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, Any]]]:
         statsByMonth: Dict[str, Dict[str, Dict[str, Any]]] = {}
@@ -91,13 +144,22 @@ class TournamentStatsHandlerBase(BaseAPIHandler):
 
 
 class TournamentStatsHandler(TournamentStatsHandlerBase):
+    # With "Prefer: respond-async" the export runs as an operation whose
+    # progress can be followed at /api/v1/operations/<id>/events
     @tornado.web.authenticated  # type: ignore[misc]
     async def get(self) -> None:
-        T = Query()
+        if wants_async(self):
+            await start_operation(self, 'stats', lambda operation: self.export_stats(operation.emit))
+            return
+        self.write(dumps(await self.export_stats()))
+
+    async def export_stats(self, progress: Progress = no_progress) -> Dict[str, Any]:
+        round_trips = google_client.round_trips
         spreadsheet = await self.get_stat_spreadsheet_for_user(
             create_if_absent=True)
         assert spreadsheet is not None
         spreadsheetId = spreadsheet['spreadsheetId']
+        progress('spreadsheet', spreadsheetId=spreadsheetId)
         now = datetime.utcnow()
         if now.month == 1:
             year = now.year - 1
@@ -105,22 +167,33 @@ class TournamentStatsHandler(TournamentStatsHandlerBase):
         else:
             year = now.year
             month = now.month - 1
-        startOfLastMonth = datetime(year=year, month=month, day=1)
-        logging.debug(f"Tournaments from {startOfLastMonth}")
-        table = self.db.table('tournaments')
-        tournaments = table.search(
-            (T.user == self.current_user['id'])
-            & (T.tournament_set == 'default')
-            & (T.startTimestamp >= int(startOfLastMonth.timestamp())))
-
-        tournaments = await self.enrich_tournaments_with_standings(tournaments)
-
-        statsByMonth = self.consolidate_stats_by_month(year, tournaments)
-        sheets = spreadsheet['sheets']
+        errors: Dict[str, str] = {}
+        # Standings of finished tournaments are collected in the background
+        # by the harvester, only a forced refresh fetches them here
+        if self.get_argument('refresh', ''):
+            startOfLastMonth = datetime(year=year, month=month, day=1)
+            logging.debug(f"Tournaments from {startOfLastMonth}")
+            tournaments = await self.async_db.table('tournaments').search(
+                user=self.current_user['id'],
+                tournament_set='default',
+                startTimestamp=at_least(int(startOfLastMonth.timestamp())))
+            tournaments, errors = await self.enrich_tournaments_with_standings(tournaments, progress)
+
+        months = [f'{year}-{month:02}', now.strftime('%Y-%m')]
+        monthlyStats = await run_blocking(read_monthly_stats, self.db, self.current_user['id'], months)
+        statsByMonth = {
+            f"{month[:4]} {calendar.month_abbr[int(month[5:])]}": stats
+            for month, stats in monthlyStats.items() if stats}
+        existingSheets = set(sheet['properties']['title'] for sheet in spreadsheet['sheets'])
+        newSheets = [sheetName for sheetName in statsByMonth if sheetName not in existingSheets]
+        exports = self.async_db.table('stats_exports')
+        previousRows = {} if self.get_argument('refresh', '') else {
+            export['sheet']: export['rows']
+            for export in await exports.search(user=self.current_user['id'], spreadsheet=spreadsheetId)
+            if export['sheet'] in existingSheets}
+        ranges: Dict[str, List[List[Any]]] = {}
+        sheetRows: Dict[str, List[List[Any]]] = {}
         for sheetName in statsByMonth:
-            if not any(sheet['properties']['title'] == sheetName
-                       for sheet in sheets):
-                await create_sheet(spreadsheetId, sheetName)
             titleRow = [
                 'Player id', 'Points', 'Wins', 'Wins with >= 10 players',
                 'Podiums', 'Won tournaments'
@@ -135,15 +208,28 @@ class TournamentStatsHandler(TournamentStatsHandlerBase):
                 f'=HYPERLINK("{get_tournament_url(tournament)}", "{tournament.get("fullName", tournament.get("name", tournament.get("id")))}")'
                 for tournament in stats['wonTournaments']
             ] for (playerId, stats) in statsByMonth[sheetName].items())
-            rowsCount = len(rows) + 1
-            colsCount = max(len(row) for row in rows)
-            await write_values(
-                spreadsheetId,
-                f'{sheetName}!A1:{chr(ord("A") + colsCount - 1)}{rowsCount}',
-                rows)
+            changed = get_changed_ranges(sheetName, rows, previousRows.get(sheetName, []))
+            if changed:
+                ranges.update(changed)
+                sheetRows[sheetName] = rows
+        await add_sheets(spreadsheetId, newSheets)
+        if newSheets:
+            progress('sheets', added=newSheets)
+        await write_ranges(spreadsheetId, ranges)
+        progress('written', sheets=list(sheetRows), ranges=len(ranges))
+        for sheetName, rows in sheetRows.items():
+            await exports.upsert({
+                'user': self.current_user['id'],
+                'spreadsheet': spreadsheetId,
+                'sheet': sheetName,
+                'rows': rows
+            }, user=self.current_user['id'], spreadsheet=spreadsheetId, sheet=sheetName)
         spreadsheet['lastUpdated'] = (await
                                       self.on_stats_updated())
-        self.write(dumps({'spreadsheet': spreadsheet}))
+        logging.info(
+            f"Stats for {self.current_user['id']} refreshed with "
+            f"{google_client.round_trips - round_trips} Google API round trips")
+        return {'spreadsheet': spreadsheet, 'errors': errors}
 
 
 class TournamentStatsDebugHandler(TournamentStatsHandlerBase):
@@ -156,6 +242,27 @@ class TournamentStatsDebugHandler(TournamentStatsHandlerBase):
         for tournament in tournaments:
             lichess_tournament = await self.lichess.get_tournament(self.token, tournament['system'], tournament['id'])
             tournament['startTimestamp'] = datetime.fromisoformat(lichess_tournament['startsAt']).timestamp()
-        tournaments = await self.enrich_tournaments_with_standings(tournaments)
+        tournaments, errors = await self.enrich_tournaments_with_standings(tournaments)
         stats = self.consolidate_stats_by_month(datetime.utcnow().year, tournaments)
-        self.write(dumps({'tournaments': tournaments, 'stats': stats}))
+        self.write(dumps({'tournaments': tournaments, 'stats': stats, 'errors': errors}))
+
+
+class TournamentLeaderboardHandler(BaseAPIHandler):
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self) -> None:
+        period = self.get_argument('period', 'ytd')
+        now = datetime.utcnow()
+        if period == 'ytd':
+            months: Optional[List[str]] = [f'{now.year}-{month:02}' for month in range(1, now.month + 1)]
+        elif period == 'all':
+            months = None
+        else:
+            try:
+                months = [datetime.strptime(period, '%Y-%m').strftime('%Y-%m')]
+            except ValueError:
+                raise HTTPError(400, f"Invalid period \"{period}\"")
+        self.write(dumps({
+            'success': True,
+            'period': period,
+            'players': await run_blocking(read_leaderboard, self.db, self.current_user['id'], months)
+        }))
@@ -0,0 +1,782 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from os.path import dirname, exists, getsize, join as path_join
+from time import monotonic, sleep
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, cast
+
+from tinydb import TinyDB, Query
+from tinydb.queries import QueryInstance
+
+
+class Document(Dict[str, Any]):
+    def __init__(self, value: Dict[str, Any], doc_id: int) -> None:
+        super().__init__(value)
+        self.doc_id = doc_id
+
+
+class Condition(NamedTuple):
+    op: str
+    value: Any
+
+
+def one_of(values: Iterable[Any]) -> Condition:
+    return Condition('in', tuple(values))
+
+
+def at_least(value: Any) -> Condition:
+    return Condition('>=', value)
+
+
+def at_most(value: Any) -> Condition:
+    return Condition('<=', value)
+
+
+def between(low: Any, high: Any) -> Condition:
+    return Condition('between', (low, high))
+
+
+# Matches documents where the field is missing or null
+def is_null() -> Condition:
+    return Condition('null', None)
+
+
+# Handlers only ever filter documents by a conjunction of field conditions, so
+# the storage interface is expressed in terms of keyword arguments:
+#   table.search(user=user_id, tournament_set='default', id=one_of(ids))
+class Table(ABC):
+    @abstractmethod
+    def search(self, **where: Any) -> List[Document]:
+        ...
+
+    def get(self, **where: Any) -> Optional[Document]:
+        found = self.search(**where)
+        return found[0] if found else None
+
+    def contains(self, **where: Any) -> bool:
+        return self.get(**where) is not None
+
+    # At most limit documents ordered by a field and then by doc_id, with
+    # documents missing the field first. A page continues after the
+    # (value, doc_id) key of the last document of the previous page.
+    def search_page(self, order_by: str, limit: int, after: Optional[Tuple[Any, int]] = None,
+                    descending: bool = False, **where: Any) -> List[Document]:
+        def key(value: Any, doc_id: int) -> Tuple[bool, Any, int]:
+            return value is not None, value, doc_id
+
+        def document_key(document: Document) -> Tuple[bool, Any, int]:
+            return key(document.get(order_by), document.doc_id)
+        found = sorted(self.search(**where), key=document_key, reverse=descending)
+        if after is not None:
+            last = key(*after)
+            found = [d for d in found if (document_key(d) < last if descending else document_key(d) > last)]
+        return found[:limit]
+
+    @abstractmethod
+    def insert(self, document: Dict[str, Any]) -> int:
+        ...
+
+    def insert_multiple(self, documents: Iterable[Dict[str, Any]]) -> List[int]:
+        return [self.insert(document) for document in documents]
+
+    @abstractmethod
+    def update(self, fields: Dict[str, Any], **where: Any) -> int:
+        ...
+
+    # Applies several (fields, where) updates with a single write
+    def update_multiple(self, updates: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]) -> int:
+        return sum(self.update(fields, **where) for fields, where in updates)
+
+    @abstractmethod
+    def upsert(self, document: Dict[str, Any], **where: Any) -> None:
+        ...
+
+    @abstractmethod
+    def remove(self, **where: Any) -> int:
+        ...
+
+
+class Storage(ABC):
+    TABLES = ('users', 'templates', 'tournaments', 'diploma_templates', 'stats_exports',
+              'stats_monthly', 'data_versions', 'harvester', 'sessions', 'creation_jobs', 'creation_quota',
+              'operations', 'operation_events', 'tokens')
+    # Whether several processes may open the same storage at once
+    MULTIPROCESS = False
+
+    @abstractmethod
+    def table(self, name: str) -> Table:
+        ...
+
+    # Reads and writes of the calling thread inside the block see no change
+    # made by anyone else meanwhile, for read-modify-writes spanning several
+    # calls or tables
+    @abstractmethod
+    def transaction(self) -> ContextManager[Any]:
+        ...
+
+    def close(self) -> None:
+        pass
+
+
+# TinyDB is not thread safe, every table of a storage shares its lock
+class TinyDBTable(Table):
+    def __init__(self, table: Any, lock: threading.RLock) -> None:
+        self._table = table
+        self._lock = lock
+
+    @staticmethod
+    def _query(where: Dict[str, Any]) -> QueryInstance:
+        assert where, "Empty condition"
+        T = Query()
+        query: Optional[QueryInstance] = None
+        for field, value in where.items():
+            if isinstance(value, Condition):
+                if value.op == 'in':
+                    q = T[field].one_of(list(value.value))
+                elif value.op == '>=':
+                    q = T[field] >= value.value
+                elif value.op == '<=':
+                    q = T[field] <= value.value
+                elif value.op == 'between':
+                    q = (T[field] >= value.value[0]) & (T[field] <= value.value[1])
+                elif value.op == 'null':
+                    q = ~T[field].exists() | (T[field] == None)  # noqa: E711
+                else:
+                    raise ValueError(f"Unknown condition {value.op}")
+            else:
+                q = T[field] == value
+            query = q if query is None else query & q
+        assert query is not None
+        return query
+
+    def search(self, **where: Any) -> List[Document]:
+        with self._lock:
+            found = self._table.search(self._query(where)) if where else self._table.all()
+        return [Document(d, d.doc_id) for d in found]
+
+    def insert(self, document: Dict[str, Any]) -> int:
+        with self._lock:
+            return int(self._table.insert(document))
+
+    def insert_multiple(self, documents: Iterable[Dict[str, Any]]) -> List[int]:
+        with self._lock:
+            return list(self._table.insert_multiple(documents))
+
+    def update(self, fields: Dict[str, Any], **where: Any) -> int:
+        with self._lock:
+            return len(self._table.update(fields, self._query(where)))
+
+    def update_multiple(self, updates: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]) -> int:
+        queries = [(fields, self._query(where)) for fields, where in updates]
+        with self._lock:
+            return len(self._table.update_multiple(queries)) if queries else 0
+
+    def upsert(self, document: Dict[str, Any], **where: Any) -> None:
+        with self._lock:
+            self._table.upsert(document, self._query(where))
+
+    def remove(self, **where: Any) -> int:
+        with self._lock:
+            return len(self._table.remove(self._query(where)))
+
+
+class TinyDBStorage(Storage):
+    def __init__(self, path: str) -> None:
+        self.db = TinyDB(path)
+        self.lock = threading.RLock()
+
+    def table(self, name: str) -> Table:
+        with self.lock:
+            return TinyDBTable(self.db.table(name), self.lock)
+
+    def transaction(self) -> ContextManager[Any]:
+        return self.lock
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+_IDENTIFIER = re.compile(r'[A-Za-z0-9_.]+')
+
+
+def _field(name: str) -> str:
+    if not _IDENTIFIER.fullmatch(name):
+        raise ValueError(f"Invalid field name {name}")
+    return f"json_extract(doc, '$.\"{name}\"')"
+
+
+# Writes take the database lock when the transaction starts. With deferred
+# transactions the read of a read-modify-write could see data another
+# process changes before the write, and upgrading the lock would fail.
+# Inside Storage.transaction() statements join the open transaction.
+@contextmanager
+def _transaction(connection: sqlite3.Connection) -> Iterator[None]:
+    if connection.in_transaction:
+        yield
+        return
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+class SQLiteTable(Table):
+    # Index expressions must match the ones produced by _field() exactly,
+    # otherwise SQLite will not use them
+    INDEXES: Dict[str, Tuple[Tuple[str, ...], ...]] = {
+        'users': (('id',),),
+        'templates': (('id',), ('user', 'tournament_set')),
+        'tournaments': (
+            ('id',),
+            ('user', 'tournament_set'),
+            ('user', 'tournament_set', 'template', 'startTimestamp'),
+            ('user', 'tournament_set', 'created'),
+            ('standings_final', 'startTimestamp')),
+        'diploma_templates': (('id',), ('user',)),
+        'stats_exports': (('user', 'spreadsheet'),),
+        'stats_monthly': (('user', 'month', 'player'),),
+        'data_versions': (('user',),),
+        'harvester': (('id',),),
+        'sessions': (('id',), ('expires',)),
+        'creation_jobs': (('id',), ('status', 'not_before'), ('user', 'status'), ('user', 'finished')),
+        'creation_quota': (('user', 'day'),),
+        'operations': (('id',), ('user', 'kind'), ('updated',)),
+        'operation_events': (('operation', 'seq'),),
+        'tokens': (('user',),),
+    }
+
+    def __init__(self, storage: 'SQLiteStorage', name: str) -> None:
+        if not _IDENTIFIER.fullmatch(name) or '.' in name:
+            raise ValueError(f"Invalid table name {name}")
+        self.name = name
+        self._storage = storage
+        with _transaction(self._db):
+            self._db.execute(
+                f'CREATE TABLE IF NOT EXISTS "{name}" ('
+                'doc_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'doc TEXT NOT NULL)')
+            for fields in self.INDEXES.get(name, ()):
+                self._db.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{name}_{"_".join(fields)}" '
+                    f'ON "{name}" ({", ".join(_field(f) for f in fields)})')
+
+    # The connection of the calling thread
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self._storage.connection
+
+    @staticmethod
+    def _where(where: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        if not where:
+            return '', []
+        clauses = []
+        params: List[Any] = []
+        for field, value in where.items():
+            if isinstance(value, Condition):
+                if value.op == 'in':
+                    clauses.append(f'{_field(field)} IN ({", ".join("?" * len(value.value))})')
+                    params.extend(value.value)
+                elif value.op == '>=':
+                    clauses.append(f'{_field(field)} >= ?')
+                    params.append(value.value)
+                elif value.op == '<=':
+                    clauses.append(f'{_field(field)} <= ?')
+                    params.append(value.value)
+                elif value.op == 'between':
+                    clauses.append(f'{_field(field)} BETWEEN ? AND ?')
+                    params.extend(value.value)
+                elif value.op == 'null':
+                    clauses.append(f'{_field(field)} IS NULL')
+                else:
+                    raise ValueError(f"Unknown condition {value.op}")
+            else:
+                clauses.append(f'{_field(field)} = ?')
+                params.append(value)
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def _select(self, where: Dict[str, Any], limit: Optional[int] = None) -> List[Document]:
+        clause, params = self._where(where)
+        sql = f'SELECT doc_id, doc FROM "{self.name}"{clause} ORDER BY doc_id'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return [Document(json.loads(doc), doc_id) for doc_id, doc in self._db.execute(sql, params)]
+
+    def search(self, **where: Any) -> List[Document]:
+        return self._select(where)
+
+    # Ordered like the index on the where fields followed by order_by, so
+    # SQLite reads the page straight from the index and stops at the limit
+    def search_page(self, order_by: str, limit: int, after: Optional[Tuple[Any, int]] = None,
+                    descending: bool = False, **where: Any) -> List[Document]:
+        clause, params = self._where(where)
+        field = _field(order_by)
+        if after is not None:
+            value, doc_id = after
+            if value is None:
+                keyset = (f'({field} IS NULL AND doc_id < ?)' if descending
+                          else f'({field} IS NOT NULL OR doc_id > ?)')
+                keyset_params: List[Any] = [doc_id]
+            elif descending:
+                keyset = f'({field} < ? OR ({field} = ? AND doc_id < ?) OR {field} IS NULL)'
+                keyset_params = [value, value, doc_id]
+            else:
+                keyset = f'({field} > ? OR ({field} = ? AND doc_id > ?))'
+                keyset_params = [value, value, doc_id]
+            clause = f'{clause} AND {keyset}' if clause else f' WHERE {keyset}'
+            params += keyset_params
+        direction = 'DESC' if descending else 'ASC'
+        sql = (f'SELECT doc_id, doc FROM "{self.name}"{clause} '
+               f'ORDER BY {field} {direction}, doc_id {direction} LIMIT {int(limit)}')
+        return [Document(json.loads(doc), doc_id) for doc_id, doc in self._db.execute(sql, params)]
+
+    def get(self, **where: Any) -> Optional[Document]:
+        found = self._select(where, limit=1)
+        return found[0] if found else None
+
+    def insert(self, document: Dict[str, Any]) -> int:
+        with _transaction(self._db):
+            cursor = self._db.execute(f'INSERT INTO "{self.name}" (doc) VALUES (?)', (json.dumps(document),))
+        return int(cursor.lastrowid or 0)
+
+    def insert_multiple(self, documents: Iterable[Dict[str, Any]]) -> List[int]:
+        ids = []
+        with _transaction(self._db):
+            for document in documents:
+                cursor = self._db.execute(f'INSERT INTO "{self.name}" (doc) VALUES (?)', (json.dumps(document),))
+                ids.append(int(cursor.lastrowid or 0))
+        return ids
+
+    def _update(self, fields: Dict[str, Any], where: Dict[str, Any]) -> int:
+        found = self._select(where)
+        for document in found:
+            document.update(fields)
+            self._db.execute(
+                f'UPDATE "{self.name}" SET doc = ? WHERE doc_id = ?',
+                (json.dumps(document), document.doc_id))
+        return len(found)
+
+    def update(self, fields: Dict[str, Any], **where: Any) -> int:
+        assert where, "Empty condition"
+        with _transaction(self._db):
+            return self._update(fields, where)
+
+    def update_multiple(self, updates: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]) -> int:
+        count = 0
+        with _transaction(self._db):
+            for fields, where in updates:
+                assert where, "Empty condition"
+                count += self._update(fields, where)
+        return count
+
+    def upsert(self, document: Dict[str, Any], **where: Any) -> None:
+        assert where, "Empty condition"
+        with _transaction(self._db):
+            if not self._update(document, where):
+                self._db.execute(f'INSERT INTO "{self.name}" (doc) VALUES (?)', (json.dumps(document),))
+
+    def remove(self, **where: Any) -> int:
+        assert where, "Empty condition"
+        clause, params = self._where(where)
+        with _transaction(self._db):
+            cursor = self._db.execute(f'DELETE FROM "{self.name}"{clause}', params)
+        return cursor.rowcount
+
+
+# Safe for several server processes sharing the database file: WAL lets
+# readers run alongside a writer and writers wait for each other for up to
+# BUSY_TIMEOUT seconds. Threads of a process each get their own connection
+# the same way, the connections are closed by whichever thread closes the
+# storage.
+class SQLiteStorage(Storage):
+    MULTIPROCESS = True
+    BUSY_TIMEOUT = 30
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._tables: Dict[str, SQLiteTable] = {}
+        # Fails right away when the database cannot be opened
+        self.connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection: Optional[sqlite3.Connection] = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def table(self, name: str) -> Table:
+        with self._lock:
+            if name in self._tables:
+                return self._tables[name]
+        table = SQLiteTable(self, name)
+        with self._lock:
+            return self._tables.setdefault(name, table)
+
+    def transaction(self) -> ContextManager[Any]:
+        return _transaction(self.connection)
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
+def _matches(document: Dict[str, Any], where: Dict[str, Any]) -> bool:
+    for field, value in where.items():
+        actual = document.get(field)
+        if not isinstance(value, Condition):
+            if actual != value:
+                return False
+        elif value.op == 'null':
+            if actual is not None:
+                return False
+        elif value.op not in ('in', '>=', '<=', 'between'):
+            raise ValueError(f"Unknown condition {value.op}")
+        else:
+            try:
+                if actual is None or not (actual in value.value if value.op == 'in' else
+                                          actual >= value.value if value.op == '>=' else
+                                          actual <= value.value if value.op == '<=' else
+                                          value.value[0] <= actual <= value.value[1]):
+                    return False
+            except TypeError:
+                return False
+    return True
+
+
+class JournalTable(Table):
+    # Documents are kept both parsed, for matching, and as JSON, which is
+    # what goes to the journal and what every read is parsed from so callers
+    # never share objects with the table. The leading fields of the SQLite
+    # indexes are indexed by value for equality and one_of conditions.
+    def __init__(self, storage: 'JournalStorage', name: str) -> None:
+        self.storage = storage
+        self.name = name
+        self.next_id = 1
+        self.rows: Dict[int, Tuple[Dict[str, Any], str]] = {}
+        self._indexes: Dict[str, Dict[Any, Set[int]]] = {
+            fields[0]: {} for fields in SQLiteTable.INDEXES.get(name, ())}
+
+    def _index(self, doc_id: int, document: Dict[str, Any], add: bool) -> None:
+        for field, index in self._indexes.items():
+            value = document.get(field)
+            try:
+                ids = index.setdefault(value, set()) if add else index.get(value, set())
+            except TypeError:
+                continue
+            if add:
+                ids.add(doc_id)
+            else:
+                ids.discard(doc_id)
+                if not ids:
+                    index.pop(value, None)
+
+    # Rows stay in doc_id order, updated rows keep their place
+    def _set(self, doc_id: int, text: str, document: Optional[Dict[str, Any]] = None) -> None:
+        if doc_id in self.rows:
+            self._index(doc_id, self.rows[doc_id][0], False)
+        document = json.loads(text) if document is None else document
+        self.rows[doc_id] = (document, text)
+        self._index(doc_id, document, True)
+
+    def _delete(self, doc_id: int) -> None:
+        old = self.rows.pop(doc_id, None)
+        if old is not None:
+            self._index(doc_id, old[0], False)
+
+    def _candidates(self, where: Dict[str, Any]) -> Iterable[int]:
+        for field, value in where.items():
+            if field not in self._indexes or (isinstance(value, Condition) and value.op not in ('in', 'null')):
+                continue
+            # Missing fields are indexed as None
+            values = (None,) if isinstance(value, Condition) and value.op == 'null' else \
+                value.value if isinstance(value, Condition) else (value,)
+            index = self._indexes[field]
+            try:
+                return sorted(set().union(*(index.get(v, ()) for v in values)))
+            except TypeError:
+                continue
+        return list(self.rows)
+
+    def _find(self, where: Dict[str, Any]) -> Iterator[int]:
+        return (doc_id for doc_id in self._candidates(where) if _matches(self.rows[doc_id][0], where))
+
+    def search(self, **where: Any) -> List[Document]:
+        with self.storage.lock:
+            return [Document(json.loads(self.rows[doc_id][1]), doc_id) for doc_id in self._find(where)]
+
+    def get(self, **where: Any) -> Optional[Document]:
+        with self.storage.lock:
+            doc_id = next(self._find(where), None)
+            return Document(json.loads(self.rows[doc_id][1]), doc_id) if doc_id is not None else None
+
+    def _insert(self, document: Dict[str, Any], changes: List[Tuple[int, str]]) -> int:
+        doc_id = self.next_id
+        self.next_id += 1
+        text = json.dumps(document)
+        self._set(doc_id, text)
+        changes.append((doc_id, text))
+        return doc_id
+
+    def insert(self, document: Dict[str, Any]) -> int:
+        return self.insert_multiple([document])[0]
+
+    def insert_multiple(self, documents: Iterable[Dict[str, Any]]) -> List[int]:
+        changes: List[Tuple[int, str]] = []
+        with self.storage.lock:
+            ids = [self._insert(document, changes) for document in documents]
+            self.storage.log(self, changes)
+        return ids
+
+    def _update(self, fields: Dict[str, Any], where: Dict[str, Any], changes: List[Tuple[int, str]]) -> int:
+        assert where, "Empty condition"
+        found = list(self._find(where))
+        for doc_id in found:
+            text = json.dumps({**self.rows[doc_id][0], **fields})
+            self._set(doc_id, text)
+            changes.append((doc_id, text))
+        return len(found)
+
+    def update(self, fields: Dict[str, Any], **where: Any) -> int:
+        return self.update_multiple([(fields, where)])
+
+    def update_multiple(self, updates: Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]) -> int:
+        changes: List[Tuple[int, str]] = []
+        with self.storage.lock:
+            count = sum(self._update(fields, where, changes) for fields, where in updates)
+            self.storage.log(self, changes)
+        return count
+
+    def upsert(self, document: Dict[str, Any], **where: Any) -> None:
+        changes: List[Tuple[int, str]] = []
+        with self.storage.lock:
+            if not self._update(document, where, changes):
+                self._insert(document, changes)
+            self.storage.log(self, changes)
+
+    def remove(self, **where: Any) -> int:
+        assert where, "Empty condition"
+        with self.storage.lock:
+            removed = list(self._find(where))
+            for doc_id in removed:
+                self._delete(doc_id)
+            self.storage.log(self, [], removed)
+        return len(removed)
+
+
+# The documents of a table one change set and removed, built from the JSON
+# of the documents. Table names are identifiers and need no escaping.
+def _journal_line(table: str, next_id: int, changes: List[Tuple[int, str]], removed: List[int]) -> str:
+    documents = ', '.join(f'[{doc_id}, {text}]' for doc_id, text in changes)
+    return f'{{"t": "{table}", "next": {next_id}, "set": [{documents}], "del": {json.dumps(removed)}}}\n'
+
+
+# Keeps every document in memory and writes changes behind to an append-only
+# journal. A background thread commits the changes of all tables together
+# every commit_interval seconds, or as soon as commit_batch changes wait, and
+# fsyncs the journal, so a crash loses at most the last commit_interval
+# seconds of changes. Each line of the journal holds the documents one call
+# set and removed and is replayed on startup on top of the snapshot. Once the
+# journal is larger than both compact_bytes and the snapshot the thread
+# writes a new snapshot and starts the journal over.
+class JournalStorage(Storage):
+    def __init__(self, path: str, commit_interval: float = 0.1, commit_batch: int = 256,
+                 compact_bytes: int = 16 * 1024 * 1024) -> None:
+        self.path = path
+        self.snapshot_path = f'{path}.snapshot'
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self._changed = threading.Condition(self.lock)
+        self._tables: Dict[str, JournalTable] = {}
+        self._pending: List[str] = []
+        self._logged = 0
+        self._committed = 0
+        self._urgent = False
+        self._closing = False
+        self._journal = open(path, 'ab')
+        try:
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._journal.close()
+            raise RuntimeError(f"{path} is used by another process")
+        self._snapshot_bytes = self._replay(self.snapshot_path, torn_tail=False) if exists(self.snapshot_path) else 0
+        self._journal_bytes = self._replay(path, torn_tail=True)
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+
+    def table(self, name: str) -> Table:
+        with self.lock:
+            if name not in self._tables:
+                if not _IDENTIFIER.fullmatch(name) or '.' in name:
+                    raise ValueError(f"Invalid table name {name}")
+                self._tables[name] = JournalTable(self, name)
+            return self._tables[name]
+
+    def transaction(self) -> ContextManager[Any]:
+        return self.lock
+
+    def log(self, table: JournalTable, changes: List[Tuple[int, str]], removed: Iterable[int] = ()) -> None:
+        removed = list(removed)
+        if not changes and not removed:
+            return
+        self._pending.append(_journal_line(table.name, table.next_id, changes, removed))
+        self._logged += 1
+        if len(self._pending) == self.commit_batch:
+            self._changed.notify_all()
+
+    # Returns the size of the file without a line cut short by a crash, which
+    # is only expected at the end of the journal
+    def _replay(self, path: str, torn_tail: bool) -> int:
+        replayed = 0
+        good = 0
+        with open(path, 'rb') as file:
+            for line in file:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("Incomplete line")
+                    record = json.loads(line)
+                except ValueError:
+                    if not torn_tail or file.read():
+                        raise RuntimeError(f"{path} is corrupted after {good} bytes")
+                    logging.warning(f"Dropping an incomplete change at the end of {path}")
+                    self._journal.truncate(good)
+                    break
+                table = cast(JournalTable, self.table(record['t']))
+                table.next_id = max(table.next_id, record['next'])
+                for doc_id, document in record['set']:
+                    table._set(doc_id, json.dumps(document), document)
+                for doc_id in record['del']:
+                    table._delete(doc_id)
+                good += len(line)
+                replayed += 1
+        if torn_tail and replayed:
+            logging.info(f"Replayed {replayed} changes from {path}")
+        return good
+
+    def _run(self) -> None:
+        while True:
+            with self.lock:
+                deadline = monotonic() + self.commit_interval
+                while not (self._closing or self._urgent or len(self._pending) >= self.commit_batch):
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                self._urgent = False
+                closing = self._closing
+                lines, self._pending = self._pending, []
+            try:
+                self._commit(lines)
+                if self._journal_bytes and self._journal_bytes >= max(self.compact_bytes, self._snapshot_bytes):
+                    self._compact()
+            except Exception:
+                logging.exception(f"Cannot write {self.path}")
+                if not closing:
+                    sleep(self.commit_interval)
+                    continue
+            if closing:
+                return
+
+    def _commit(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        data = ''.join(lines).encode()
+        try:
+            self._journal.write(data)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except Exception:
+            self._journal.truncate(self._journal_bytes)
+            with self.lock:
+                self._pending[:0] = lines
+            raise
+        self._journal_bytes += len(data)
+        with self.lock:
+            self._committed += len(lines)
+            self._changed.notify_all()
+
+    # Documents are only serialized once, the snapshot is made of the JSON
+    # the tables already hold. Changes made while it is written go to the
+    # journal that is started over afterwards.
+    def _compact(self) -> None:
+        with self.lock:
+            lines, self._pending = self._pending, []
+            tables = [(table.name, table.next_id, [(doc_id, text) for doc_id, (_, text) in table.rows.items()])
+                      for table in self._tables.values()]
+        self._commit(lines)
+        temporary = f'{self.snapshot_path}.tmp'
+        with open(temporary, 'wb') as file:
+            for name, next_id, rows in tables:
+                file.write(_journal_line(name, next_id, rows, []).encode())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.snapshot_path)
+        directory = os.open(dirname(self.snapshot_path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._journal.truncate(0)
+        os.fsync(self._journal.fileno())
+        logging.info(f"Compacted {self._journal_bytes} bytes of {self.path} into a snapshot")
+        self._snapshot_bytes = getsize(self.snapshot_path)
+        self._journal_bytes = 0
+
+    # Waits until every change made so far is on disk
+    def flush(self) -> None:
+        with self.lock:
+            target = self._logged
+            self._urgent = True
+            self._changed.notify_all()
+            while self._committed < target and self._thread.is_alive():
+                self._changed.wait(self.commit_interval)
+
+    def close(self) -> None:
+        with self.lock:
+            self._closing = True
+            self._changed.notify_all()
+        self._thread.join()
+        self._journal.close()
+
+
+STORAGE_ENGINES = {
+    'sqlite': (SQLiteStorage, 'db.sqlite3'),
+    'tinydb': (TinyDBStorage, 'db.json'),
+    'journal': (JournalStorage, 'db.journal'),
+}
+
+
+# Settings are passed on to the storage class of the engine
+def open_storage(engine: str, db_dir: str, check_migration: bool = True, **settings: Any) -> Storage:
+    if engine not in STORAGE_ENGINES:
+        raise ValueError(f"Unknown storage engine {engine}")
+    storage_class, file_name = STORAGE_ENGINES[engine]
+    path = path_join(db_dir, file_name)
+    if check_migration and engine != 'tinydb' and not exists(path) and exists(path_join(db_dir, 'db.json')):
+        logging.warning(
+            f"{path} does not exist but {db_dir}/db.json does. Run "
+            f"migrate_db.py --engine {engine} {path_join(db_dir, 'db.json')} {db_dir} to import existing data")
+    logging.info(f"Using {engine} storage at {path}")
+    return storage_class(path, **settings)
@@ -0,0 +1,16 @@
+import json
+import os
+import sys
+import tempfile
+
+# Run with: python3 -m unittest discover -t . -s tests
+# The handler modules read the Google service account key from the working
+# directory when they are imported, like the benchmark server the tests run
+# in a directory of their own with a fake key.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORK_DIR = tempfile.mkdtemp(prefix='tournaments-tests-')
+with open(os.path.join(WORK_DIR, 'google_key.json'), 'w') as f:
+    json.dump({'type': 'service_account', 'client_email': 'tests@example.com', 'private_key': '',
+               'token_uri': 'https://oauth2.googleapis.com/token'}, f)
+os.chdir(WORK_DIR)
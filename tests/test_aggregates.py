@@ -0,0 +1,25 @@
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from aggregates import apply_standings, get_month, read_monthly_stats
+from storage import STORAGE_ENGINES, open_storage
+
+
+class ApplyStandingsTest(unittest.TestCase):
+    def test_concurrent_updates_are_not_lost(self) -> None:
+        start = int(time())
+        tournaments = [
+            {'id': f't{i}', 'startTimestamp': start,
+             'standings': {'players': [{'username': 'alice', 'rank': 1, 'score': 1}]}}
+            for i in range(40)]
+        for engine in STORAGE_ENGINES:
+            with self.subTest(engine=engine):
+                db = open_storage(engine, tempfile.mkdtemp(), check_migration=False)
+                with ThreadPoolExecutor(8) as executor:
+                    for future in [executor.submit(apply_standings, db, 'user', [dict(t)]) for t in tournaments]:
+                        future.result()
+                month = get_month(tournaments[0])
+                self.assertEqual(read_monthly_stats(db, 'user', [month])[month]['alice']['points'], len(tournaments))
+                db.close()
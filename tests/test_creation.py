@@ -0,0 +1,109 @@
+import asyncio
+import tempfile
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List, cast
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from creation import CREATED, FAILED, CreationQueue, enqueue
+from lichessapi import LichessAPI
+from sessions import save_token
+from storage import SQLiteStorage
+from tournaments import PlannedTournament, TournamentCreateHandler
+
+TEMPLATE = {
+    'id': 'template', 'type': 'arena', 'name': 'Weekly', 'clockTime': 180, 'clockIncrement': 2, 'minutes': 60,
+    'startDate': {'weekday': 1, 'wall_time': '18:00', 'timezone': 'Etc/UTC'}, 'password': '',
+    'conditions.minRating.rating': 0, 'conditions.maxRating.rating': 0, 'conditions.nbRatedGame.nb': 0,
+}
+
+
+class CancelWhileWaitingTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db = SQLiteStorage(f'{tempfile.mkdtemp()}/db.sqlite3')
+        self.queue = CreationQueue(self.db, cast(LichessAPI, None))
+        self.handler = SimpleNamespace(
+            db=self.db, current_user={'id': 'user'}, settings={'creation_queue': self.queue})
+
+    def tearDown(self) -> None:
+        self.db.close()
+        super().tearDown()
+
+    def plan(self, weeks: int) -> List[PlannedTournament]:
+        start = datetime.now(timezone.utc) + timedelta(days=1)
+        return [PlannedTournament(dict(TEMPLATE, id=f'template{i}'), start + timedelta(weeks=i), None)
+                for i in range(weeks)]
+
+    # Like CreationJobsHandler.delete for the first job and the queue for
+    # the others
+    async def cancel_first(self, progress: List[Any]) -> None:
+        while not progress:
+            await asyncio.sleep(0.01)
+        jobs = progress[0][1]['jobs']
+        table = self.db.table('creation_jobs')
+        table.remove(user='user', id=jobs[0]['id'])
+        table.update_multiple([({'status': CREATED, 'finished': 0, 'tournament': {'id': job['id']}},
+                                {'id': job['id']}) for job in jobs[1:]])
+        self.queue._changed.notify_all()
+
+    @gen_test(timeout=10)
+    async def test_job_cancelled_during_wait_for(self) -> None:
+        progress: List[Any] = []
+
+        def record(event: str, **data: Any) -> None:
+            progress.append((event, data))
+        cancelling = asyncio.ensure_future(self.cancel_first(progress))
+        result: Dict[str, Any] = await TournamentCreateHandler.create(
+            cast(TournamentCreateHandler, self.handler), self.plan(3), 5, record)
+        await cancelling
+
+        self.assertEqual([planned['template'] for planned in result['plan']], ['template0', 'template1', 'template2'])
+        self.assertEqual(result['plan'][0]['cancelled'], True)
+        self.assertEqual(result['plan'][0]['success'], False)
+        jobs = progress[0][1]['jobs']
+        self.assertEqual([planned.get('id') for planned in result['plan'][1:]], [job['id'] for job in jobs[1:]])
+        self.assertTrue(all(planned['success'] for planned in result['plan'][1:]))
+        self.assertEqual(result['created']['template0'], {'success': False, 'cancelled': True})
+        self.assertIn(('cancelled', {'id': jobs[0]['id']}), progress)
+
+
+class FakeLichess():
+    def __init__(self) -> None:
+        self.tokens: List[str] = []
+
+    async def create_tournament(self, token: str, type: str, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        self.tokens.append(token)
+        return {'id': f'created{len(self.tokens)}', 'name': parameters['name']}
+
+
+class CreationTokenTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db = SQLiteStorage(f'{tempfile.mkdtemp()}/db.sqlite3')
+        self.lichess = FakeLichess()
+        self.queue = CreationQueue(self.db, cast(LichessAPI, self.lichess))
+        start = (datetime.now(timezone.utc) + timedelta(days=1)).timestamp()
+        self.tournaments = [(f'template{i}', {'type': 'arena', 'name': f'Weekly {i}', 'startTimestamp': start})
+                            for i in range(2)]
+
+    def tearDown(self) -> None:
+        self.db.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_jobs_use_saved_token(self) -> None:
+        save_token(self.db, 'user', 'saved-token')
+        ids = [job['id'] for job in enqueue(self.db, 'user', self.tournaments)]
+        self.assertFalse(any('token' in job for job in self.db.table('creation_jobs').search()))
+        await self.queue.run_once()
+        self.assertEqual(self.lichess.tokens, ['saved-token', 'saved-token'])
+        self.assertEqual([job['status'] for job in await self.queue.wait_for(ids, 0)], [CREATED, CREATED])
+
+    @gen_test
+    async def test_jobs_without_token_fail(self) -> None:
+        ids = [job['id'] for job in enqueue(self.db, 'user', self.tournaments)]
+        await self.queue.run_once()
+        self.assertEqual(self.lichess.tokens, [])
+        self.assertEqual([job['status'] for job in await self.queue.wait_for(ids, 0)], [FAILED, FAILED])
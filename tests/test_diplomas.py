@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from typing import Any, List
+
+from tornado.options import define, options
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.web import HTTPError
+
+from dataio import AsyncStorage
+from diplomas import DiplomaTemplateHandler, load_fields
+from storage import SQLiteStorage
+
+# Importing webapp would parse the command line of the test runner
+if 'db_dir' not in options:
+    define('db_dir', type=str)
+
+
+class FieldsFileTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        options.db_dir = tempfile.mkdtemp()
+        os.makedirs(f'{options.db_dir}/diplomas')
+        with open(f'{options.db_dir}/secret', 'w') as f:
+            json.dump({'secret': True}, f)
+        self.db = SQLiteStorage(f'{options.db_dir}/db.sqlite3')
+        self.written: List[Any] = []
+
+    def tearDown(self) -> None:
+        self.db.close()
+        super().tearDown()
+
+    def test_load_fields_stays_in_diplomas_directory(self) -> None:
+        for fields_file in ('../secret', f'{options.db_dir}/secret', '.', 'a/../../secret'):
+            with self.assertRaises(HTTPError, msg=fields_file):
+                load_fields({'fields_file': fields_file})
+
+    @gen_test
+    async def test_post_ignores_fields_file(self) -> None:
+        async def post(body: Any) -> None:
+            handler = SimpleNamespace(
+                request=SimpleNamespace(body=json.dumps(body).encode()), current_user={'id': 'user'},
+                async_db=AsyncStorage(self.db), write=self.written.append)
+            await DiplomaTemplateHandler.post(handler, 'template')
+        await post({'name': 'Diploma', 'fields': {'objects': []}})
+        await post({'name': 'Renamed', 'fields_file': '../secret'})
+
+        template = self.db.table('diploma_templates').get(id='template')
+        assert template is not None
+        self.assertEqual(template['name'], 'Renamed')
+        self.assertEqual(template['fields_file'], 'user-template')
+        self.assertEqual(load_fields(template), {'objects': []})
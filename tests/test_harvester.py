@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+from datetime import datetime
+from time import time
+from typing import cast
+
+from aggregates import backfill_standings, read_monthly_stats
+from harvester import StandingsHarvester
+from lichessapi import LichessAPI
+from storage import SQLiteStorage
+
+
+class PendingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = SQLiteStorage(f'{tempfile.mkdtemp()}/db.sqlite3')
+        self.harvester = StandingsHarvester(self.db, cast(LichessAPI, None))
+
+    def tearDown(self) -> None:
+        self.db.close()
+
+    def test_pending_tournaments_started_in_window(self) -> None:
+        now = int(time())
+        self.db.table('tournaments').insert_multiple([
+            {'id': id, 'user': 'user', 'system': 'arena', 'minutes': 60, 'startTimestamp': start, **fields}
+            for id, start, fields in (
+                ('finished', now - 86400, {}),
+                ('harvested', now - 86400, {'standings_final': True}),
+                ('running', now - 60, {}),
+                ('upcoming', now + 86400, {}),
+                ('old', now - 63 * 86400, {}),
+                ('retried', now - 2 * 86400, {'harvest_after': now + 600}),
+            )])
+        self.assertEqual([t['id'] for _, t in self.harvester.pending()], ['finished'])
+        self.assertEqual(self.harvester.pending('other'), [])
+
+    def test_window_covers_stats_exports(self) -> None:
+        harvester = StandingsHarvester(self.db, cast(LichessAPI, None), window=7 * 86400)
+        self.assertEqual(harvester.window, StandingsHarvester.MIN_WINDOW)
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db = SQLiteStorage(f'{tempfile.mkdtemp()}/db.sqlite3')
+
+    def tearDown(self) -> None:
+        self.db.close()
+
+    def test_standings_saved_without_stats_are_added(self) -> None:
+        standings = {'players': [
+            {'username': 'alice', 'rank': 1, 'score': 5}, {'username': 'bob', 'rank': 2, 'score': 3}]}
+        start = int(time())
+        self.db.table('tournaments').insert_multiple([
+            {'id': 'legacy', 'user': 'user', 'startTimestamp': start, 'standings': standings},
+            {'id': 'unfetched', 'user': 'user', 'startTimestamp': start},
+        ])
+        self.assertEqual(backfill_standings(self.db), 1)
+        self.assertEqual(backfill_standings(self.db), 0)
+        month = datetime.fromtimestamp(start).strftime('%Y-%m')
+        stats = read_monthly_stats(self.db, 'user', [month])[month]
+        self.assertEqual((stats['alice']['points'], stats['alice']['wins']), (5, 1))
+        self.assertEqual(stats['bob']['podiums'], 1)
+        self.assertTrue(self.db.table('tournaments').get(id='legacy')['stats_applied'])
@@ -0,0 +1,35 @@
+from time import monotonic
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from lichessapi import LichessAPI
+
+
+class FakeLichessAPI(LichessAPI):
+    def __init__(self, status: str) -> None:
+        super().__init__('client', 'http://localhost/login')
+        self.status = status
+
+    async def _make_request(self, url: str, token: str, method: str, raw_body: Optional[str] = None,
+                            **kwargs: Any) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        return {'id': url.rsplit('/', 1)[-1], 'status': self.status}
+
+    async def stream_swiss_standings(self, token: str, id: str, max: int = 10) -> AsyncIterator[Dict[str, Any]]:
+        yield {'username': 'alice', 'rank': 1, 'points': 3}
+
+
+class SwissStandingsTest(AsyncTestCase):
+    async def expires_in(self, status: str) -> float:
+        lichess = FakeLichessAPI(status)
+        self.assertEqual(await lichess.get_swiss_standings('', 'swiss', 10),
+                         [{'username': 'alice', 'rank': 1, 'points': 3}])
+        return lichess.cache._entries[('swiss_standings', 'swiss', 10)].expires - monotonic()
+
+    @gen_test
+    async def test_standings_of_live_tournaments_expire_soon(self) -> None:
+        self.assertLessEqual(await self.expires_in('started'), LichessAPI.LIVE_TOURNAMENT_TTL)
+
+    @gen_test
+    async def test_standings_of_finished_tournaments_are_kept(self) -> None:
+        self.assertGreater(await self.expires_in('finished'), LichessAPI.LIVE_TOURNAMENT_TTL)
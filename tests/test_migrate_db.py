@@ -0,0 +1,44 @@
+import tempfile
+import unittest
+from os.path import join
+
+from tinydb import TinyDB
+
+from migrate_db import migrate
+from storage import open_storage
+
+DOCUMENTS = {
+    'tournaments': [
+        {'id': 'abc', 'type': 'arena', 'startsAt': 1700000000000, 'user': 'a', 'conditions': {'teamMember': 't'}},
+        {'id': 'def', 'type': 'swiss', 'startsAt': 1700003600000, 'user': 'b', 'name': 'Ünïcode "quoted"'},
+    ],
+    'templates': [{'id': 'x', 'user': 'a', 'conditions.minRating.rating': 1500, 'password': None}],
+}
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_dir = tempfile.mkdtemp()
+        with TinyDB(join(self.db_dir, 'db.json')) as db:
+            for name, documents in DOCUMENTS.items():
+                db.table(name).insert_multiple(documents)
+
+    def test_open_storage_names_migration(self) -> None:
+        with self.assertLogs(level='WARNING') as logs:
+            open_storage('journal', self.db_dir).close()
+        self.assertIn(f"migrate_db.py --engine journal {self.db_dir}/db.json {self.db_dir}", logs.output[0])
+
+    def test_migrate_into_journal(self) -> None:
+        self.assertEqual(migrate(join(self.db_dir, 'db.json'), self.db_dir, 'journal'), 3)
+        # Documents are read back from the journal
+        storage = open_storage('journal', self.db_dir)
+        try:
+            for name, documents in DOCUMENTS.items():
+                self.assertEqual(storage.table(name).search(), documents)
+        finally:
+            storage.close()
+
+    def test_migrate_refuses_non_empty_target(self) -> None:
+        migrate(join(self.db_dir, 'db.json'), self.db_dir, 'journal')
+        with self.assertRaises(RuntimeError):
+            migrate(join(self.db_dir, 'db.json'), self.db_dir, 'journal')
@@ -0,0 +1,62 @@
+import asyncio
+import tempfile
+from typing import Any, Dict
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from operations import DONE, RUNNING, Operation, Operations
+from storage import JournalStorage
+
+
+class OperationsTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db = JournalStorage(f'{tempfile.mkdtemp()}/db.journal')
+        self.operations = Operations(self.db)
+
+    def tearDown(self) -> None:
+        self.db.close()
+        super().tearDown()
+
+    @gen_test(timeout=10)
+    async def test_events_are_stored_one_per_row(self) -> None:
+        release = asyncio.Event()
+
+        async def run(operation: Operation) -> Dict[str, Any]:
+            for i in range(50):
+                operation.emit('step', n=i)
+                if i % 7 == 0:
+                    await asyncio.sleep(0)
+            await release.wait()
+            return {'steps': 50}
+        operation = await self.operations.start('user', 'test', run)
+        while len(self.db.table('operation_events').search(operation=operation.id)) < 50:
+            await self.operations.wait(0.1)
+
+        status = await self.operations.get(operation.id, 'user')
+        assert status is not None
+        self.assertEqual(status['status'], RUNNING)
+        self.assertNotIn('events', status)
+        events = await self.operations.events(operation.id, 39)
+        self.assertEqual([(e['id'], e['event'], e['data']) for e in events],
+                         [(i, 'step', {'n': i}) for i in range(40, 50)])
+
+        release.set()
+        while (status := await self.operations.get(operation.id, 'user')) and status['status'] == RUNNING:
+            await self.operations.wait(0.1)
+        self.assertEqual(status['status'], DONE)
+        self.assertEqual(status['result'], {'steps': 50})
+        self.assertEqual(len(await self.operations.events(operation.id)), 50)
+        self.assertIsNone(await self.operations.get(operation.id, 'other'))
+
+    @gen_test(timeout=10)
+    async def test_prune_removes_events(self) -> None:
+        async def run(operation: Operation) -> Dict[str, Any]:
+            operation.emit('step')
+            return {}
+        operation = await self.operations.start('user', 'test', run)
+        while not await self.operations.recent('user') or (await self.operations.recent('user'))[0]['status'] != DONE:
+            await self.operations.wait(0.1)
+        self.operations.KEEP = -1
+        self.assertEqual(self.operations.prune(), 1)
+        self.assertEqual(self.db.table('operation_events').search(operation=operation.id), [])
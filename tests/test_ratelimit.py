@@ -0,0 +1,42 @@
+from typing import List
+
+from tornado.httpclient import HTTPClientError, HTTPRequest, HTTPResponse
+from tornado.testing import AsyncTestCase, gen_test
+
+from ratelimit import RequestScheduler
+
+
+class RetryTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.scheduler = RequestScheduler(backoff_base=0, max_retries=2)
+        self.calls = 0
+
+    def failing(self, failures: List[Exception]):
+        async def fetch() -> HTTPResponse:
+            self.calls += 1
+            if failures:
+                raise failures.pop(0)
+            return HTTPResponse(HTTPRequest('https://lichess.org/api/user/a'), 200)
+        return fetch
+
+    @gen_test
+    async def test_connection_errors_are_retried(self) -> None:
+        res = await self.scheduler.run('token', self.failing([ConnectionResetError(), HTTPClientError(599, 'Timeout')]))
+        self.assertEqual(res.code, 200)
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(self.scheduler.retries, 2)
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+    @gen_test
+    async def test_retries_are_limited(self) -> None:
+        with self.assertRaises(HTTPClientError):
+            await self.scheduler.run('token', self.failing([HTTPClientError(599, 'Timeout')] * 3))
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+    @gen_test
+    async def test_not_idempotent_requests_are_not_retried(self) -> None:
+        with self.assertRaises(ConnectionRefusedError):
+            await self.scheduler.run('token', self.failing([ConnectionRefusedError()]), idempotent=False)
+        self.assertEqual(self.calls, 1)
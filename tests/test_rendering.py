@@ -0,0 +1,21 @@
+import os
+import tempfile
+import unittest
+
+from dataio import get_executor
+from rendering import get_pool, render_diploma, shutdown_pool
+
+
+class PoolTest(unittest.TestCase):
+    def tearDown(self) -> None:
+        shutdown_pool()
+
+    def test_workers_are_not_forked_from_threaded_process(self) -> None:
+        get_executor().submit(lambda: None).result()
+        pool = get_pool(1)
+        context = pool._mp_context
+        assert context is not None
+        self.assertNotEqual(context.get_start_method(), 'fork')
+        path = f'{tempfile.mkdtemp()}/diploma.png'
+        pool.submit(render_diploma, [], path).result(timeout=60)
+        self.assertTrue(os.path.getsize(path))
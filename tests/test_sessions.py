@@ -0,0 +1,51 @@
+import tempfile
+from time import time
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from sessions import SessionStore
+from storage import JournalStorage
+
+
+class SessionTokenTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = f'{tempfile.mkdtemp()}/db.journal'
+        self.db = JournalStorage(self.path)
+        self.db.table('users').insert({'id': 'user', 'username': 'User'})
+
+    def tearDown(self) -> None:
+        self.db.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_token_is_not_stored_with_session(self) -> None:
+        id = (await SessionStore(self.db).create('secret-token', {'id': 'user'})).id
+        self.db.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read().count('secret-token'), 1)
+        self.db = JournalStorage(self.path)
+
+        self.assertNotIn('token', self.db.table('sessions').get(id=id) or {})
+        session = await SessionStore(self.db).get(id)
+        assert session is not None
+        self.assertEqual(session.token, 'secret-token')
+
+    @gen_test
+    async def test_token_of_old_session_is_moved(self) -> None:
+        self.db.table('sessions').insert(
+            {'id': 'old', 'token': 'old-token', 'user': 'user', 'expires': time() + 60, 'validated': time()})
+        session = await SessionStore(self.db).get('old')
+        assert session is not None
+        self.assertEqual(session.token, 'old-token')
+        self.assertEqual(self.db.table('sessions').get(id='old'),
+                         {'id': 'old', 'user': 'user', 'expires': session.expires, 'validated': session.validated})
+        self.assertEqual(self.db.table('tokens').get(user='user'), {'user': 'user', 'token': 'old-token'})
+
+    @gen_test
+    async def test_prune_removes_unused_tokens(self) -> None:
+        sessions = SessionStore(self.db, ttl=-1)
+        id = (await sessions.create('token', {'id': 'user'})).id
+        self.assertEqual(sessions.prune(), 1)
+        self.assertIsNone(self.db.table('tokens').get(user='user'))
+        self.assertIsNone(await sessions.get(id))
@@ -0,0 +1,54 @@
+import tempfile
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from lichessapi import LichessError
+from stats import TournamentStatsHandlerBase
+from storage import SQLiteStorage
+
+STANDINGS = {'players': [{'name': name, 'rank': rank, 'score': 10 - rank} for rank, name in enumerate('abc', 1)]}
+
+
+class FakeLichess():
+    def __init__(self, errors: Dict[str, int]) -> None:
+        self.errors = errors
+
+    async def get_tournament(self, token: str, type: str, id: str) -> Dict[str, Any]:
+        if id in self.errors:
+            raise LichessError(self.errors[id], "Error", f'https://lichess.org/api/tournament/{id}')
+        return {'id': id, 'standing': STANDINGS}
+
+
+class FetchStandingsTest(AsyncTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db = SQLiteStorage(f'{tempfile.mkdtemp()}/db.sqlite3')
+        self.db.table('tournaments').insert_multiple([
+            {'id': id, 'user': 'user', 'system': 'arena', 'startTimestamp': 1700000000}
+            for id in ('finished', 'deleted', 'throttled', 'failing')])
+        self.handler = SimpleNamespace(
+            db=self.db, token='', options=SimpleNamespace(standings_concurrency=2),
+            lichess=FakeLichess({'deleted': 404, 'throttled': 429, 'failing': 502}),
+            get_argument=lambda name, default=None: default)
+        self.handler.fetch_standings = lambda tournament: TournamentStatsHandlerBase.fetch_standings(
+            self.handler, tournament)
+
+    def tearDown(self) -> None:
+        self.db.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_only_deleted_tournaments_get_empty_standings(self) -> None:
+        tournaments: List[Dict[str, Any]] = self.db.table('tournaments').search()
+        enriched, errors = await TournamentStatsHandlerBase.enrich_tournaments_with_standings(
+            self.handler, tournaments)
+
+        self.assertEqual(sorted(t['id'] for t in enriched), ['deleted', 'finished'])
+        self.assertEqual(sorted(errors), ['failing', 'throttled'])
+        stored = {t['id']: t for t in self.db.table('tournaments').search()}
+        self.assertEqual(stored['finished']['standings'], STANDINGS)
+        self.assertEqual(stored['deleted']['standings'], {'players': []})
+        self.assertNotIn('standings', stored['throttled'])
+        self.assertNotIn('standings', stored['failing'])
@@ -0,0 +1,25 @@
+import unittest
+from base64 import urlsafe_b64encode
+from json import dumps
+from typing import Any
+
+from tornado.web import HTTPError
+
+from storage import Document
+from tournaments import decode_cursor, encode_cursor
+
+
+def cursor(value: Any) -> str:
+    return urlsafe_b64encode(dumps(value).encode()).decode()
+
+
+class CursorTest(unittest.TestCase):
+    def test_cursor_round_trip(self) -> None:
+        for created in (1700000000, 1700000000.5, '2023-11-14', None):
+            self.assertEqual(decode_cursor(encode_cursor(Document({'created': created}, 7), 'created')), (created, 7))
+
+    def test_sort_key_must_be_scalar(self) -> None:
+        for invalid in ([[1], 7], [{'a': 1}, 7], [True, 7], [1, 'x'], [1], 'x'):
+            with self.assertRaises(HTTPError, msg=repr(invalid)) as raised:
+                decode_cursor(cursor(invalid))
+            self.assertEqual(raised.exception.status_code, 400)
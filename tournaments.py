@@ -1,22 +1,25 @@
 from datetime import datetime, timedelta, timezone
 import logging
 try:
-    from backports.zoneinfo import ZoneInfo  # type: ignore[import]
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError  # type: ignore[import]
 except ModuleNotFoundError:
-    from zoneinfo import ZoneInfo
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from json import loads, dumps
 from math import floor
 from secrets import token_urlsafe
-from typing import Any, Dict, List, Union, cast
-from asyncio import gather
-from lichessapi import LichessError
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union, cast
 
-from tinydb import Query
 import tornado
 
 from tornado.web import HTTPError
 
 from basehandler import BaseAPIHandler
+from creation import CREATED, QUEUED, CreationQueue, enqueue, job_status
+from dataio import run_blocking
+from operations import Progress, no_progress, start_operation, wants_async
+from storage import Document, Storage, at_least, one_of
 
 
 def convert_clock_time(seconds: int) -> str:
@@ -41,6 +44,7 @@ def convert_start_date(startDate: Union[int, Dict[str, Union[int, str]]]) -> Dic
 
 
 class TournamentTemplateHandler(BaseAPIHandler):
+    versioned = True
     ALLOWED_FIELDS = {
         'arena':
         ('id', 'type', 'name', 'clockTime', 'clockIncrement', 'minutes', 'startDate',
@@ -63,15 +67,13 @@ class TournamentTemplateHandler(BaseAPIHandler):
         return {k: v for k, v in tournament.items() if k in cls.ALLOWED_FIELDS[tournament['type']]} if tournament.get('type', '') in cls.ALLOWED_FIELDS else {}  # noqa: E501
 
     @tornado.web.authenticated  # type: ignore[misc]
-    def get(self, id: str) -> None:
-        table = self.db.table('templates')
-        T = Query()
+    async def get(self, id: str) -> None:
         if id:
             template = cast(
                 Dict[str, Any],
-                table.get((T.user == self.current_user['id'])
-                          & (T.tournament_set == 'default')
-                          & (T.id == id)))
+                await self.async_db.table('templates').get(user=self.current_user['id'],
+                                                           tournament_set='default',
+                                                           id=id))
             if not template:
                 raise HTTPError(
                     404,
@@ -82,20 +84,25 @@ class TournamentTemplateHandler(BaseAPIHandler):
             template['startDate'] = convert_start_date(template['startDate'])
             self.write(dumps({'tournament': self.filter_allowed_fields(template), 'success': True}))
         else:
-            templates = table.search((T.user == self.current_user['id'])
-                                     & (T.tournament_set == 'default'))
-            res = [self.filter_allowed_fields(t) for t in templates]
-            for t in res:
-                if 'clockTime' in t:
-                    t['clockTime'] = convert_clock_time(t['clockTime'])
-                if 'startDate' in t:
-                    t['startDate'] = convert_start_date(t['startDate'])
-
-            res.sort(key=lambda template: template.get('index', 0))
-            self.write(dumps({'templates': res, 'success': True}))
+            templates = await run_blocking(self.list_templates, self.db, self.current_user['id'])
+            self.write(dumps({'templates': templates, 'success': True}))
+
+    # Every template of a user as the editor shows it, in their order
+    @classmethod
+    def list_templates(cls, db: Storage, user: str) -> List[Dict[str, Any]]:
+        templates = db.table('templates').search(user=user, tournament_set='default')
+        res = [cls.filter_allowed_fields(t) for t in templates]
+        for t in res:
+            if 'clockTime' in t:
+                t['clockTime'] = convert_clock_time(t['clockTime'])
+            if 'startDate' in t:
+                t['startDate'] = convert_start_date(t['startDate'])
+
+        res.sort(key=lambda template: template.get('index', 0))
+        return res
 
     @tornado.web.authenticated  # type: ignore[misc]
-    def post(self, id: str) -> None:
+    async def post(self, id: str) -> None:
         value = {}
         try:
             value = self.filter_allowed_fields(loads(self.request.body.decode()))
@@ -106,32 +113,59 @@ class TournamentTemplateHandler(BaseAPIHandler):
         value['tournament_set'] = 'default'
         if 'clockTime' in value:
             value['clockTime'] = int(float(value['clockTime'])*60)
-        table = self.db.table('templates')
-        table.insert(value)
+        await self.async_db.table('templates').insert(value)
         self.write(dumps({'success': True, 'id': value['id']}))
 
-    @tornado.web.authenticated  # type: ignore[misc]
-    def patch(self, id: str) -> None:
-        value = {}
-        try:
-            value = self.filter_allowed_fields(loads(self.request.body.decode()))
-        except ValueError:
-            raise HTTPError(400, "Invalid JSON")
+    def patch_value(self, value: Dict[str, Any], id: str) -> Dict[str, Any]:
         value['id'] = id
         value['user'] = self.current_user['id']
         value['tournament_set'] = 'default'
         if 'clockTime' in value:
             value['clockTime'] = int(float(value['clockTime'])*60)
-        table = self.db.table('templates')
-        T = Query()
-        u = table.update(value, (T.user == self.current_user['id']) & (T.id == id) & (T.tournament_set == 'default'))
+        return value
+
+    # Without an id the body is {"templates": [{"id": ..., "index": ...}]}
+    # and changes several templates at once, like the indexes after a
+    # template was moved
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def patch(self, id: str) -> None:
+        value = {}
+        try:
+            value = loads(self.request.body.decode())
+        except ValueError:
+            raise HTTPError(400, "Invalid JSON")
+        if not id:
+            await self.patch_multiple(value)
+            return
+        value = self.patch_value(self.filter_allowed_fields(value), id)
+        u = await self.async_db.table('templates').update(
+            value, user=self.current_user['id'], id=id, tournament_set='default')
         self.write(dumps({'success': bool(u)}))
 
+    # Every change is checked before any is applied and all of them are
+    # saved in one write. Changes only need the fields they change.
+    async def patch_multiple(self, request: Dict[str, Any]) -> None:
+        changes = request.get('templates') if isinstance(request, dict) else None
+        if not isinstance(changes, list) or not all(isinstance(c, dict) and c.get('id') for c in changes):
+            raise HTTPError(400, "Expected a list of templates with ids")
+        table = self.async_db.table('templates')
+        stored = {t['id']: t for t in await table.search(user=self.current_user['id'], tournament_set='default')}
+        updates = []
+        for change in changes:
+            template = stored.get(change['id'])
+            if template is None:
+                raise HTTPError(404, f"No template with id \"{change['id']}\" for user: \"{self.current_user['id']}\"")
+            try:
+                value = self.patch_value(
+                    self.filter_allowed_fields({'type': template.get('type'), **change}), change['id'])
+            except (TypeError, ValueError):
+                raise HTTPError(400, f"Invalid template {change['id']}")
+            updates.append((value, {'user': self.current_user['id'], 'id': change['id'], 'tournament_set': 'default'}))
+        self.write(dumps({'success': True, 'updated': await table.update_multiple(updates)}))
+
     @tornado.web.authenticated  # type: ignore[misc]
-    def delete(self, id: str) -> None:
-        T = Query()
-        table = self.db.table('templates')
-        u = table.remove((T.user == self.current_user['id']) & (T.id == id) & (T.tournament_set == 'default'))
+    async def delete(self, id: str) -> None:
+        u = await self.async_db.table('templates').remove(user=self.current_user['id'], id=id, tournament_set='default')
         self.write(dumps({'success': bool(u)}))
 
 
@@ -140,39 +174,208 @@ def get_this_monday(d: datetime) -> datetime:
     return datetime(monday.year, monday.month, monday.day, tzinfo=d.tzinfo)
 
 
-class TournamentCreateHandler(BaseAPIHandler):
+WEEK = 7 * 24 * 3600
+# Lichess lets users create tournaments up to this many weeks in advance
+MAX_PLAN_WEEKS = 6
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
+
+
+@lru_cache(maxsize=1024)
+def parse_wall_time(wall_time: str) -> Tuple[int, int]:
+    parsed = datetime.strptime(wall_time, "%H:%M")
+    return parsed.hour, parsed.minute
+
+
+def get_tournament_start(start_date: Dict[str, Any], week: float) -> datetime:
+    tz = get_zone(cast(str, start_date['timezone']))
+    hour, minute = parse_wall_time(cast(str, start_date['wall_time']))
+    monday_in_tz = get_this_monday(datetime.fromtimestamp(week, tz))
+    tournament_day = monday_in_tz + timedelta(days=cast(int, start_date['weekday']))
+    return datetime(tournament_day.year, tournament_day.month, tournament_day.day, hour, minute, tzinfo=tz)
+
+
+# (template, startTimestamp) of the user's tournaments that have not started
+# yet, the only ones a new plan can collide with, and whether they are
+# created or still queued
+def get_scheduled_starts(db: Storage, user: str, now: datetime) -> Dict[Tuple[str, int], str]:
+    tournaments = db.table('tournaments').search(
+        user=user, tournament_set='default', startTimestamp=at_least(int(now.timestamp())))
+    scheduled = {(t['template'], t['startTimestamp']): CREATED for t in tournaments if 'template' in t}
+    for job in db.table('creation_jobs').search(user=user, status=QUEUED):
+        scheduled[(job['template'], job['startTimestamp'])] = QUEUED
+    return scheduled
+
+
+class PlannedTournament(NamedTuple):
+    template: Dict[str, Any]
+    start: Optional[datetime]
+    error: Optional[str]
+
+    @property
+    def start_timestamp(self) -> Optional[int]:
+        return int(self.start.timestamp()) if self.start else None
+
+
+# Every tournament the templates would create in the given weeks, each with
+# the reason it cannot be created if there is one
+def build_plan(templates: Iterable[Dict[str, Any]], week: float, weeks: int,
+               scheduled: Dict[Tuple[str, int], str], now: datetime) -> List[PlannedTournament]:
+    plan = []
+    for template in templates:
+        name = template.get('name', template.get('id'))
+        try:
+            start_date = convert_start_date(template['startDate'])
+            starts = [get_tournament_start(start_date, week + i * WEEK) for i in range(weeks)]
+        except (KeyError, ValueError, ZoneInfoNotFoundError):
+            logging.exception("Incomplete template")
+            plan.append(PlannedTournament(template, None, f"Cannot create tournament {name}. Incomplete template."))
+            continue
+        for start in starts:
+            error = None
+            if start <= now:
+                error = f"Cannot create tournament {name} as it would start in the past"
+            elif scheduled.get((template.get('id', ''), int(start.timestamp()))) == CREATED:
+                error = f"Tournament {name} was created earlier"
+            elif scheduled.get((template.get('id', ''), int(start.timestamp()))) == QUEUED:
+                error = f"Tournament {name} is queued for creation already"
+            elif template.get('type') not in ('arena', 'swiss'):
+                error = f"Unsupported template type {template.get('type')} for {name}"
+            plan.append(PlannedTournament(template, start, error))
+    return plan
+
+
+# Parameters of the Lichess create request for a planned tournament
+def get_creation_parameters(planned: PlannedTournament) -> Dict[str, Any]:
+    template = dict(planned.template)
+    start = cast(int, planned.start_timestamp)
+    if int(template['conditions.minRating.rating']) <= 0:
+        del template['conditions.minRating.rating']
+    if int(template['conditions.maxRating.rating']) <= 0:
+        del template['conditions.maxRating.rating']
+    if int(template['conditions.nbRatedGame.nb']) <= 0:
+        del template['conditions.nbRatedGame.nb']
+    if not template['password']:
+        del template['password']
+    template['startTimestamp'] = start
+    if template['type'] == 'arena':
+        template['startDate'] = start * 1000
+    else:
+        template['startsAt'] = start * 1000
+    return template
+
+
+# Opaque page cursors holding the sort key of the last document of a page
+def encode_cursor(document: Document, order_by: str) -> str:
+    return urlsafe_b64encode(dumps([document.get(order_by), document.doc_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    try:
+        value, doc_id = loads(urlsafe_b64decode(cursor.encode()))
+        # The sort key is compared with stored values, which are scalars
+        if isinstance(value, bool) or not isinstance(value, (str, int, float, type(None))):
+            raise ValueError(f"Invalid sort key {value!r}")
+        return value, int(doc_id)
+    except (ValueError, TypeError):
+        raise HTTPError(400, "Invalid cursor")
+
+
+# The requested fields of a document, or all of them except the large ones
+def project(document: Dict[str, Any], fields: List[str], large: Iterable[str] = ()) -> Dict[str, Any]:
+    if fields:
+        return {field: document[field] for field in ['id', *fields] if field in document}
+    return {field: value for field, value in document.items() if field not in large}
+
+
+class TournamentPlanHandler(BaseAPIHandler):
+    def get_plan(self, request: Dict[str, Any]) -> List[PlannedTournament]:
+        try:
+            week = float(request['week'])
+            weeks = int(request.get('weeks', 1))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(400, "Invalid week")
+        if not 1 <= weeks <= MAX_PLAN_WEEKS:
+            raise HTTPError(400, f"Tournaments can be planned for 1 to {MAX_PLAN_WEEKS} weeks")
+        table = self.db.table('templates')
+        if not request.get('templates'):
+            templates = table.search(user=self.current_user['id'], tournament_set='default')
+        else:
+            templates = table.search(
+                user=self.current_user['id'],
+                tournament_set='default',
+                id=one_of(request['templates']))
+        templates.sort(key=lambda template: template.get('index', 0))
+        now = datetime.now(timezone.utc)
+        return build_plan(
+            templates, week, weeks, get_scheduled_starts(self.db, self.current_user['id'], now), now)
+
+    @tornado.web.authenticated  # type: ignore[misc]
+    async def get(self) -> None:
+        plan = await run_blocking(self.get_plan, {
+            'week': self.get_argument('week', None),
+            'weeks': self.get_argument('weeks', '1'),
+            'templates': [id for id in self.get_argument('templates', '').split(',') if id],
+        })
+        self.write(dumps({'success': True, 'plan': [{
+            'template': planned.template.get('id'),
+            'name': planned.template.get('name'),
+            'startTimestamp': planned.start_timestamp,
+            'success': planned.error is None,
+            **({'error': planned.error} if planned.error else {}),
+        } for planned in plan]}))
+
+
+class TournamentCreateHandler(TournamentPlanHandler):
+    versioned = True
+    # Seconds a background creation waits for the creation queue
+    OPERATION_WAIT = 300
+
+    PAGE_SIZE = 16
+    MAX_PAGE_SIZE = 100
+    # Left out of the created tournaments unless asked for with fields=
+    LARGE_FIELDS = ('standings',)
+
+    # The user's tournaments, most recently created first, limit at a time.
+    # "next" is the cursor of the following page. The first page also has
+    # the stats spreadsheet.
     @tornado.web.authenticated  # type: ignore[misc]
     async def get(self) -> None:
-        T = Query()
-        table = self.db.table('tournaments')
-        tournaments = table.search((T.user == self.current_user['id'])
-                                   & (T.tournament_set == 'default'))
-        tournaments.sort(key=lambda t: t.get('created', 0), reverse=True)
-        self.write(
-            dumps({
-                'success': True,
-                'tournaments': tournaments,
-                'stats': {
-                    'spreadsheet': await self.get_stat_spreadsheet_for_user()
-                }
-            }))
-
-    @staticmethod
-    def get_tournament_start(template: Dict[str, Any], week: float):
-        start_date_data = convert_start_date(template['startDate'])
-        tz = ZoneInfo(cast(str, start_date_data['timezone']))
-        wall_time = datetime.strptime(cast(str, start_date_data['wall_time']), "%H:%M")
-        monday_in_tz = get_this_monday(datetime.fromtimestamp(week, tz))
-        tournament_day = monday_in_tz + timedelta(days=cast(int, start_date_data['weekday']))
-
-        return datetime(
-            year=tournament_day.year,
-            month=tournament_day.month,
-            day=tournament_day.day,
-            hour=wall_time.hour,
-            minute=wall_time.minute,
-            tzinfo=tz).replace(tzinfo=tz)
+        try:
+            limit = int(self.get_argument('limit', str(self.PAGE_SIZE)))
+        except ValueError:
+            raise HTTPError(400, "Invalid limit")
+        if not 1 <= limit <= self.MAX_PAGE_SIZE:
+            raise HTTPError(400, f"Limit must be between 1 and {self.MAX_PAGE_SIZE}")
+        cursor = self.get_argument('cursor', '')
+        fields = [field for field in self.get_argument('fields', '').split(',') if field]
+        reply: Dict[str, Any] = {
+            'success': True,
+            **await run_blocking(self.get_created_page, self.db, self.current_user['id'], limit, cursor, fields),
+        }
+        if not cursor:
+            reply['stats'] = {'spreadsheet': self.get_stat_spreadsheet_link()}
+        self.write(dumps(reply))
 
+    @classmethod
+    def get_created_page(cls, db: Storage, user: str, limit: int, cursor: str = '',
+                         fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        tournaments = db.table('tournaments').search_page(
+            'created', limit + 1, decode_cursor(cursor) if cursor else None, descending=True,
+            user=user, tournament_set='default')
+        return {
+            'tournaments': [project(tournament, fields or [], cls.LARGE_FIELDS) for tournament in tournaments[:limit]],
+            'next': encode_cursor(tournaments[limit - 1], 'created') if len(tournaments) > limit else None,
+        }
+
+    # Queues every tournament of the plan for the requested weeks and waits a
+    # moment for them to be created. Tournaments over the Lichess daily limit
+    # stay queued and are created on the following days. With "Prefer:
+    # respond-async" the creation runs as an operation instead, which waits
+    # for every tournament and reports each one as it is created.
     @tornado.web.authenticated  # type: ignore[misc]
     async def post(self) -> None:
         request = {}
@@ -181,94 +384,59 @@ class TournamentCreateHandler(BaseAPIHandler):
         except ValueError:
             raise HTTPError(400, "Invalid JSON")
 
-        T = Query()
-        table = self.db.table('templates')
-        if not request.get('templates'):
-            templates = table.search((T.user == self.current_user['id']) & (T.tournament_set == 'default'))
-        else:
-            templates = table.search(
-                (T.user == self.current_user['id']) &
-                (T.tournament_set == 'default') &
-                (T.id.one_of(request.get('templates'))))
-        processed_templates = []
-        errors: Dict[str, List[str]] = {}
-        for _t in templates:
-            template = dict(_t)
-            id = template.get('id', 'Unknown template')
-            try:
-                tournamentStart = self.get_tournament_start(template, cast(float, request.get('week')))
-                if tournamentStart <= datetime.now(timezone.utc).astimezone(tournamentStart.tzinfo):
-                    if not errors.get(id):
-                        errors[id] = []
-                    errors[id].append(f"Cannot create tournament {template['name']} as it would start in the past")
-                    continue
-                if int(template['conditions.minRating.rating']) <= 0:
-                    del template['conditions.minRating.rating']
-                if int(template['conditions.maxRating.rating']) <= 0:
-                    del template['conditions.maxRating.rating']
-                if int(template['conditions.nbRatedGame.nb']) <= 0:
-                    del template['conditions.nbRatedGame.nb']
-                if not template['password']:
-                    del template['password']
-                table = self.db.table('tournaments')
-                template['startTimestamp'] = int(tournamentStart.timestamp())
-                if table.contains(
-                        (T.user == self.current_user['id']) &
-                        (T.tournament_set == 'default') &
-                        (T.template == id) &
-                        (T.startTimestamp == int(tournamentStart.timestamp()))):
-                    if not errors.get(id):
-                        errors[id] = []
-                    errors[id].append(f"Tournament {template['name']} was created earlier")
-                    continue
-                if template.get('type') == 'arena':
-                    template['startDate'] = int(tournamentStart.timestamp())*1000
-                elif template.get('type') == 'swiss':
-                    if tournamentStart <= datetime.now(timezone.utc).astimezone(tournamentStart.tzinfo):
-                        if not errors.get(id):
-                            errors[id] = []
-                        errors[id].append(f"Cannot create tournament {template['name']} as it would start in the past")
-                        continue
-                    template['startsAt'] = int(tournamentStart.timestamp())*1000
-                else:
-                    if not errors.get(id):
-                        errors[id] = []
-                    errors[id].append(f"Unsupported template type {template['type']} for {template['name']}")
+        plan = await run_blocking(self.get_plan, request)
+        if wants_async(self):
+            await start_operation(
+                self, 'create', lambda operation: self.create(plan, self.OPERATION_WAIT, operation.emit))
+            return
+        self.write(dumps(await self.create(plan, self.options.creation_wait)))
+
+    # "created" has the last result of every template, "plan" the result of
+    # every planned tournament
+    async def create(self, plan: List[PlannedTournament], wait: float,
+                     progress: Progress = no_progress) -> Dict[str, Any]:
+        results: Dict[int, Dict[str, Any]] = {}
+        creating: List[Tuple[int, Dict[str, Any]]] = []
+        for i, planned in enumerate(plan):
+            if planned.error is None:
+                try:
+                    creating.append((i, get_creation_parameters(planned)))
                     continue
-            except KeyError:
-                logging.exception("Incomplete template")
-                if not errors.get(id):
-                    errors[id] = []
-                errors[id].append(f"Cannot create tournament {template['name']}. Incomplete template.")
-            processed_templates.append(template)
-        req = [
-            self.lichess.create_tournament(self.token, template['type'], template)
-            for template in processed_templates]
-        result = await gather(*req, return_exceptions=True)
-        created = []
-        reply: Dict[str, Any] = {}
-        for id, error in errors.items():
-            reply[id] = {'success': False, 'error': ', '.join(error)}
-        for t, r in zip(processed_templates, result):
-            if isinstance(r, dict):
-                c = dict(r)
-                c.update({
-                    'user': self.current_user['id'],
-                    'tournament_set': 'default',
-                    'template': t.get('id'),
-                    'password': t.get('password'),
-                    'created': datetime.utcnow().timestamp(),
-                    'startTimestamp': t.get('startTimestamp')
-                })
-                created.append(c)
-                reply[t.get('id', '')] = dict(r)
-                reply[t.get('id', '')]['success'] = True
-                reply[t.get('id', '')]['password'] = t.get('password')
-            elif isinstance(r, LichessError):
-                reply[t.get('id', '')] = {'success': False, 'error': r.message}
+                except (KeyError, ValueError):
+                    logging.exception("Incomplete template")
+                    planned = plan[i] = planned._replace(
+                        error=f"Cannot create tournament {planned.template.get('name')}. Incomplete template.")
+            results[i] = {'success': False, 'error': planned.error}
+        jobs = await run_blocking(enqueue, self.db, self.current_user['id'], [
+            (plan[i].template.get('id', ''), parameters) for i, parameters in creating])
+        progress('queued', jobs=[job_status(job) for job in jobs], errors=len(results))
+        queue = cast(CreationQueue, self.settings['creation_queue'])
+        queue.wake()
+        ids = [job['id'] for job in jobs]
+        finished = {job['id']: job for job in await queue.wait_for(ids, wait, progress)}
+        for (i, parameters), id in zip(creating, ids):
+            job = finished.get(id)
+            if job is None:
+                # Cancelled while waiting
+                results[i] = {'success': False, 'cancelled': True}
+            elif job['status'] == CREATED:
+                results[i] = dict(job['tournament'], success=True, password=parameters.get('password'))
+            elif job['status'] == QUEUED:
+                results[i] = {'success': False, 'queued': True, 'job': job_status(job)}
             else:
-                reply[t.get('id', '')] = {'success': False, 'error': "Internal error"}
+                results[i] = {'success': False, 'error': job.get('error', "Internal error")}
 
-        table = self.db.table('tournaments')
-        table.insert_multiple(created)
-        self.write(dumps({'success': True, 'created': reply}))
+        reply: Dict[str, Any] = {}
+        errors: Dict[str, List[str]] = {}
+        for i, planned in enumerate(plan):
+            id = planned.template.get('id', '')
+            if results[i]['success'] or results[i].get('queued') or results[i].get('cancelled'):
+                reply[id] = results[i]
+            else:
+                errors.setdefault(id, []).append(results[i]['error'])
+        for id, error in errors.items():
+            if id not in reply:
+                reply[id] = {'success': False, 'error': ', '.join(error)}
+        return {'success': True, 'created': reply, 'plan': [
+            dict(results[i], template=planned.template.get('id'), startTimestamp=planned.start_timestamp)
+            for i, planned in enumerate(plan)]}
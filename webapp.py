@@ -1,119 +1,98 @@
+import asyncio
 import json
 import logging
 import os
 import pwd
 import grp
-from asyncio import gather
+import shutil
+import signal
 from urllib.parse import urlsplit
 from secrets import token_urlsafe
 from pathlib import Path
-from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple, cast
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.auth
 from tornado.options import define, options, parse_config_file, parse_command_line
 import tornado.escape
 
-from tinydb import TinyDB, Query
-
 from lichessapi import LichessAPI
-from basehandler import BaseHandler, BaseAPIHandler
-from diplomas import DiplomaTemplateHandler, DiplomaDuplicateHandler
-from tournaments import TournamentTemplateHandler, TournamentCreateHandler
-from stats import TournamentStatsHandler, TournamentStatsDebugHandler
+from cache import ResponseCache
+from ratelimit import RequestScheduler
+from basehandler import BaseHandler, BaseAPIHandler, bump_data_version
+from diplomas import DiplomaTemplateHandler, DiplomaDuplicateHandler, DiplomaRenderHandler, get_tournament_results
+from blobs import BlobHandler, BLOB_NAME, blob_dir
+from tournaments import TournamentTemplateHandler, TournamentCreateHandler, TournamentPlanHandler
+from stats import TournamentStatsHandler, TournamentStatsDebugHandler, TournamentLeaderboardHandler
+from aggregates import backfill_standings
+from harvester import StandingsHarvester, HarvesterStatusHandler
+from creation import CreationQueue, CreationJobsHandler
+from operations import Operations, OperationsHandler, OperationEventsHandler
+from sessions import SessionStore
+from storage import open_storage, STORAGE_ENGINES
+from compression import get_transforms
+from dataio import StallDetector, get_executor, run_blocking, shutdown_executor
+from rendering import prune_renders, shutdown_pool
+from metrics import Collected, MetricsHandler, TimedStorage, log_request, save_snapshot
+import googleapi
 
 from version import __version__, __revision__
 
 base_path = os.path.abspath(os.path.dirname(__file__))
 os.chdir(base_path)
 
-RELEVANT_VARIANTS = ('blitz', 'rapid', 'classical')
-
-
-def get_this_monday(d: datetime) -> datetime:
-    monday = d + timedelta(days=-d.weekday())
-    return datetime(monday.year, monday.month, monday.day)
-
 
 class TournamentAPI(BaseAPIHandler):
     @tornado.web.authenticated  # type: ignore[misc]
     async def get(self) -> None:
-        tournament_url = self.get_argument('tournament')
-        need_standings = bool(self.get_argument('results', ''))
-        scheme, netloc, path, query, fragment = urlsplit(tournament_url)
-        paths = path.split('/')
-        if netloc != 'lichess.org' or len(paths) < 2:
-            raise tornado.web.HTTPError(400, "Invalid tournament URL")
-        else:
-            id = paths[-1]
-            if paths[-2] == 'tournament':
-                type = 'arena'
-            elif paths[-2] == 'swiss':
-                type = 'swiss'
-            else:
-                raise tornado.web.HTTPError(400, "Invalid tournament type")
-        tournament = await self.lichess.get_tournament(self.token, type, id)
-        if need_standings:
-            if type == 'arena':
-                players = await gather(*[self.lichess.get_user(self.token, player['name']) for player in tournament['standing']['players']])  # noqa: E501
-                for p, player in zip(tournament['standing']['players'], players):
-                    p['profile'] = player.get('profile', {})
-            elif type == 'swiss':
-                standings = await self.lichess.get_swiss_standings(self.token, id, 10)
-                players = await gather(*[self.lichess.get_user(self.token, player['username']) for player in standings])  # noqa: E501
-                for p, player in zip(standings, players):
-                    p['profile'] = player.get('profile', {})
-                    p['name'] = p['username']
-                    del p['username']
-                tournament['standing'] = {'players': standings}
-                tournament['fullName'] = tournament['name']
-            for player in tournament['standing']['players']:
-                profile = await self.lichess.get_user(self.token, player['name'])
-                if 'perfs' not in profile:
-                    player['ratings'] = dict()
-                else:
-                    player['ratings'] = dict((variant, perf['rating']) for (variant, perf) in profile['perfs'].items()
-                                             if 'rating' in perf)
-                player['ratings']['max'] = max(player['ratings'].get(variant, 0) for variant in RELEVANT_VARIANTS)
+        tournament = await get_tournament_results(
+            self.lichess, self.token, self.get_argument('tournament'), bool(self.get_argument('results', '')))
         tournament['success'] = True
-        tournament['type'] = type
         self.write(json.dumps(tournament))
 
 
+# Teams the user leads, the only ones tournaments can be created for
+def get_led_teams(teams: List[Dict[str, Any]], user: str) -> List[Dict[str, Any]]:
+    return [team for team in teams if any(user == leader['id'] for leader in team['leaders'])]
+
+
 class TeamsAPI(BaseAPIHandler):
     @tornado.web.authenticated  # type: ignore[misc]
     async def get(self) -> None:
         self.write(json.dumps({
             'success': True,
-            'teams': [
-                team for team in
-                await self.lichess.get_user_teams(self.token, self.current_user['username'])
-                if any(self.current_user['id'] == leader['id'] for leader in team['leaders'])]}))
+            'teams': get_led_teams(
+                await self.lichess.get_user_teams(self.token, self.current_user['username']),
+                self.current_user['id'])}))
 
 
 class HomeHandler(BaseHandler):
+    # The page comes with what the API would return to its first requests.
+    # Teams are only included when Lichess does not have to be asked, the
+    # page requests them otherwise.
     async def get(self) -> None:
         if not self.current_user:
             self.render('login.html')
             return
-        table = self.db.table('templates')
-        T = Query()
-        templates = table.search((T.user == self.current_user['id']) & (T.tournament_set == 'default'))
-        table = self.db.table('tournaments')
-        tournaments = table.search((T.user == self.current_user['id']) & (T.tournament_set == 'default'))
-        table = self.db.table('diploma_templates')
-        diploma_templates = table.search(T.user == self.current_user['id'])
-
+        user = self.current_user['id']
+        teams = self.lichess.get_cached_user_teams(self.current_user['username'])
+        templates, tournaments, diploma_templates = await asyncio.gather(
+            run_blocking(TournamentTemplateHandler.list_templates, self.db, user),
+            run_blocking(TournamentCreateHandler.get_created_page, self.db, user, TournamentCreateHandler.PAGE_SIZE),
+            run_blocking(DiplomaTemplateHandler.list_templates, self.db, user))
+        bootstrap = {
+            'templates': templates,
+            'tournaments': {**tournaments, 'stats': {'spreadsheet': self.get_stat_spreadsheet_link()}},
+            'diplomaTemplates': diploma_templates,
+            'teams': get_led_teams(teams, user) if teams is not None else None,
+        }
         self.render(
             'home.html',
-            templates=templates,
-            tournaments=tournaments,
-            diploma_templates=diploma_templates,
-            datetime=datetime,
-            timedelta=timedelta,
-            this_monday=get_this_monday(datetime.utcnow()),
+            bootstrap=json.dumps(bootstrap).replace('<', '\\u003c'),
             xsrf_token=self.xsrf_token
             )
 
@@ -123,9 +102,8 @@ class DiplomasHandler(BaseHandler):
     async def get(self, command: str, id: str = '') -> None:
         if command == 'delete':
             self.check_xsrf_cookie()
-            T = Query()
-            table = self.db.table('diploma_templates')
-            table.remove((T.user == self.current_user['id']) & (T.id == id))
+            await self.async_db.table('diploma_templates').remove(user=self.current_user['id'], id=id)
+            await run_blocking(bump_data_version, self.db, self.current_user['id'])
             self.redirect('/')
         elif command == 'add':
             self.redirect(f'/diplomas/edit/{token_urlsafe(16)}')
@@ -154,7 +132,7 @@ class LoginHandler(BaseHandler):
             token = await self.lichess.get_access_token(
                 self.get_argument('code'),
                 code_verifier)
-            self.set_secure_cookie('t', token)
+            await self.start_session(token, await self.lichess.get_current_user(token))
             next = self.get_argument('state', '/')
             s = urlsplit(next)
             if s.hostname or s.scheme or s.username or s.password:
@@ -165,8 +143,10 @@ class LoginHandler(BaseHandler):
 class LogoutHandler(BaseHandler):
     async def get(self) -> None:
         self.check_xsrf_cookie()
-        self.clear_cookie('t')
-        self.clear_cookie('u')
+        session_id = self.get_secure_cookie('s')
+        if session_id:
+            await self.sessions.delete(session_id.decode())
+        self.clear_cookie('s')
         self.redirect('/')
 
 
@@ -181,12 +161,45 @@ def define_options() -> None:
     define("debug", type=bool, default=False)
     define("bind", default="127.0.0.1")
     define("port", type=int, default=14742)
+    define("processes", type=int, default=1, help="Server processes, 0 for one per CPU")
+    define("shutdown_timeout", type=float, default=30, help="Seconds to wait for Lichess requests on shutdown")
     define("base_url", type=str)
 
     define("lichess_client_id", type=str, default='eaade028-da6e-11eb-b2d8-ab4b0acb0c63')
+    define("lichess_cache_entries", type=int, default=2048)
+    define("lichess_cache_bytes", type=int, default=64 * 1024 * 1024)
+    define("lichess_rate", type=float, default=20, help="Requests per second to Lichess from this server")
+    define("lichess_token_rate", type=float, default=4, help="Requests per second to Lichess per OAuth token")
+    define("lichess_concurrency", type=int, default=8, help="Maximum concurrent requests to Lichess")
+    define("lichess_retries", type=int, default=3)
+    define("standings_concurrency", type=int, default=4, help="Tournaments fetched in parallel for stats")
+    define("harvest_interval", type=float, default=60, help="Seconds between background standings harvests")
+    define("harvest_batch", type=int, default=20, help="Tournaments harvested per run")
+    define("harvest_window", type=float, default=62,
+           help="Days after their start tournaments are harvested, at least the 62 days stats exports cover")
+    define("daily_public_tournaments", type=int, default=12, help="Public tournaments a user may create per day")
+    define("daily_private_tournaments", type=int, default=24, help="Private tournaments a user may create per day")
+    define("creation_interval", type=float, default=2, help="Seconds between runs of the creation queue")
+    define("creation_wait", type=float, default=10, help="Seconds a create request waits for its queued tournaments")
+    define("precompressed_cache_bytes", type=int, default=32 * 1024 * 1024,
+           help="Memory for compressed diploma template responses, 0 to disable")
+    define("render_processes", type=int, default=0, help="Processes rendering diplomas, 0 for one per CPU")
+    define("render_cache_days", type=float, default=30, help="Days rendered diplomas are kept after last use")
+    define("io_threads", type=int, default=4, help="Threads reading and writing files and the database")
+    define("stall_threshold", type=float, default=0.25,
+           help="Seconds the event loop may be blocked before its stack is logged, 0 to disable")
     define("db_dir", type=str, default='/var/lib/lichess-tournaments')
+    define("storage", type=str, default='sqlite', help=f"Storage engine: {', '.join(STORAGE_ENGINES)}")
+    define("journal_commit_interval", type=float, default=0.1,
+           help="Seconds between commits of the journal storage, the changes a crash may lose")
+    define("journal_commit_batch", type=int, default=256, help="Changes that start a journal commit right away")
+    define("journal_compact_bytes", type=int, default=16 * 1024 * 1024,
+           help="Journal size from which it is compacted into a snapshot")
 
     define('cookie_secret', type=str)
+    define('session_days', type=float, default=30, help="Days a login stays valid")
+    define('session_cache_entries', type=int, default=4096, help="Sessions kept in memory per process")
+    define('metrics_token', type=str, default='', help="Bearer token required for /metrics, empty allows anyone")
 
 
 define_options()
@@ -205,12 +218,13 @@ settings = {
     'static_path': options.static_path,
     'cookie_secret': options.cookie_secret,
     'xsrf_cookies': True,
-    'lichess': LichessAPI(options.lichess_client_id, f'{options.base_url}/login')
+    'log_function': log_request,
 }
 
 urls: tornado.web._RuleList = [
     (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": options.static_path}),
     (r"/", HomeHandler),
+    (rf"/diplomas/blob/({BLOB_NAME})", BlobHandler, {"path": blob_dir()}),
     (r"/diplomas/(add)", DiplomasHandler),
     (r"/diplomas/(delete)/([-a-zA-Z0-9_=]+)", DiplomasHandler),
     (r"/diplomas/(edit)/([-a-zA-Z0-9_=]+)", DiplomasHandler),
@@ -219,21 +233,113 @@ urls: tornado.web._RuleList = [
 
     (r"/api/v1/diploma/template/([-a-zA-Z0-9_=]+)?", DiplomaTemplateHandler),
     (r"/api/v1/diploma/template/duplicate/([-a-zA-Z0-9_=]+)?", DiplomaDuplicateHandler),
+    (r"/api/v1/diploma/render/([-a-zA-Z0-9_=]+)", DiplomaRenderHandler),
     (r"/api/v1/tournament/template/([-a-zA-Z0-9_=]*)", TournamentTemplateHandler),
     (r"/api/v1/tournament/create", TournamentCreateHandler),
+    (r"/api/v1/tournament/plan", TournamentPlanHandler),
+    (r"/api/v1/tournament/jobs/?([-a-zA-Z0-9_=]*)", CreationJobsHandler),
     (r"/api/v1/tournament/last", TournamentCreateHandler),
     (r"/api/v1/teams", TeamsAPI),
     (r"/api/v1/tournament", TournamentAPI),
     (r"/api/v1/tournament/stats", TournamentStatsHandler),
     (r"/api/v1/tournament/stats-debug", TournamentStatsDebugHandler),
+    (r"/api/v1/tournament/leaderboard", TournamentLeaderboardHandler),
+    (r"/api/v1/harvester/status", HarvesterStatusHandler),
+    (r"/api/v1/operations/?([-a-zA-Z0-9_=]*)", OperationsHandler),
+    (r"/api/v1/operations/([-a-zA-Z0-9_=]+)/events", OperationEventsHandler),
+    (r"/metrics", MetricsHandler),
 ]
-application = tornado.web.Application(urls, **settings)
+application = tornado.web.Application(urls, transforms=get_transforms(), **settings)
+
+
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+# Every server process gets an equal share of the Lichess limits. Created
+# after forking as the HTTP client belongs to the IOLoop of the process.
+def create_lichess_api(processes: int) -> LichessAPI:
+    rate = options.lichess_rate / processes
+    token_rate = options.lichess_token_rate / processes
+    return LichessAPI(
+        options.lichess_client_id, f'{options.base_url}/login',
+        cache=ResponseCache(options.lichess_cache_entries, options.lichess_cache_bytes),
+        scheduler=RequestScheduler(
+            rate=rate,
+            burst=rate,
+            token_rate=token_rate,
+            token_burst=2 * token_rate,
+            concurrency=max(1, options.lichess_concurrency // processes),
+            max_retries=options.lichess_retries))
+
+
+def ratio(hits: float, misses: float) -> Dict[Tuple[str, ...], float]:
+    return {(): hits / (hits + misses) if hits + misses else 0.0}
+
+
+def register_metrics(lichess: LichessAPI, sessions: SessionStore, queue: CreationQueue,
+                     operations: Operations, stall_detector: StallDetector) -> None:
+    Collected('lichess_cache_requests_total', "Lichess response cache lookups", 'counter', ('result',),
+              lambda: {(result,): lichess.cache.stats()[key]
+                       for result, key in (('hit', 'hits'), ('miss', 'misses'), ('shared', 'shared'))})
+    Collected('lichess_cache_hit_ratio', "Share of Lichess requests served from cache", 'gauge', (),
+              lambda: ratio(lichess.cache.hits + lichess.cache.shared, lichess.cache.misses))
+    Collected('lichess_cache_bytes', "Size of cached Lichess responses", 'gauge', (),
+              lambda: {(): lichess.cache.bytes})
+    Collected('lichess_scheduler_requests', "Lichess requests waiting for or holding a slot", 'gauge', ('state',),
+              lambda: {('queued',): lichess.scheduler.queue_depth, ('in_flight',): lichess.scheduler.in_flight})
+    Collected('lichess_scheduler_events_total', "Lichess retries and 429 replies", 'counter', ('event',),
+              lambda: {('retry',): lichess.scheduler.retries, ('throttled',): lichess.scheduler.throttled})
+    Collected('lichess_scheduler_wait_seconds_total', "Time spent waiting for the Lichess rate limits", 'counter',
+              (), lambda: {(): lichess.scheduler.wait_time})
+
+    def precompressed() -> Any:
+        return DiplomaTemplateHandler._fields_cache
+    Collected('precompressed_cache_hit_ratio', "Share of diploma templates served precompressed", 'gauge', (),
+              lambda: ratio(precompressed().hits, precompressed().misses) if precompressed() else {})
+    Collected('precompressed_cache_bytes', "Size of precompressed responses", 'gauge', (),
+              lambda: {(): precompressed().bytes} if precompressed() else {})
+    Collected('session_cache_hit_ratio', "Share of sessions found in memory", 'gauge', (),
+              lambda: ratio(sessions.hits, sessions.misses))
+    Collected('creation_jobs_total', "Tournament creation jobs run by the queue", 'counter', ('result',),
+              lambda: {('created',): queue.created, ('failed',): queue.failed, ('postponed',): queue.postponed})
+    Collected('operations_running', "Background operations running in this process", 'gauge', (),
+              lambda: {(): operations.running})
+    Collected('google_round_trips_total', "Requests sent to Google", 'counter', (),
+              lambda: {(): googleapi.client.round_trips})
+    Collected('event_loop_stalls_total', "Times the event loop was blocked longer than stall_threshold", 'counter',
+              (), lambda: {(): stall_detector.stalls})
+
+
+def forward_signal(signum: int, frame: Any) -> None:
+    # The parent of forked workers passes the signal on and then waits
+    # for them to exit
+    signal.signal(signum, signal.SIG_IGN)
+    os.killpg(0, signum)
+
+
+async def shutdown(server: tornado.httpserver.HTTPServer, harvester: StandingsHarvester,
+                   queue: CreationQueue, stall_detector: StallDetector) -> None:
+    logging.info("Shutting down")
+    # A second signal stops the process right away
+    for signum in SHUTDOWN_SIGNALS:
+        asyncio.get_event_loop().remove_signal_handler(signum)
+    server.stop()
+    harvester.stop()
+    queue.stop()
+    lichess = cast(LichessAPI, application.settings['lichess'])
+    if not await lichess.scheduler.drain(options.shutdown_timeout):
+        logging.warning(f"{lichess.scheduler.in_flight} Lichess requests still running")
+    shutdown_pool()
+    stall_detector.stop()
+    await googleapi.client.close()
+    shutdown_executor()
+    BaseHandler.db.close()
+    tornado.ioloop.IOLoop.current().stop()
 
 
 def run() -> None:
     logging.info(f'Starting server v. {__version__}.{__revision__}')
-    server = tornado.httpserver.HTTPServer(application, xheaders=True)
-    server.listen(options.port, options.bind)
+    sockets = tornado.netutil.bind_sockets(options.port, options.bind)
     logging.info(f'Listening on : {options.bind}:{options.port}')
     logging.info(f'Logging : {options.logging} ; Debug : {options.debug}')
     Path(options.db_dir).mkdir(mode=0o700, parents=True, exist_ok=True)
@@ -248,9 +354,83 @@ def run() -> None:
         logging.info(f"Dropping privileges to user: {options.user}/{uid}")
         os.setuid(uid)
 
-    BaseHandler.set_db(TinyDB(f'{options.db_dir}/db.json'))
-
-    tornado.ioloop.IOLoop.instance().start()
+    processes = options.processes or tornado.process.cpu_count()
+    metrics_dir = os.path.join(options.db_dir, 'metrics')
+    if processes > 1:
+        if not STORAGE_ENGINES[options.storage][0].MULTIPROCESS:
+            raise SystemExit(f"Storage {options.storage} cannot be shared by several processes")
+        if options.debug:
+            raise SystemExit("Debug mode only works with a single process")
+        logging.info(f"Starting {processes} processes")
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        for signum in SHUTDOWN_SIGNALS:
+            signal.signal(signum, forward_signal)
+        tornado.process.fork_processes(processes)
+        for signum in SHUTDOWN_SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+        if not options.render_processes:
+            options.render_processes = max(1, tornado.process.cpu_count() // processes)
+    worker = tornado.process.task_id() or 0
+
+    # Everything below is per process: each one has its own database
+    # connection, Lichess client and caches
+    storage_settings = {
+        'commit_interval': options.journal_commit_interval,
+        'commit_batch': options.journal_commit_batch,
+        'compact_bytes': options.journal_compact_bytes,
+    } if options.storage == 'journal' else {}
+    BaseHandler.set_db(TimedStorage(open_storage(options.storage, options.db_dir, **storage_settings)))
+    get_executor(options.io_threads)
+    googleapi.client.discovery_cache_dir = os.path.join(options.db_dir, 'google')
+    application.settings['lichess'] = create_lichess_api(processes)
+    application.settings['sessions'] = SessionStore(
+        BaseHandler.db, options.session_cache_entries, options.session_days * 86400)
+    # Creations are queued by every process and run by the first one
+    queue = CreationQueue(BaseHandler.db, application.settings['lichess'], options.daily_public_tournaments,
+                          options.daily_private_tournaments, options.creation_interval)
+    application.settings['creation_queue'] = queue
+    application.settings['operations'] = Operations(BaseHandler.db)
+    stall_detector = StallDetector(options.stall_threshold)
+    if options.stall_threshold > 0:
+        stall_detector.start()
+    register_metrics(application.settings['lichess'], application.settings['sessions'], queue,
+                     application.settings['operations'], stall_detector)
+    if processes > 1:
+        application.settings.update(worker=worker, metrics_dir=metrics_dir)
+        tornado.ioloop.PeriodicCallback(lambda: save_snapshot(metrics_dir, worker), 10 * 1000).start()
+    server = tornado.httpserver.HTTPServer(application, xheaders=True)
+    server.add_sockets(sockets)
+
+    harvester = StandingsHarvester(
+        BaseHandler.db, application.settings['lichess'], options.harvest_interval, options.harvest_batch,
+        options.harvest_window * 86400)
+    application.settings['harvester'] = harvester
+    if worker == 0:
+        queue.start()
+
+        async def start_harvester() -> None:
+            if backfilled := await run_blocking(backfill_standings, BaseHandler.db):
+                logging.info(f"Added standings of {backfilled} tournaments to the monthly stats")
+            harvester.start()
+        tornado.ioloop.IOLoop.current().add_callback(start_harvester)
+
+        async def prune() -> None:
+            if removed := await run_blocking(prune_renders, options.db_dir, options.render_cache_days * 86400):
+                logging.info(f"Removed {removed} cached diplomas")
+            if removed := await run_blocking(application.settings['sessions'].prune):
+                logging.info(f"Removed {removed} expired sessions")
+            if removed := await run_blocking(queue.prune):
+                logging.info(f"Removed {removed} finished creation jobs")
+            if removed := await run_blocking(application.settings['operations'].prune):
+                logging.info(f"Removed {removed} finished operations")
+        tornado.ioloop.IOLoop.current().add_callback(prune)
+        tornado.ioloop.PeriodicCallback(prune, 86400 * 1000).start()
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    for signum in SHUTDOWN_SIGNALS:
+        asyncio.get_event_loop().add_signal_handler(
+            signum, io_loop.add_callback, shutdown, server, harvester, queue, stall_detector)
+    io_loop.start()
 
 
 if __name__ == '__main__':